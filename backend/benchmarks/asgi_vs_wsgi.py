@@ -0,0 +1,100 @@
+'''
+Throughput and latency of the WSGI and ASGI serving modes under the
+same concurrent read and quiz traffic.
+
+Each mode is started as a server process against the same database, a
+closed-loop load runs against it, and the results are printed side by
+side. From the backend folder run:
+
+    pip install gunicorn uvicorn asyncpg
+    python -m benchmarks.asgi_vs_wsgi --concurrency 64 --duration 20
+'''
+import argparse
+import os
+import socket
+import subprocess
+import sys
+import time
+
+from .loadgen import run_load
+
+HOST = '127.0.0.1'
+
+# the WSGI mode gets the same number of threads the ASGI mode uses to
+# run passed-through requests, so only the native routes differ
+SERVERS = {
+    'wsgi': ['{python}', '-m', 'gunicorn', '--workers', '{workers}',
+             '--threads', '{threads}', '--bind', '{host}:{port}',
+             'flaskr:create_app()'],
+    'asgi': ['{python}', '-m', 'uvicorn', '--factory', '--workers',
+             '{workers}', '--host', '{host}', '--port', '{port}',
+             '--no-access-log', 'flaskr.asgi:create_asgi_app']
+}
+
+REQUESTS = [
+    ('GET', '/categories', None),
+    ('GET', '/questions?page=1', None),
+    ('GET', '/questions?page=2', None),
+    ('GET', '/categories/1/questions', None),
+    ('GET', '/categories/3/questions?after=0&limit=5', None),
+    ('POST', '/quizzes', {'previous_questions': [],
+                          'quiz_category': {'type': 'All', 'id': 0}}),
+    ('POST', '/quizzes', {'previous_questions': [20, 21],
+                          'quiz_category': {'type': 'Science', 'id': 1}}),
+]
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind((HOST, 0))
+        return sock.getsockname()[1]
+
+
+def wait_for(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection((HOST, port), 1).close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError('server on port {} did not start'.format(port))
+
+
+def benchmark(mode, args):
+    port = free_port()
+    command = [part.format(python=sys.executable, workers=args.workers,
+                           threads=args.threads, host=HOST, port=port)
+               for part in SERVERS[mode]]
+    # the response cache would hide the database work being compared
+    env = dict(os.environ, RESPONSE_CACHE='')
+    server = subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL,
+                              stderr=subprocess.DEVNULL)
+    try:
+        wait_for(port)
+        run_load(HOST, port, REQUESTS, args.concurrency, 2)
+        return run_load(HOST, port, REQUESTS, args.concurrency,
+                        args.duration)
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--concurrency', type=int, default=64)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--threads', type=int, default=16)
+    args = parser.parse_args()
+
+    results = {mode: benchmark(mode, args) for mode in SERVERS}
+    print('{:<12}{:>12}{:>12}'.format('', 'wsgi', 'asgi'))
+    for key in ['requests', 'errors', 'throughput', 'p50_ms', 'p90_ms',
+                'p99_ms', 'max_ms']:
+        print('{:<12}{:>12.1f}{:>12.1f}'.format(
+            key, results['wsgi'][key], results['asgi'][key]))
+
+
+if __name__ == '__main__':
+    main()
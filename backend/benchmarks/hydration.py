@@ -0,0 +1,70 @@
+'''
+Per-row cost of reading questions as ORM objects and formatting them,
+against reading the same columns as plain row tuples.
+
+Both ways read the same rows of the seeded database (see benchmarks.seed)
+and must render byte-identical JSON. From the backend folder run:
+
+    python -m benchmarks.hydration --rows 10000 --repeat 5
+'''
+import argparse
+import time
+
+from flask import json
+
+from .seed import bench_app, DEFAULT_DATABASE
+from models import db, Question
+
+
+def read_objects(limit):
+    # the read path before projection: full instances, then format()
+    questions = Question.query.order_by(Question.id).limit(limit).all()
+    return [question.format() for question in questions]
+
+
+def read_rows(limit):
+    rows = Question.rows().order_by(Question.id).limit(limit).all()
+    return [Question.format_row(row) for row in rows]
+
+
+def best_time(read, limit, repeat):
+    best = None
+    for _ in range(repeat):
+        # a new session per run, as every request gets one
+        db.session.remove()
+        started = time.perf_counter()
+        read(limit)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--database', default=DEFAULT_DATABASE)
+    parser.add_argument('--rows', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    app = bench_app(args.database)
+    with app.app_context():
+        objects = read_objects(args.rows)
+        if json.dumps(objects) != json.dumps(read_rows(args.rows)):
+            raise SystemExit('the two read paths render different JSON')
+        count = len(objects)
+        if count == 0:
+            raise SystemExit('no questions, seed the database first')
+
+        print('{:10}{:>12}{:>14}'.format('read', 'total ms', 'us per row'))
+        timings = {}
+        for name, read in [('objects', read_objects), ('rows', read_rows)]:
+            timings[name] = best_time(read, args.rows, args.repeat)
+            print('{:10}{:>12.2f}{:>14.2f}'.format(
+                name, timings[name] * 1000, timings[name] / count * 1e6))
+        print('{} rows, {:.1f}x faster, {:.2f} us saved per row'.format(
+            count, timings['objects'] / timings['rows'],
+            (timings['objects'] - timings['rows']) / count * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+'''
+A small closed-loop HTTP load generator: every client thread keeps one
+connection open and sends the next request as soon as the previous one
+is answered, until the duration is over.
+'''
+import http.client
+import itertools
+import json
+import threading
+import time
+
+
+def percentile(values, fraction):
+    if len(values) == 0:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(fraction * (len(values) - 1))))
+    return values[index]
+
+
+def summarize(latencies, errors, elapsed):
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'throughput': len(latencies) / elapsed if elapsed else 0.0,
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p90_ms': percentile(latencies, 0.90) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'max_ms': max(latencies) * 1000 if latencies else 0.0
+    }
+
+
+def client(host, port, requests, deadline, latencies, errors, lock):
+    connection = http.client.HTTPConnection(host, port, timeout=30)
+    mine = []
+    failed = 0
+    for method, path, body in requests:
+        if time.monotonic() >= deadline:
+            break
+        headers = {'Content-Type': 'application/json'} if body else {}
+        started = time.perf_counter()
+        try:
+            connection.request(method, path, body=body, headers=headers)
+            response = connection.getresponse()
+            response.read()
+            if response.status >= 500:
+                failed += 1
+        except (OSError, http.client.HTTPException):
+            failed += 1
+            connection.close()
+            connection = http.client.HTTPConnection(host, port, timeout=30)
+            continue
+        mine.append(time.perf_counter() - started)
+    connection.close()
+    with lock:
+        latencies.extend(mine)
+        errors[0] += failed
+
+
+'''
+run_load(host, port, requests, concurrency, duration)
+    requests is a list of (method, path, body) cycled by every client,
+    bodies given as dicts are sent as JSON. Returns the throughput and
+    latency percentiles of the run
+'''
+
+
+def run_load(host, port, requests, concurrency=16, duration=10.0):
+    requests = [(method, path, json.dumps(body)
+                 if isinstance(body, dict) else body)
+                for method, path, body in requests]
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    started = time.monotonic()
+    deadline = started + duration
+    threads = []
+    for number in range(concurrency):
+        # every client starts at another point of the request mix
+        offset = number % len(requests)
+        mix = itertools.cycle(requests[offset:] + requests[:offset])
+        thread = threading.Thread(target=client, args=(
+            host, port, mix, deadline, latencies, errors, lock))
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    return summarize(latencies, errors[0], time.monotonic() - started)
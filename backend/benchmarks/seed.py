@@ -0,0 +1,147 @@
+'''
+Seeds a synthetic question bank for the benchmarks.
+
+Question texts are drawn from a fixed pseudo-word vocabulary, so search
+terms hit a realistic number of rows, and a known marker word is put in
+about one question out of a hundred. Existing rows are kept, the table is
+topped up to the requested count. From the backend folder run:
+
+    python -m benchmarks.seed --database sqlite:///bench.db --count 100000
+    python -m benchmarks.seed --database postgres://.../trivia_bench \
+        --count 1000000
+'''
+import argparse
+import os
+import random
+
+from flaskr import create_app
+from models import setup_db, create_tables, db, questions_bulk_written, \
+    Category, Question
+
+DEFAULT_DATABASE = os.environ.get('BENCH_DATABASE_URL', 'sqlite:///bench.db')
+
+VOCABULARY_SIZE = 5000
+WORDS_PER_QUESTION = (5, 12)
+MARKER = 'zebra'
+MARKER_RATE = 0.01
+CATEGORIES = ['Science', 'Art', 'Geography', 'History', 'Entertainment',
+              'Sports']
+BATCH_SIZE = 1000
+
+
+def vocabulary(rng, size=VOCABULARY_SIZE):
+    letters = 'abcdefghijklmnopqrstuvwxyz'
+    words = set()
+    while len(words) < size:
+        words.add(''.join(rng.choice(letters)
+                          for _ in range(rng.randint(3, 9))))
+    return sorted(words)
+
+
+def make_rows(count, category_ids, seed=0):
+    rng = random.Random(seed)
+    words = vocabulary(rng)
+    for _ in range(count):
+        text = rng.sample(words, rng.randint(*WORDS_PER_QUESTION))
+        if rng.random() < MARKER_RATE:
+            text[rng.randrange(len(text))] = MARKER
+        yield {
+            'question': ' '.join(text).capitalize() + '?',
+            'answer': rng.choice(words),
+            'category': rng.choice(category_ids),
+            'difficulty': rng.randint(1, 5)
+        }
+
+
+def database_url(database):
+    # relative SQLite paths are taken from the working directory, not from
+    # the root of whichever app opens them
+    prefix = 'sqlite:///'
+    if database.startswith(prefix) and database != prefix and \
+            not database[len(prefix):].startswith('/'):
+        return prefix + os.path.abspath(database[len(prefix):])
+    return database
+
+
+'''
+bench_app(database, config)
+    the trivia app on the given database with its tables created. The
+    response cache is off unless the config turns it on, so repeated
+    requests measure the routes rather than the cache
+'''
+
+
+def bench_app(database=DEFAULT_DATABASE, config=None):
+    settings = {'RESPONSE_CACHE': None}
+    settings.update(config or {})
+    app = create_app(settings)
+    setup_db(app, database_url(database))
+    create_tables(app)
+    return app
+
+
+def ensure_categories(count):
+    existing = [category.id for category in
+                Category.query.order_by(Category.id)]
+    for number in range(len(existing), count):
+        name = CATEGORIES[number % len(CATEGORIES)]
+        if number >= len(CATEGORIES):
+            name += ' {}'.format(number // len(CATEGORIES) + 1)
+        category = Category(type=name)
+        category.insert()
+        existing.append(category.id)
+    return existing[:count]
+
+
+'''
+seed(app, count, categories)
+    tops the questions table of the app's database up to count rows
+    spread over the given number of categories, in multi-row INSERTs
+'''
+
+
+def seed(app, count, categories=len(CATEGORIES), seed=0, progress=None):
+    with app.app_context():
+        category_ids = ensure_categories(categories)
+        missing = count - Question.query.count()
+        if missing <= 0:
+            return 0
+
+        table = Question.__table__
+        batch = []
+        inserted = 0
+        for row in make_rows(missing, category_ids, seed):
+            batch.append(row)
+            if len(batch) == BATCH_SIZE:
+                db.session.execute(table.insert().values(batch))
+                db.session.commit()
+                inserted += len(batch)
+                batch = []
+                if progress is not None:
+                    progress(inserted, missing)
+        if len(batch) > 0:
+            db.session.execute(table.insert().values(batch))
+            db.session.commit()
+            inserted += len(batch)
+        questions_bulk_written()
+        return inserted
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--database', default=DEFAULT_DATABASE)
+    parser.add_argument('--count', type=int, default=10000)
+    parser.add_argument('--categories', type=int, default=len(CATEGORIES))
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    def progress(done, total):
+        print('\r{}/{}'.format(done, total), end='', flush=True)
+
+    inserted = seed(bench_app(args.database), args.count, args.categories,
+                    args.seed, progress)
+    print('\rinserted {} questions'.format(inserted))
+
+
+if __name__ == '__main__':
+    main()
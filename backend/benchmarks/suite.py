@@ -0,0 +1,258 @@
+'''
+Micro and macro benchmarks of the trivia routes on a seeded question bank.
+
+Micro benchmarks run every scenario in process through the Flask test
+client and count the SQL statements of each request. Macro benchmarks
+send the same requests to a running server with the closed-loop load
+generator. Both report throughput and latency percentiles, and a run can
+be saved as a baseline and later checked against it, exiting with status
+1 when a scenario regressed. From the backend folder run:
+
+    python -m benchmarks.seed --count 100000
+    python -m benchmarks.suite --save-baseline baseline.json
+    python -m benchmarks.suite --baseline baseline.json
+    python -m benchmarks.suite --url http://127.0.0.1:5000 --concurrency 32
+'''
+import argparse
+import json
+import sys
+import time
+from urllib.parse import urlsplit
+
+from sqlalchemy import event, func
+
+from .loadgen import run_load, summarize
+from .seed import bench_app, seed, DEFAULT_DATABASE, MARKER
+from models import db, Question
+
+# length of previous_questions in the quiz scenarios
+QUIZ_PREVIOUS = 500
+
+# a scenario regressed when its latency grew by more than the tolerance
+# and by more than the noise floor, or when it runs more queries
+DEFAULT_TOLERANCE = 0.25
+NOISE_FLOOR_MS = 0.5
+COMPARED = ['p50_ms', 'p90_ms']
+
+
+'''
+scenarios(app)
+    returns {name: [(method, path, body), ...]} for the seeded database.
+    One operation of a scenario sends its requests in order, a path may
+    refer to the JSON of the previous response, e.g. '{created}'
+'''
+
+
+def scenarios(app, previous=QUIZ_PREVIOUS):
+    with app.app_context():
+        count, last_id = db.session.query(func.count(Question.id),
+                                          func.max(Question.id)).one()
+        category_id = db.session.query(Question.category).\
+            order_by(Question.id).limit(1).scalar()
+        in_category = [question_id for question_id, in db.session.query(
+            Question.id).filter(Question.category == category_id).
+            order_by(Question.id).limit(previous)]
+        in_all = [question_id for question_id, in db.session.query(
+            Question.id).order_by(Question.id).limit(previous)]
+    if count == 0:
+        raise SystemExit('no questions, seed the database first')
+
+    last_page = (count - 1) // 10 + 1
+    return {
+        'categories': [('GET', '/categories', None)],
+        'questions_first_page': [('GET', '/questions?page=1', None)],
+        'questions_deep_page': [
+            ('GET', '/questions?page={}'.format(last_page), None)],
+        'questions_deep_cursor': [
+            ('GET', '/questions?after={}&limit=10'.format(last_id - 10),
+             None)],
+        'category_first_page': [
+            ('GET', '/categories/{}/questions?after=0&limit=10'.format(
+                category_id), None)],
+        'category_deep_cursor': [
+            ('GET', '/categories/{}/questions?after={}&limit=10'.format(
+                category_id, in_category[-1]), None)],
+        'search_index': [
+            ('POST', '/questions', {'searchTerm': MARKER, 'page': 1})],
+        'search_index_prefix': [
+            ('POST', '/questions', {'searchTerm': MARKER[:3], 'page': 1})],
+        'search_substring': [
+            ('POST', '/questions', {'searchTerm': MARKER, 'page': 1,
+                                    'mode': 'substring'})],
+        'quiz_turn_category': [
+            ('POST', '/quizzes', {'previous_questions': in_category,
+                                  'quiz_category': {'id': category_id}})],
+        'quiz_turn_all': [
+            ('POST', '/quizzes', {'previous_questions': in_all,
+                                  'quiz_category': {'id': 0}})],
+        'insert_delete': [
+            ('POST', '/questions', {'question': 'Benchmark question?',
+                                    'answer': 'yes', 'difficulty': 1,
+                                    'category': category_id}),
+            ('DELETE', '/questions/{created}', None)],
+    }
+
+
+class QueryCounter:
+    def __init__(self, engine):
+        self.engine = engine
+        self.count = 0
+
+    def __enter__(self):
+        event.listen(self.engine, 'before_cursor_execute', self.execute)
+        return self
+
+    def __exit__(self, *exc_info):
+        event.remove(self.engine, 'before_cursor_execute', self.execute)
+
+    def execute(self, *args):
+        self.count += 1
+
+
+def operation(client, requests):
+    data = {}
+    for method, path, body in requests:
+        response = client.open(path.format(**data), method=method,
+                               json=body)
+        if response.status_code >= 400:
+            raise RuntimeError('{} {} returned {}'.format(
+                method, path, response.status_code))
+        data = response.get_json() or {}
+
+
+'''
+run_micro(app, requests, iterations, warmup)
+    times iterations operations of a scenario in process after warmup
+    untimed ones, and adds the median number of queries per operation
+'''
+
+
+def run_micro(app, requests, iterations=200, warmup=20):
+    client = app.test_client()
+    for _ in range(warmup):
+        operation(client, requests)
+
+    latencies = []
+    queries = []
+    errors = 0
+    with app.app_context():
+        engine = db.engine
+    with QueryCounter(engine) as counter:
+        started = time.monotonic()
+        for _ in range(iterations):
+            before = counter.count
+            begun = time.perf_counter()
+            try:
+                operation(client, requests)
+            except RuntimeError:
+                errors += 1
+                continue
+            latencies.append(time.perf_counter() - begun)
+            queries.append(counter.count - before)
+        elapsed = time.monotonic() - started
+
+    result = summarize(latencies, errors, elapsed)
+    result['queries'] = sorted(queries)[len(queries) // 2] if queries else 0
+    return result
+
+
+def run_macro(url, requests, concurrency, duration):
+    # every operation of a load run must stand alone
+    if any('{' in path for _, path, _ in requests):
+        return None
+    address = urlsplit(url)
+    return run_load(address.hostname, address.port or 80, requests,
+                    concurrency, duration)
+
+
+'''
+regressions(results, baseline, tolerance)
+    returns a message for every scenario of the baseline that got slower
+    or runs more queries
+'''
+
+
+def regressions(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    messages = []
+    for name, expected in sorted(baseline.items()):
+        result = results.get(name)
+        if result is None:
+            continue
+        for metric in COMPARED:
+            limit = max(expected[metric] * (1 + tolerance),
+                        expected[metric] + NOISE_FLOOR_MS)
+            if result[metric] > limit:
+                messages.append('{}: {} {:.2f} > {:.2f}'.format(
+                    name, metric, result[metric], limit))
+        if 'queries' in expected and \
+                result.get('queries', 0) > expected['queries']:
+            messages.append('{}: queries {} > {}'.format(
+                name, result['queries'], expected['queries']))
+    return messages
+
+
+def print_table(results):
+    columns = ['throughput', 'p50_ms', 'p90_ms', 'p99_ms', 'max_ms',
+               'queries', 'errors']
+    print('{:24}'.format('scenario') +
+          ''.join('{:>12}'.format(column) for column in columns))
+    for name, result in results.items():
+        print('{:24}'.format(name) + ''.join(
+            '{:>12.2f}'.format(result[column])
+            if isinstance(result.get(column), float)
+            else '{:>12}'.format(result.get(column, '-'))
+            for column in columns))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--database', default=DEFAULT_DATABASE)
+    parser.add_argument('--rows', type=int, default=None,
+                        help='seed the database up to this many questions')
+    parser.add_argument('--scenario', action='append', default=None,
+                        help='run only these scenarios')
+    parser.add_argument('--iterations', type=int, default=200)
+    parser.add_argument('--warmup', type=int, default=20)
+    parser.add_argument('--url', default=None,
+                        help='run the macro benchmarks against this server')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=10.0)
+    parser.add_argument('--response-cache', action='store_true')
+    parser.add_argument('--baseline', default=None)
+    parser.add_argument('--save-baseline', default=None)
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE)
+    args = parser.parse_args()
+
+    config = {'RESPONSE_CACHE': 'memory'} if args.response_cache else {}
+    app = bench_app(args.database, config)
+    if args.rows is not None:
+        seed(app, args.rows)
+
+    results = {}
+    for name, requests in scenarios(app).items():
+        if args.scenario and name not in args.scenario:
+            continue
+        if args.url:
+            result = run_macro(args.url, requests, args.concurrency,
+                               args.duration)
+        else:
+            result = run_micro(app, requests, args.iterations, args.warmup)
+        if result is not None:
+            results[name] = result
+    print_table(results)
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as baseline:
+            json.dump(results, baseline, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            messages = regressions(results, json.load(baseline),
+                                   args.tolerance)
+        for message in messages:
+            print('regression', message)
+        if messages:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,32 +1,232 @@
+import math
 import os
-from flask import Flask, request, abort, jsonify
+import time
+import click
+from flask import Flask, request, abort, jsonify, g, Response, \
+    stream_with_context
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
-import random
-
-from models import setup_db, Question, Category
+from sqlalchemy.exc import SQLAlchemyError
+
+from models import setup_db, create_tables, pool_stats, read_setting, \
+    use_replica, db, Question, QuestionStats
+from .bulk import missing_fields, read_rows, import_questions, \
+    export_questions, delete_questions, update_questions, FORMATS, \
+    IMPORT_BATCH_SIZE, MAX_BATCH_ITEMS
+from .cache import category_cache, cache_backend, ResponseCache, \
+    CATEGORY_CACHE_TTL, RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL
+from .streaming import stream_questions, STREAM_FORMATS, \
+    STREAM_BATCH_SIZE
+from .httpcache import conditional, content_version
+from .search import get_search_backend, search_index, SUGGESTIONS, \
+    MAX_SUGGESTIONS
+from .quiz import question_pool, QuizSession, MemorySessionStore
+from .metrics import instrument
+from .fastjson import json_encoder
+from .compression import Compressor, COMPRESS_MIN_SIZE, COMPRESS_LEVEL, \
+    BROTLI_LEVEL
+from .admission import admission_control, parse_limits, shed, \
+    ADMISSION_LIMITS, ADMISSION_QUEUE_SIZE, ADMISSION_TIMEOUT, \
+    ADMISSION_RETRY_AFTER
+from .changes import read_changes, change_bounds, prune_changes, \
+    CHANGES_PER_PAGE, MAX_CHANGES_PER_PAGE, CHANGES_RETENTION_DAYS
+from .analytics import AnswerRecorder, ANSWER_QUEUE_SIZE, \
+    ANSWER_FLUSH_SIZE, ANSWER_FLUSH_INTERVAL, ANSWER_QUEUE_TIMEOUT
 
 QUESTIONS_PER_PAGE = 10
+MAX_QUESTIONS_PER_PAGE = 100
+
+# clients that wrote read from the primary this long, so they see their
+# writes even when the replicas lag behind
+READ_YOUR_WRITES_WINDOW = 5
+READ_PRIMARY_COOKIE = 'read_primary_until'
+
+# suggestions may be reused by clients and proxies for a few seconds
+SUGGESTIONS_MAX_AGE = 10
+
+# POST routes that don't write in the request, besides search
+READ_ONLY_ENDPOINTS = {'get_random_quiz_question', 'create_quiz_session',
+                       'next_quiz_question', 'record_quiz_answers'}
+
+
+def format_questions(request, rows):
+    # ?stats=true adds the answer statistics of the questions, one query
+    if request.args.get('stats', '').lower() not in ('1', 'true', 'yes'):
+        return [Question.format_row(row) for row in rows]
+    stats = QuestionStats.for_questions([row.id for row in rows])
+    return [Question.format_row(row, stats[row.id]) for row in rows]
 
 
 def questions_pagination(request, selection):
     page_num = request.args.get('page', '1', type=int)
+    if page_num < 1:
+        return []
     start = (page_num - 1) * QUESTIONS_PER_PAGE
-    end = start + QUESTIONS_PER_PAGE
-    questions = [question.format() for question in selection]
-    if len(questions) >= end:
-        my_questions = questions[start:end]
-        return my_questions
-    else:
-        my_questions = questions[start:]
-        return my_questions
+
+    # let the database slice the page so only 10 rows are loaded and formatted
+    page = selection.order_by(Question.id).\
+        limit(QUESTIONS_PER_PAGE).offset(start).all()
+    return format_questions(request, page)
+
+
+def questions_after(request, selection):
+    # keyset pagination: seek past the cursor on the primary key so deep
+    # pages cost the same as the first one
+    after = request.args.get('after', 0, type=int)
+    limit = request.args.get('limit', QUESTIONS_PER_PAGE, type=int)
+    if limit < 1:
+        abort(400)
+    limit = min(limit, MAX_QUESTIONS_PER_PAGE)
+
+    # fetch one extra row to know whether there is a next page
+    page = selection.filter(Question.id > after).order_by(Question.id).\
+        limit(limit + 1).all()
+    questions = format_questions(request, page[:limit])
+    next_cursor = questions[-1]['id'] if len(page) > limit else None
+    return questions, next_cursor
 
 
 def create_app(test_config=None):
     # create and configure the app
     app = Flask(__name__)
+    if test_config is not None:
+        app.config.from_mapping(test_config)
     setup_db(app)
 
+    @app.cli.command('init-db')
+    def init_db():
+        """Create the tables that don't exist yet."""
+        create_tables(app)
+
+    @app.cli.command('import-questions')
+    @click.argument('path', type=click.File('rb'))
+    @click.option('--format', type=click.Choice(FORMATS), default=None)
+    @click.option('--batch-size', type=int, default=IMPORT_BATCH_SIZE)
+    def import_questions_command(path, format, batch_size):
+        """Import questions from an NDJSON or CSV file."""
+        format = format or ('csv' if path.name.endswith('.csv')
+                            else 'ndjson')
+        report = import_questions(read_rows(path, format), batch_size)
+        click.echo('imported {imported}, failed {failed}'.format(**report))
+        for error in report['errors']:
+            click.echo('row {row}: {error}'.format(**error), err=True)
+
+    @app.cli.command('export-questions')
+    @click.argument('path', type=click.File('w'))
+    @click.option('--format', type=click.Choice(FORMATS), default='ndjson')
+    def export_questions_command(path, format):
+        """Export every question as NDJSON or CSV."""
+        for chunk in export_questions(format):
+            path.write(chunk)
+
+    @app.cli.command('prune-changes')
+    @click.option('--days', type=int, default=CHANGES_RETENTION_DAYS)
+    def prune_changes_command(days):
+        """Delete the change log older than the given days."""
+        click.echo('deleted {}'.format(prune_changes(days)))
+
+    # quiz decks live in a pluggable store, in process by default
+    quiz_sessions = app.config.get('QUIZ_SESSION_STORE') or \
+        MemorySessionStore()
+
+    # searchTerm queries use the inverted index unless configured otherwise
+    search_backend = app.config.get('SEARCH_BACKEND', 'index')
+    if isinstance(search_backend, str):
+        search_backend = get_search_backend(search_backend)
+
+    # rendered GET responses are shared through RESPONSE_CACHE, 'memory',
+    # a redis:// URL, a backend object, or None to turn it off
+    response_cache = app.config.get('RESPONSE_CACHE',
+                                    os.environ.get('RESPONSE_CACHE',
+                                                   'memory'))
+    if response_cache:
+        app.extensions['response_cache'] = ResponseCache(
+            cache_backend(response_cache,
+                          app.config.get('RESPONSE_CACHE_SIZE',
+                                         RESPONSE_CACHE_SIZE)),
+            app.config.get('RESPONSE_CACHE_TTL', RESPONSE_CACHE_TTL))
+
+    # bodies of COMPRESS_MIN_SIZE bytes or more are sent with gzip or br,
+    # whichever Accept-Encoding prefers, unless COMPRESSION is off
+    compressor = None
+    if read_setting(app, 'COMPRESSION', bool, True):
+        compressor = app.extensions['compression'] = Compressor(
+            read_setting(app, 'COMPRESS_MIN_SIZE', int, COMPRESS_MIN_SIZE),
+            read_setting(app, 'COMPRESS_LEVEL', int, COMPRESS_LEVEL),
+            read_setting(app, 'BROTLI_LEVEL', int, BROTLI_LEVEL))
+
+    # categories are served from memory, refreshed after CATEGORY_CACHE_TTL
+    category_cache.ttl = app.config.get('CATEGORY_CACHE_TTL',
+                                        CATEGORY_CACHE_TTL)
+
+    # responses are encoded with orjson or ujson when installed, compact
+    # even in debug mode, unless JSON_BACKEND and JSON_COMPACT say otherwise
+    app.json_encoder = json_encoder(
+        read_setting(app, 'JSON_BACKEND', str, 'auto'),
+        read_setting(app, 'JSON_COMPACT', bool, True), app.json_encoder)
+
+    # per request query count, DB, ORM and JSON encoding times, sent as a
+    # Server-Timing header and exported on GET /metrics, when METRICS is set
+    metrics = app.extensions['metrics'] = instrument(app) \
+        if read_setting(app, 'METRICS', bool, False) else None
+
+    # expensive endpoints run ADMISSION_LIMITS requests at once per process,
+    # the others queue for a turn or get 503, unless ADMISSION_CONTROL is
+    # off. With RATE_LIMIT set, each client gets that many requests per
+    # second, in bursts of RATE_LIMIT_BURST
+    admission = None
+    if read_setting(app, 'ADMISSION_CONTROL', bool, True):
+        admission = app.extensions['admission'] = admission_control(
+            app,
+            dict(ADMISSION_LIMITS,
+                 **read_setting(app, 'ADMISSION_LIMITS', parse_limits, {})),
+            read_setting(app, 'ADMISSION_QUEUE_SIZE', int,
+                         ADMISSION_QUEUE_SIZE),
+            read_setting(app, 'ADMISSION_TIMEOUT', float, ADMISSION_TIMEOUT),
+            read_setting(app, 'RATE_LIMIT', float, 0),
+            read_setting(app, 'RATE_LIMIT_BURST', int, None),
+            read_setting(app, 'ADMISSION_RETRY_AFTER', int,
+                         ADMISSION_RETRY_AFTER))
+
+    # quiz answers are queued and written behind the requests in batches
+    answer_recorder = app.extensions['answers'] = AnswerRecorder(
+        app,
+        read_setting(app, 'ANSWER_QUEUE_SIZE', int, ANSWER_QUEUE_SIZE),
+        read_setting(app, 'ANSWER_FLUSH_SIZE', int, ANSWER_FLUSH_SIZE),
+        read_setting(app, 'ANSWER_FLUSH_INTERVAL', float,
+                     ANSWER_FLUSH_INTERVAL),
+        read_setting(app, 'ANSWER_QUEUE_TIMEOUT', float,
+                     ANSWER_QUEUE_TIMEOUT))
+
+    # with DATABASE_REPLICA_URLS set, read-only requests go to a replica
+    read_your_writes_window = read_setting(
+        app, 'READ_YOUR_WRITES_WINDOW', float, READ_YOUR_WRITES_WINDOW)
+
+    def read_from_replica():
+        g.read_only = True
+        if app.extensions.get('replicas') is None:
+            return
+        if request.cookies.get(READ_PRIMARY_COOKIE, 0, type=float) > \
+                time.time():
+            return
+        use_replica()
+
+    @app.before_request
+    def route_reads():
+        if request.method in ('GET', 'HEAD') or \
+                request.endpoint in READ_ONLY_ENDPOINTS:
+            read_from_replica()
+
+    @app.after_request
+    def remember_writes(response):
+        if app.extensions.get('replicas') is not None and \
+                request.method in ('POST', 'PATCH', 'PUT', 'DELETE') and \
+                response.status_code < 400 and not g.get('read_only'):
+            response.set_cookie(READ_PRIMARY_COOKIE,
+                                str(time.time() + read_your_writes_window),
+                                max_age=int(read_your_writes_window) + 1)
+        return response
+
     '''
   @DONE: Set up CORS. Allow '*' for origins. Delete the sample
    route after completing the TODOs
@@ -42,6 +242,10 @@ def create_app(test_config=None):
         response.headers.add('Access-Control-Allow-Headers',
                              'Content-Type,Authorization,true')
         response.headers.add('Access-Control-Allow-Methods', 'GET,POST,DELETE')
+        # cacheable GETs are compressed before they are cached, see
+        # conditional, everything else is compressed here
+        if compressor is not None:
+            compressor.apply(response, compressor.negotiate())
         return response
 
     '''
@@ -51,17 +255,15 @@ def create_app(test_config=None):
   '''
 
     @app.route('/categories', methods=['GET'])
+    @conditional('categories')
     def retrieve_categories():
-        selection = Category.query.all()
-        if len(selection) == 0:
+        categories = category_cache.get(content_version('categories'))
+        if len(categories) == 0:
             abort(404)
 
-        # formatting categories as dictionary -> {key(id) : value(type)}
-        categories = {category.id: category.type for category in selection}
-
         return jsonify({
             'success': True,
-            'categories': categories
+            'categories': category_cache.fragment(categories)
         })
 
     '''
@@ -79,26 +281,31 @@ def create_app(test_config=None):
   '''
 
     @app.route('/questions', methods=['GET'])
+    @conditional('questions', 'categories', stats='question_stats')
     def retrieve_questions():
-        selection = Question.query.all()
-
-        # apply pagination with 10 questions per page
-        paginated_questions = questions_pagination(request, selection)
+        selection = Question.rows()
+
+        # use cursor pagination when ?after= is given, else 10 per page
+        cursor_mode = 'after' in request.args
+        if cursor_mode:
+            paginated_questions, next_cursor = questions_after(request,
+                                                               selection)
+        else:
+            paginated_questions = questions_pagination(request, selection)
         if len(paginated_questions) == 0:
             abort(404)
-        categories = Category.query.all()
-
-        # formatting categories as dictionary -> {key(id) : value(type)}
-        all_categories = {category.id: category.type
-                          for category in categories}
-        return jsonify({
+        result = {
             'success': True,
             'questions': paginated_questions,
-            'total_questions': len(selection),
-            'categories': all_categories,
+            'total_questions': selection.count(),
+            'categories': category_cache.fragment(
+                category_cache.get(content_version('categories'))),
             'current_category': [question['category']
                                  for question in paginated_questions]
-        })
+        }
+        if cursor_mode:
+            result['next_cursor'] = next_cursor
+        return jsonify(result)
 
     '''
   @DONE:
@@ -146,12 +353,10 @@ def create_app(test_config=None):
             search_input = data.get('searchTerm')
             if search_input is None or search_input == '':
                 abort(400)
-            return search_question(search_input)
+            return search_question(search_input, data)
 
-        for item in ['question', 'answer', 'difficulty', 'category']:
-            if item not in data.keys() or data[item] is None or\
-                            data[item] == '':
-                abort(400)
+        if len(missing_fields(data)) > 0:
+            abort(400)
 
         # in case POST request is to add new question
         try:
@@ -169,6 +374,89 @@ def create_app(test_config=None):
         except:
             abort(422)
 
+    '''
+  Bulk import reads NDJSON or CSV rows from the request body as they
+  arrive and inserts them in batches, export streams the table back.
+  '''
+
+    @app.route('/questions/import', methods=['POST'])
+    def bulk_import_questions():
+        format = request.args.get('format')
+        if format is None:
+            format = 'csv' if request.mimetype == 'text/csv' else 'ndjson'
+        batch_size = request.args.get('batch_size', IMPORT_BATCH_SIZE,
+                                      type=int)
+        if format not in FORMATS or batch_size < 1:
+            abort(400)
+
+        report = import_questions(read_rows(request.stream, format),
+                                  batch_size)
+        if report['imported'] == 0 and report['failed'] > 0:
+            status = 422
+        else:
+            status = 200
+        return jsonify(dict(report, success=status == 200)), status
+
+    '''
+  Batch delete and update take lists of ids or patches, run them in one
+  transaction with a few bulk statements and report on every item.
+  '''
+
+    def batch_items(name):
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict):
+            abort(400)
+        items = data.get(name)
+        if not isinstance(items, list) or len(items) == 0 or \
+                len(items) > MAX_BATCH_ITEMS:
+            abort(400)
+        return items
+
+    def batch_response(name, results, done):
+        failed = len(results) - done
+        status = 422 if done == 0 and failed > 0 else 200
+        return jsonify({
+            'success': status == 200,
+            name: done,
+            'failed': failed,
+            'results': results
+        }), status
+
+    @app.route('/questions/delete', methods=['POST'])
+    def batch_delete_questions():
+        ids = batch_items('ids')
+        try:
+            results, deleted = delete_questions(ids)
+        except SQLAlchemyError:
+            db.session.rollback()
+            abort(422)
+        return batch_response('deleted', results, deleted)
+
+    @app.route('/questions/update', methods=['POST'])
+    def batch_update_questions():
+        # a list of patches, or one change applied to a list of ids
+        data = request.get_json(silent=True)
+        if isinstance(data, dict) and isinstance(data.get('set'), dict):
+            patches = [dict(data['set'], id=question_id)
+                       for question_id in batch_items('ids')]
+        else:
+            patches = batch_items('patches')
+        try:
+            results, updated = update_questions(patches)
+        except SQLAlchemyError:
+            db.session.rollback()
+            abort(422)
+        return batch_response('updated', results, updated)
+
+    @app.route('/questions/export', methods=['GET'])
+    def bulk_export_questions():
+        format = request.args.get('format', 'ndjson')
+        if format not in FORMATS:
+            abort(400)
+        mimetype = 'text/csv' if format == 'csv' else 'application/x-ndjson'
+        return Response(stream_with_context(export_questions(format)),
+                        mimetype=mimetype)
+
     '''
   @DONE:
   Create a POST endpoint to get questions based on a search term.
@@ -179,20 +467,99 @@ def create_app(test_config=None):
   Try using the word "title" to start.
   '''
 
-    def search_question(search_input):
+    def search_question(search_input, data):
+        read_from_replica()
 
-        # query all questions that contains the term of search
-        selection = Question.query.filter(Question.question.ilike
-                                          ("%{}%".format(search_input))).all()
+        # "mode": "substring" keeps the old scan, else use the search index
+        try:
+            backend = get_search_backend(data['mode']) \
+                if 'mode' in data else search_backend
+        except ValueError:
+            abort(400)
+
+        # ?stream=json|ndjson writes every match as it is read
+        stream = request.args.get('stream')
+        if stream is not None:
+            if stream not in STREAM_FORMATS:
+                abort(400)
+            selection, total = backend.iterate(search_input,
+                                               STREAM_BATCH_SIZE)
+            if total == 0:
+                abort(404)
+            return stream_questions({'success': True,
+                                     'total_questions': total},
+                                    selection, stream, categories=True)
+
+        # return every match, or 10 per page when a page is given
+        page_num = data.get('page')
+        if page_num is None:
+            selection, total = backend.search(search_input)
+        else:
+            if not isinstance(page_num, int) or page_num < 1:
+                abort(400)
+            selection, total = backend.search(
+                search_input, (page_num - 1) * QUESTIONS_PER_PAGE,
+                QUESTIONS_PER_PAGE)
         if len(selection) == 0:
             abort(404)
         return jsonify({
             'success': True,
-            'questions': [question.format() for question in selection],
-            'total_questions': len(selection),
+            'questions': [Question.format_row(question)
+                          for question in selection],
+            'total_questions': total,
             'current_category': [question.category for question in selection]
         })
 
+    '''
+  The change feed lets clients keep a local copy of the questions and
+  categories up to date: fetch ?since=<version> and apply the rows
+  inserted, updated and deleted since then.
+  '''
+
+    @app.route('/changes', methods=['GET'])
+    @conditional('changes')
+    def retrieve_changes():
+        # without ?since=, the current version to start a local copy from
+        if 'since' not in request.args:
+            _, last = change_bounds()
+            return jsonify({
+                'success': True,
+                'version': last or 0
+            })
+
+        since = request.args.get('since', type=int)
+        limit = request.args.get('limit', CHANGES_PER_PAGE, type=int)
+        if since is None or since < 0 or limit < 1:
+            abort(400)
+        changes = read_changes(since, min(limit, MAX_CHANGES_PER_PAGE))
+        if changes is None:
+            abort(410)
+        return jsonify(dict(changes, success=True))
+
+    # the search index is built in the background once the app serves
+    @app.before_first_request
+    def warm_search_index():
+        search_index.warm(app)
+
+    @app.route('/questions/suggestions', methods=['GET'])
+    def suggest_questions():
+        # served from the search index as the user types, so clients may
+        # ask on every keystroke; short prefixes just get no suggestions,
+        # nor does anyone while the index is being built
+        limit = request.args.get('limit', SUGGESTIONS, type=int)
+        if limit < 1:
+            abort(400)
+        search_index.warm(app)
+        suggestions = search_index.suggest(request.args.get('q', ''),
+                                           min(limit, MAX_SUGGESTIONS))
+        response = jsonify({
+            'success': True,
+            'suggestions': suggestions
+        })
+        response.cache_control.public = True
+        response.cache_control.max_age = SUGGESTIONS_MAX_AGE
+        return response
+
     '''
   @DONE:
   Create a GET endpoint to get questions based on category.
@@ -203,14 +570,43 @@ def create_app(test_config=None):
   '''
 
     @app.route('/categories/<int:category_id>/questions', methods=['GET'])
+    @conditional('category:{category_id}', stats='question_stats')
     def getQuestions_by_category(category_id):
-        selection = Question.query.filter(Question.category ==
-                                          str(category_id)).all()
+        selection = Question.rows().filter(Question.category == category_id)
+
+        # ?stream=json|ndjson writes the questions as they are read
+        stream = request.args.get('stream')
+        if stream is not None:
+            if stream not in STREAM_FORMATS:
+                abort(400)
+            total = selection.count()
+            if total == 0:
+                abort(404)
+            return stream_questions({'success': True,
+                                     'total_questions': total,
+                                     'current_category': category_id},
+                                    selection.order_by(Question.id).
+                                    yield_per(STREAM_BATCH_SIZE), stream)
+
+        # return one page when ?after= is given, else the whole category
+        if 'after' in request.args:
+            questions, next_cursor = questions_after(request, selection)
+            if len(questions) == 0:
+                abort(404)
+            return jsonify({
+                'success': True,
+                'questions': questions,
+                'total_questions': selection.count(),
+                'current_category': category_id,
+                'next_cursor': next_cursor
+            })
+
+        selection = selection.all()
         if len(selection) == 0:
             abort(404)
         return jsonify({
             'success': True,
-            'questions': [question.format() for question in selection],
+            'questions': format_questions(request, selection),
             'total_questions': len(selection),
             'current_category': category_id
         })
@@ -230,36 +626,144 @@ def create_app(test_config=None):
     @app.route('/quizzes', methods=['POST'])
     def get_random_quiz_question():
         data = request.get_json()
-        quiz_questions = []
         category = data.get('quiz_category')
         previous_questions = data.get('previous_questions')
         if (category is None) or (previous_questions is None):
             return abort(400)
 
         try:
-            # query questions in case of all categories or any single category
-            selection = Question.query.filter(Question.category ==
-                                              category['id']).\
-                all() if category['id'] != 0 else Question.query.all()
-
-            # ensure quiz questions list doesn't contain any previous questions
-            for question in selection:
-                this_question = question.format()
-                if this_question['id'] in previous_questions:
-                    pass
-                else:
-                    quiz_questions.append(this_question)
-
-            # get random question of non previous questions
-            my_question = random.choice(quiz_questions) \
-                if len(quiz_questions) > 0 else None
+            # pick a random unseen id from the cached pool of the category
+            # (id 0 means all categories) and load only that question
+            my_question = question_pool.pick(category['id'],
+                                             previous_questions)
             return jsonify({
                 'success': True,
-                'question': my_question
+                'question': Question.format_row(my_question)
+                if my_question is not None else None
             })
         except:
             abort(422)
 
+    @app.route('/quizzes/answers', methods=['POST'])
+    def record_quiz_answers():
+        # one answer, or {"answers": [...]}, queued for the stats writer
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict):
+            abort(400)
+        answers = data.get('answers', [data])
+        if not isinstance(answers, list) or len(answers) == 0 or \
+                len(answers) > MAX_BATCH_ITEMS:
+            abort(400)
+        for answer in answers:
+            if not isinstance(answer, dict) or \
+                    type(answer.get('question_id')) is not int or \
+                    not isinstance(answer.get('correct'), bool):
+                abort(400)
+
+        recorded = answer_recorder.record_all(
+            [(answer['question_id'], answer['correct'])
+             for answer in answers])
+        if recorded == 0:
+            # the queue has room again once the worker wrote it
+            shed(503, math.ceil(answer_recorder.flush_interval))
+        return jsonify({
+            'success': True,
+            'recorded': recorded,
+            'dropped': len(answers) - recorded
+        }), 202
+
+    @app.route('/stats/answers', methods=['GET'])
+    def retrieve_answer_stats():
+        return jsonify({
+            'success': True,
+            'answers': answer_recorder.stats()
+        })
+
+    @app.route('/stats/cache', methods=['GET'])
+    def retrieve_cache_stats():
+        response_cache = app.extensions.get('response_cache')
+        return jsonify({
+            'success': True,
+            'categories': category_cache.stats(),
+            'responses': response_cache.stats()
+            if response_cache is not None else None
+        })
+
+    @app.route('/metrics', methods=['GET'])
+    def export_metrics():
+        if metrics is None:
+            abort(404)
+        body = metrics.render()
+        if admission is not None:
+            body += admission.render()
+        return Response(body, mimetype='text/plain; version=0.0.4')
+
+    @app.route('/stats/admission', methods=['GET'])
+    def retrieve_admission_stats():
+        # per endpoint: requests admitted, queued and shed, to tune limits
+        return jsonify({
+            'success': True,
+            'admission': admission.stats() if admission is not None
+            else None
+        })
+
+    @app.route('/stats/pool', methods=['GET'])
+    def retrieve_pool_stats():
+        # connection pool usage, to size the pool and the workers
+        replicas = app.extensions.get('replicas')
+        return jsonify({
+            'success': True,
+            'pool': pool_stats(),
+            'replicas': replicas.stats() if replicas is not None else []
+        })
+
+    '''
+  Quiz sessions keep a shuffled deck of the category questions on the
+  server, so each turn sends only the session id instead of the whole
+  list of previous questions.
+  '''
+
+    @app.route('/quizzes/sessions', methods=['POST'])
+    def create_quiz_session():
+        data = request.get_json()
+        category = data.get('quiz_category') if data is not None else None
+        if category is None:
+            abort(400)
+
+        try:
+            session = QuizSession.start(category['id'])
+        except (TypeError, KeyError, ValueError, SQLAlchemyError):
+            abort(422)
+        quiz_sessions.add(session)
+        return jsonify({
+            'success': True,
+            'session_id': session.id,
+            'total_questions': len(session.deck)
+        })
+
+    @app.route('/quizzes/sessions/<session_id>/next', methods=['POST'])
+    def next_quiz_question(session_id):
+        session = quiz_sessions.get(session_id)
+        if session is None:
+            abort(404)
+        my_question = session.next_question()
+        quiz_sessions.save(session)
+        return jsonify({
+            'success': True,
+            'question': Question.format_row(my_question)
+            if my_question is not None else None,
+            'played': session.played
+        })
+
+    @app.route('/quizzes/sessions/<session_id>', methods=['DELETE'])
+    def end_quiz_session(session_id):
+        if not quiz_sessions.remove(session_id):
+            abort(404)
+        return jsonify({
+            'success': True,
+            'deleted': session_id
+        })
+
     '''
   @DONE:
   Create error handlers for all expected errors
@@ -290,6 +794,14 @@ def create_app(test_config=None):
             "message": "Bad Request!"
         }), 400
 
+    @app.errorhandler(410)
+    def gone(error):
+        return jsonify({
+            "success": False,
+            "error": 410,
+            "message": "Gone!"
+        }), 410
+
     @app.errorhandler(422)
     def unprocessable(error):
         return jsonify({
@@ -298,4 +810,26 @@ def create_app(test_config=None):
             "message": "Unprocessable Entity!"
         }), 422
 
+    @app.errorhandler(429)
+    def too_many_requests(error):
+        response = jsonify({
+            "success": False,
+            "error": 429,
+            "message": "Too Many Requests!"
+        })
+        if g.get('retry_after') is not None:
+            response.headers['Retry-After'] = str(g.retry_after)
+        return response, 429
+
+    @app.errorhandler(503)
+    def service_unavailable(error):
+        response = jsonify({
+            "success": False,
+            "error": 503,
+            "message": "Service Unavailable!"
+        })
+        if g.get('retry_after') is not None:
+            response.headers['Retry-After'] = str(g.retry_after)
+        return response, 503
+
     return app
@@ -0,0 +1,275 @@
+import math
+import threading
+import time
+from collections import OrderedDict
+
+from flask import abort, g, request
+
+# concurrent requests per endpoint and process, the expensive ones only:
+# scans, whole-table loads and bulk writes hold a connection the longest
+ADMISSION_LIMITS = {
+    'search_question': 8,
+    'get_random_quiz_question': 16,
+    'create_quiz_session': 8,
+    'bulk_import_questions': 2,
+    'bulk_export_questions': 2,
+    'batch_delete_questions': 2,
+    'batch_update_questions': 2,
+}
+
+# requests over the limit wait in a queue this long for a turn, a full
+# queue or an expired wait is answered with 503 at once
+ADMISSION_QUEUE_SIZE = 32
+ADMISSION_TIMEOUT = 2.0
+
+# the Retry-After of shed requests, in seconds
+ADMISSION_RETRY_AFTER = 1
+
+# clients tracked by the rate limiter, the least recently seen are
+# forgotten first and start again with a full bucket
+RATE_LIMIT_CLIENTS = 10000
+
+
+'''
+ConcurrencyLimit(name, limit, queue_size, timeout)
+    lets limit requests run at once. Up to queue_size more wait, in
+    turn, at most timeout seconds for one of them to end, and the others
+    are refused. Counts what it admitted, queued, rejected and timed out
+'''
+
+
+class ConcurrencyLimit:
+
+    def __init__(self, name, limit, queue_size=ADMISSION_QUEUE_SIZE,
+                 timeout=ADMISSION_TIMEOUT):
+        self.name = name
+        self.limit = limit
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.active = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.queued = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.wait_time = 0.0
+        self._condition = threading.Condition()
+
+    def _admit(self):
+        # nobody jumps the queue while requests are waiting
+        if self.active < self.limit and self.waiting == 0:
+            self.active += 1
+            self.admitted += 1
+            return True
+        return False
+
+    def try_acquire(self):
+        # admits the request if it needn't wait, else leaves it to acquire
+        with self._condition:
+            return self._admit()
+
+    def acquire(self):
+        with self._condition:
+            if self._admit():
+                return True
+            if self.waiting >= self.queue_size:
+                self.rejected += 1
+                return False
+
+            self.waiting += 1
+            self.queued += 1
+            started = time.monotonic()
+            try:
+                while self.active >= self.limit:
+                    remaining = started + self.timeout - time.monotonic()
+                    if remaining <= 0:
+                        self.timed_out += 1
+                        return False
+                    self._condition.wait(remaining)
+            finally:
+                self.waiting -= 1
+                self.wait_time += time.monotonic() - started
+            self.active += 1
+            self.admitted += 1
+            return True
+
+    def release(self):
+        with self._condition:
+            self.active -= 1
+            self._condition.notify()
+
+    def stats(self):
+        with self._condition:
+            return {
+                'limit': self.limit,
+                'queue_size': self.queue_size,
+                'active': self.active,
+                'waiting': self.waiting,
+                'admitted': self.admitted,
+                'queued': self.queued,
+                'rejected': self.rejected,
+                'timed_out': self.timed_out,
+                'wait_time': self.wait_time
+            }
+
+
+'''
+RateLimiter(rate, burst)
+    a token bucket per client: burst requests at once, then rate requests
+    per second. take() returns 0 when the request may run, else how many
+    seconds until the client may send the next one
+'''
+
+
+class RateLimiter:
+
+    def __init__(self, rate, burst, max_clients=RATE_LIMIT_CLIENTS):
+        self.rate = rate
+        self.burst = burst
+        self.max_clients = max_clients
+        self.allowed = 0
+        self.limited = 0
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, client):
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.pop(client, None)
+            if bucket is None:
+                tokens = self.burst
+            else:
+                tokens = min(self.burst,
+                             bucket[0] + (now - bucket[1]) * self.rate)
+            if tokens >= 1:
+                tokens -= 1
+                wait = 0
+                self.allowed += 1
+            else:
+                wait = (1 - tokens) / self.rate
+                self.limited += 1
+            self._buckets[client] = (tokens, now)
+            if len(self._buckets) > self.max_clients:
+                self._buckets.popitem(last=False)
+        return wait
+
+    def stats(self):
+        with self._lock:
+            return {
+                'rate': self.rate,
+                'burst': self.burst,
+                'clients': len(self._buckets),
+                'allowed': self.allowed,
+                'limited': self.limited
+            }
+
+
+def shed(code, retry_after):
+    # the error handlers send g.retry_after as Retry-After, abort() only
+    # takes it as an argument since Werkzeug 1.0
+    g.retry_after = retry_after
+    abort(code)
+
+
+def parse_limits(value):
+    # {endpoint: limit} from a dict or 'search_question=8,...'
+    if isinstance(value, str):
+        value = dict(item.split('=', 1) for item in value.split(',')
+                     if item.strip())
+    return {name.strip(): int(limit) for name, limit in value.items()}
+
+
+def limit_name():
+    # searches share POST /questions with inserts, but not their cost
+    if request.endpoint == 'insert_question':
+        data = request.get_json(silent=True)
+        if isinstance(data, dict) and 'searchTerm' in data:
+            return 'search_question'
+    return request.endpoint
+
+
+'''
+AdmissionControl
+    the concurrency limits of the app endpoints and the optional client
+    rate limiter, with their counters as a dict and as Prometheus text
+'''
+
+
+class AdmissionControl:
+
+    def __init__(self, limits, rate_limiter=None,
+                 retry_after=ADMISSION_RETRY_AFTER):
+        self.limits = limits
+        self.rate_limiter = rate_limiter
+        self.retry_after = retry_after
+
+    def stats(self):
+        return {
+            'endpoints': {name: limit.stats()
+                          for name, limit in sorted(self.limits.items())},
+            'rate_limit': self.rate_limiter.stats()
+            if self.rate_limiter is not None else None
+        }
+
+    def render(self):
+        lines = []
+        for counter in ('admitted', 'queued', 'rejected', 'timed_out'):
+            name = 'trivia_admission_{}_total'.format(counter)
+            lines.append('# TYPE {} counter'.format(name))
+            lines.extend('{}{{endpoint="{}"}} {}'.format(
+                name, endpoint, getattr(limit, counter))
+                for endpoint, limit in sorted(self.limits.items()))
+        for gauge in ('active', 'waiting'):
+            name = 'trivia_admission_{}'.format(gauge)
+            lines.append('# TYPE {} gauge'.format(name))
+            lines.extend('{}{{endpoint="{}"}} {}'.format(
+                name, endpoint, getattr(limit, gauge))
+                for endpoint, limit in sorted(self.limits.items()))
+        if self.rate_limiter is not None:
+            for counter in ('allowed', 'limited'):
+                name = 'trivia_rate_limit_{}_total'.format(counter)
+                lines.append('# TYPE {} counter'.format(name))
+                lines.append('{} {}'.format(
+                    name, getattr(self.rate_limiter, counter)))
+        return '\n'.join(lines) + '\n'
+
+
+'''
+admission_control(app, limits, queue_size, timeout, rate, burst)
+    sheds load before the views run: a client over its rate gets 429, a
+    request to a limited endpoint waits for a turn or gets 503, both with
+    a Retry-After header. The turn is given back once the response, even
+    a streamed one, is sent. Returns the AdmissionControl
+'''
+
+
+def admission_control(app, limits=ADMISSION_LIMITS,
+                      queue_size=ADMISSION_QUEUE_SIZE,
+                      timeout=ADMISSION_TIMEOUT, rate=0, burst=None,
+                      retry_after=ADMISSION_RETRY_AFTER):
+    control = AdmissionControl(
+        {name: ConcurrencyLimit(name, limit, queue_size, timeout)
+         for name, limit in limits.items() if limit > 0},
+        RateLimiter(rate, burst or max(1, rate)) if rate > 0 else None,
+        retry_after)
+
+    @app.before_request
+    def admit():
+        if control.rate_limiter is not None:
+            wait = control.rate_limiter.take(request.remote_addr)
+            if wait > 0:
+                shed(429, math.ceil(wait))
+        limit = control.limits.get(limit_name())
+        if limit is None:
+            return
+        if not limit.acquire():
+            shed(503, control.retry_after)
+        g.admission = limit
+
+    @app.teardown_request
+    def release(exc):
+        limit = g.pop('admission', None)
+        if limit is not None:
+            limit.release()
+
+    return control
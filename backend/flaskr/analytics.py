@@ -0,0 +1,157 @@
+import atexit
+import queue
+import threading
+import time
+
+from sqlalchemy.exc import IntegrityError
+
+from models import db, add_question_stats
+
+# answers waiting to be written, more are refused until the worker catches up
+ANSWER_QUEUE_SIZE = 10000
+
+# the worker writes once this many answers are queued, or after the interval
+ANSWER_FLUSH_SIZE = 500
+ANSWER_FLUSH_INTERVAL = 2.0
+
+# how long record() waits for room in a full queue before refusing
+ANSWER_QUEUE_TIMEOUT = 0.05
+
+
+'''
+AnswerRecorder(app, queue_size, flush_size, flush_interval, queue_timeout)
+    records quiz answers in a bounded in-process queue and writes them
+    behind the requests: a background thread adds them up per question
+    and writes the counts in one transaction whenever flush_size answers
+    are waiting or flush_interval seconds passed. A full queue wakes the
+    worker, answers are refused once it stayed full for queue_timeout
+    seconds of a call. What is left is written when the process exits
+'''
+
+
+class AnswerRecorder:
+
+    def __init__(self, app, queue_size=ANSWER_QUEUE_SIZE,
+                 flush_size=ANSWER_FLUSH_SIZE,
+                 flush_interval=ANSWER_FLUSH_INTERVAL,
+                 queue_timeout=ANSWER_QUEUE_TIMEOUT):
+        self.app = app
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.queue_timeout = queue_timeout
+        self.queue = queue.Queue(queue_size)
+        self.recorded = 0
+        self.dropped = 0
+        self.written = 0
+        self.failed = 0
+        self.flushes = 0
+        self._worker = None
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+        self._flush_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+
+    def start(self):
+        # the worker starts with the first answer, not with every app
+        with self._stats_lock:
+            if self._worker is not None:
+                return
+            self._worker = threading.Thread(target=self._run,
+                                            name='answer-recorder',
+                                            daemon=True)
+            self._worker.start()
+        atexit.register(self.close)
+
+    def record(self, question_id, correct):
+        return self.record_all([(question_id, correct)]) == 1
+
+    def record_all(self, answers):
+        # queues (question_id, correct) pairs, waiting at most queue_timeout
+        # in all for room, and drops the rest once the queue is full.
+        # Returns how many were queued
+        self.start()
+        if self.queue.qsize() >= self.flush_size:
+            self._wake.set()
+        deadline = time.monotonic() + self.queue_timeout
+        recorded = 0
+        for question_id, correct in answers:
+            try:
+                self.queue.put((question_id, bool(correct)),
+                               timeout=max(0, deadline - time.monotonic()))
+            except queue.Full:
+                self._wake.set()
+                break
+            recorded += 1
+        with self._stats_lock:
+            self.recorded += recorded
+            self.dropped += len(answers) - recorded
+        return recorded
+
+    def _run(self):
+        while not self._stopping.is_set():
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self.flush()
+
+    def _drain(self):
+        # {question_id: [plays, correct]} of every queued answer
+        counts = {}
+        while True:
+            try:
+                question_id, correct = self.queue.get_nowait()
+            except queue.Empty:
+                return counts
+            total = counts.setdefault(question_id, [0, 0])
+            total[0] += 1
+            total[1] += correct
+
+    def flush(self):
+        # writes every answer queued so far, returns how many were written,
+        # answers to questions deleted in the meantime are not
+        with self._flush_lock:
+            counts = self._drain()
+            if len(counts) == 0:
+                return 0
+            answers = sum(plays for plays, _ in counts.values())
+            try:
+                written = self._write(counts)
+            except Exception:
+                self.app.logger.exception('could not write %d quiz answers',
+                                          answers)
+                with self._stats_lock:
+                    self.failed += answers
+                return 0
+            with self._stats_lock:
+                self.written += written
+                self.flushes += 1
+            return written
+
+    def _write(self, counts):
+        with self.app.app_context():
+            try:
+                with db.engine.begin() as connection:
+                    return add_question_stats(connection, counts)
+            except IntegrityError:
+                # another process created some of the same counters first
+                with db.engine.begin() as connection:
+                    return add_question_stats(connection, counts)
+
+    def close(self):
+        self._stopping.set()
+        self._wake.set()
+        worker = self._worker
+        if worker is not None and worker is not threading.current_thread():
+            worker.join(self.flush_interval + 1)
+        self.flush()
+
+    def stats(self):
+        with self._stats_lock:
+            return {
+                'queued': self.queue.qsize(),
+                'capacity': self.queue.maxsize,
+                'recorded': self.recorded,
+                'dropped': self.dropped,
+                'written': self.written,
+                'failed': self.failed,
+                'flushes': self.flushes
+            }
@@ -0,0 +1,744 @@
+'''
+ASGI entry point of the trivia API
+
+The read routes that spend their time waiting on PostgreSQL (categories,
+question pages, category questions and quiz turns) are served natively
+with asyncpg, so a waiting request doesn't hold a thread. They send the
+same ETags, 304s and compressed bodies as the Flask views and share the
+response cache. Every other request (creating, deleting and searching
+questions, quiz sessions, bulk import and export, stats) is passed to
+the Flask app on a worker thread, so ORM events, caches and indexes
+behave as they do under WSGI. The native routes are timed into the same
+metrics and read from the same replicas as the Flask views. Run it with:
+
+    pip install asyncpg uvicorn
+    uvicorn --factory flaskr.asgi:create_asgi_app
+'''
+import asyncio
+import io
+import json
+import math
+import re
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import ContextVar
+
+from werkzeug.wrappers import Request as BaseRequest, Response
+
+try:
+    import asyncpg
+except ImportError:  # the ASGI mode is optional
+    asyncpg = None
+
+from models import read_setting, replica_urls, QuestionStats
+from . import create_app, QUESTIONS_PER_PAGE, MAX_QUESTIONS_PER_PAGE, \
+    READ_PRIMARY_COOKIE
+from .httpcache import compute_etag, not_modified, set_cache_headers, \
+    HTTP_CACHE_MAX_AGE
+from .metrics import server_timing, RequestTiming
+from .quiz import question_pool, pick_unseen, category_key, pool_version, \
+    ALL_CATEGORIES
+
+# threads running the requests passed to the Flask app
+WSGI_THREADS = 16
+
+# chunks of a passed-through response buffered ahead of a slow client,
+# which is dropped once it read nothing for WSGI_SEND_TIMEOUT seconds
+WSGI_QUEUE_SIZE = 16
+WSGI_SEND_TIMEOUT = 30
+
+ERROR_MESSAGES = {
+    400: 'Bad Request!',
+    404: 'Resource Not Found!',
+    422: 'Unprocessable Entity!',
+    429: 'Too Many Requests!',
+    500: 'Internal Server Error!',
+    503: 'Service Unavailable!'
+}
+
+QUESTION_COLUMNS = 'id, question, answer, category, difficulty'
+
+# a replica is taken out when it can't be reached, not on bad statements
+CONNECTION_ERRORS = (OSError, asyncio.TimeoutError) + (
+    (asyncpg.PostgresConnectionError, asyncpg.InterfaceError)
+    if asyncpg is not None else ())
+
+# the native request being handled by this task, if any
+current_request = ContextVar('current_request', default=None)
+
+CORS_HEADERS = [
+    (b'access-control-allow-headers', b'Content-Type,Authorization,true'),
+    (b'access-control-allow-methods', b'GET,POST,DELETE')
+]
+
+
+class HTTPError(Exception):
+
+    def __init__(self, status, retry_after=None):
+        super().__init__(status)
+        self.status = status
+        self.retry_after = retry_after
+
+
+class ClientDisconnected(Exception):
+    pass
+
+
+def dumps(data):
+    # same bytes as jsonify outside debug mode
+    return (json.dumps(data, sort_keys=True, separators=(',', ':')) +
+            '\n').encode('utf-8')
+
+
+def asyncpg_dsn(database_path):
+    # asyncpg only knows the plain postgres schemes
+    scheme, rest = database_path.split('://', 1)
+    if not scheme.startswith('postgres'):
+        raise ValueError('the ASGI mode needs a PostgreSQL database')
+    return 'postgresql://' + rest
+
+
+class Request(BaseRequest):
+
+    def __init__(self, environ, body, params, timing=None):
+        super().__init__(environ)
+        self.body = body
+        self.params = params
+        self.timing = timing
+        # the pool it reads from, and its replica engine if it is one
+        self.pool = None
+        self.replica = None
+
+    def arg(self, name, default, type=int):
+        # like request.args.get(name, default, type=type) in Flask
+        return self.args.get(name, default, type=type)
+
+    def get_json(self):
+        try:
+            return json.loads(self.body.decode('utf-8'))
+        except ValueError:
+            return None
+
+
+def format_question(row, stats=None):
+    result = {
+        'id': row['id'],
+        'question': row['question'],
+        'answer': row['answer'],
+        'category': row['category'],
+        'difficulty': row['difficulty']
+    }
+    if stats is not None:
+        result['stats'] = stats
+    return result
+
+
+'''
+AsgiApp
+    routes requests to the native handlers or to the Flask app
+'''
+
+
+class AsgiApp:
+
+    def __init__(self, wsgi_app, dsn, pool_options):
+        self.wsgi_app = wsgi_app
+        self.dsn = dsn
+        self.pool_options = pool_options
+        # asyncpg pools, of the primary under None and of each replica
+        # under its engine in the ReplicaSet of the Flask app
+        self.pools = {}
+        self._pool_locks = None
+        self.replicas = wsgi_app.extensions.get('replicas')
+        self.replica_dsns = {} if self.replicas is None else {
+            engine: asyncpg_dsn(url) for engine, url in
+            zip(self.replicas.engines, replica_urls(wsgi_app))}
+        self.metrics = wsgi_app.extensions.get('metrics')
+        self.rules = {rule.endpoint: rule.rule
+                      for rule in wsgi_app.url_map.iter_rules()}
+        self.executor = ThreadPoolExecutor(
+            wsgi_app.config.get('ASGI_WSGI_THREADS', WSGI_THREADS))
+        self.send_timeout = wsgi_app.config.get('ASGI_SEND_TIMEOUT',
+                                                WSGI_SEND_TIMEOUT)
+        self.compressor = wsgi_app.extensions.get('compression')
+        self.response_cache = wsgi_app.extensions.get('response_cache')
+        self.admission = wsgi_app.extensions.get('admission')
+        self.max_age = wsgi_app.config.get('HTTP_CACHE_MAX_AGE',
+                                           HTTP_CACHE_MAX_AGE)
+        # with the endpoint of the Flask view, for admission control, and
+        # the content versions of the GET routes, as in conditional
+        self.routes = [
+            ('GET', re.compile(r'^/categories$'), 'retrieve_categories',
+             self.categories, ['categories'], {}),
+            ('GET', re.compile(r'^/questions$'), 'retrieve_questions',
+             self.questions, ['questions', 'categories'],
+             {'stats': 'question_stats'}),
+            ('GET', re.compile(r'^/categories/(?P<category_id>\d+)'
+                               r'/questions$'), 'getQuestions_by_category',
+             self.category_questions, ['category:{category_id}'],
+             {'stats': 'question_stats'}),
+            ('POST', re.compile(r'^/quizzes$'), 'get_random_quiz_question',
+             self.quiz_question, None, None),
+        ]
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        if scope['type'] != 'http':
+            return
+
+        body = await self.read_body(receive)
+        for method, pattern, endpoint, handler, names, optional_names \
+                in self.routes:
+            match = pattern.match(scope['path'])
+            if match and method == scope['method']:
+                request = Request(self.wsgi_environ(scope, body), body,
+                                  match.groupdict(), RequestTiming()
+                                  if self.metrics is not None else None)
+                current_request.set(request)
+                limit = None
+                try:
+                    limit = await self.admit(request, endpoint)
+                    response = await self.respond(request, handler, names,
+                                                  optional_names)
+                except HTTPError as error:
+                    response = self.error_response(error.status,
+                                                   error.retry_after)
+                except Exception:
+                    # logged like Flask logs the errors of its views
+                    self.wsgi_app.logger.exception(
+                        'Exception on %s [%s]', request.path,
+                        request.method)
+                    response = self.error_response(500)
+                finally:
+                    # the database work is done once the response is built
+                    if limit is not None:
+                        limit.release()
+                # None for the requests left to Flask
+                if response is not None:
+                    return await self.send_timed(send, request, response,
+                                                 self.rules[endpoint])
+                current_request.set(None)
+                break
+        await self.call_wsgi(scope, body, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                try:
+                    await self.connect()
+                except Exception as error:
+                    await send({'type': 'lifespan.startup.failed',
+                                'message': str(error)})
+                    return
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.close()
+                self.executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def connect(self, replica=None):
+        # the pool of the primary, or of a replica, created once. Each
+        # has a lock, so a replica slow to answer holds up no other pool
+        if self._pool_locks is None:
+            self._pool_locks = {}
+        lock = self._pool_locks.setdefault(replica, asyncio.Lock())
+        async with lock:
+            pool = self.pools.get(replica)
+            if pool is None:
+                if asyncpg is None:
+                    raise RuntimeError('the ASGI mode needs asyncpg')
+                dsn = self.dsn if replica is None else \
+                    self.replica_dsns[replica]
+                pool = self.pools[replica] = await asyncpg.create_pool(
+                    dsn, **self.pool_options)
+        return pool
+
+    async def close(self):
+        pools, self.pools = self.pools, {}
+        for pool in pools.values():
+            await pool.close()
+        # the locks belong to the event loop that created them
+        self._pool_locks = None
+
+    async def read_body(self, receive):
+        chunks = []
+        more_body = True
+        while more_body:
+            message = await receive()
+            chunks.append(message.get('body', b''))
+            more_body = message.get('more_body', False)
+        return b''.join(chunks)
+
+    async def send_response(self, send, environ, response):
+        app_iter, status, headers = response.get_wsgi_response(environ)
+        await send({
+            'type': 'http.response.start',
+            'status': int(status.split(' ', 1)[0]),
+            'headers': [(name.lower().encode('latin-1'),
+                         value.encode('latin-1'))
+                        for name, value in headers] + CORS_HEADERS
+        })
+        await send({'type': 'http.response.body', 'body': b''.join(app_iter)})
+
+    async def send_timed(self, send, request, response, rule):
+        # with METRICS on, the timings go in a Server-Timing header and,
+        # once the body is sent, in the histograms of the Flask app
+        timing = request.timing
+        if timing is not None:
+            timing.status = response.status_code
+            response.headers['Server-Timing'] = server_timing(timing)
+        await self.send_response(send, request.environ, response)
+        if timing is not None:
+            self.metrics.record((rule, request.method, str(timing.status)),
+                                timing, time.perf_counter() - timing.started)
+
+    def error_response(self, status, retry_after=None):
+        response = Response(self.encode({
+            'success': False,
+            'error': status,
+            'message': ERROR_MESSAGES[status]
+        }), status=status, mimetype='application/json')
+        if retry_after is not None:
+            response.headers['Retry-After'] = str(retry_after)
+        return response
+
+    async def admit(self, request, endpoint):
+        # the admission control of the Flask app: the client's rate, then a
+        # turn of the endpoint's limit, waited for on a thread of the
+        # default executor when there is none free. Returns the limit to
+        # release. A request left to Flask after all is admitted there too
+        if self.admission is None:
+            return None
+        rate_limiter = self.admission.rate_limiter
+        if rate_limiter is not None:
+            wait = rate_limiter.take(request.remote_addr)
+            if wait > 0:
+                raise HTTPError(429, math.ceil(wait))
+        limit = self.admission.limits.get(endpoint)
+        if limit is None:
+            return None
+        if not limit.try_acquire() and not await \
+                asyncio.get_running_loop().run_in_executor(None,
+                                                           limit.acquire):
+            raise HTTPError(503, self.admission.retry_after)
+        return limit
+
+    async def read_pool(self, request):
+        # like the Flask app, reads go to the next healthy replica unless
+        # the client wrote recently. A replica is probed once its retry
+        # time came, and taken out when it can't be reached
+        replicas = self.replicas
+        if replicas is not None and request.cookies.get(
+                READ_PRIMARY_COOKIE, 0, type=float) <= time.time():
+            for _ in range(len(replicas.engines)):
+                replica, up = replicas.next_engine()
+                if up is False:
+                    continue
+                try:
+                    pool = self.pools.get(replica) or \
+                        await self.connect(replica)
+                    if up is None:
+                        await pool.fetchval('SELECT 1')
+                        replicas.mark_up(replica)
+                except CONNECTION_ERRORS:
+                    replicas.mark_down(replica)
+                    continue
+                request.replica = replica
+                return pool
+        return self.pools.get(None) or await self.connect()
+
+    async def query(self, method, query, *args):
+        # runs on the pool of the current request, timed for its metrics
+        request = current_request.get()
+        if request is None:
+            pool = self.pools.get(None) or await self.connect()
+            return await getattr(pool, method)(query, *args)
+        if request.pool is None:
+            request.pool = await self.read_pool(request)
+        started = time.perf_counter()
+        try:
+            return await getattr(request.pool, method)(query, *args)
+        except CONNECTION_ERRORS:
+            if request.replica is not None:
+                self.replicas.mark_down(request.replica)
+            raise
+        finally:
+            if request.timing is not None:
+                request.timing.queries += 1
+                request.timing.db += time.perf_counter() - started
+
+    async def fetch(self, query, *args):
+        return await self.query('fetch', query, *args)
+
+    async def fetchval(self, query, *args):
+        return await self.query('fetchval', query, *args)
+
+    async def blocking(self, function, *args):
+        # the response cache backend may wait on the network
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, function, *args)
+
+    async def read_versions(self, names):
+        # like models.read_versions, None while some counter doesn't exist
+        rows = await self.fetch('SELECT name, version, updated_at '
+                                'FROM content_versions '
+                                'WHERE name = ANY($1::text[])', names)
+        versions = {row['name']: (row['version'], row['updated_at'])
+                    for row in rows}
+        return versions if len(versions) == len(set(names)) else None
+
+    def encode(self, data):
+        request = current_request.get()
+        if request is None or request.timing is None:
+            return dumps(data)
+        started = time.perf_counter()
+        try:
+            return dumps(data)
+        finally:
+            request.timing.serialize += time.perf_counter() - started
+
+    def render(self, result, encoding):
+        response = Response(self.encode(result), mimetype='application/json')
+        if self.compressor is not None:
+            self.compressor.apply(response, encoding)
+        return response
+
+    async def respond(self, request, handler, names, optional_names):
+        # the result of handler as the conditional Flask views send it:
+        # ETag and Last-Modified from the content versions names, 304,
+        # response cache and compression. None when Flask has to answer
+        encoding = self.compressor.negotiate(request) \
+            if self.compressor is not None else None
+        if names is None:
+            result = await handler(request)
+            return self.render(result, encoding) \
+                if result is not None else None
+
+        names = [name.format(**request.params) for name in names]
+        names.extend(name for arg, name in sorted(optional_names.items())
+                     if arg in request.args)
+        versions = await self.read_versions(names)
+        if versions is None:
+            return None
+        etag = compute_etag(names, versions, encoding, request)
+        last_modified = max(updated_at for _, updated_at in versions.values())
+        if not_modified(etag, last_modified, request):
+            response = Response(status=304)
+        else:
+            response = None
+            if self.response_cache is not None:
+                response = await self.blocking(self.response_cache.cached,
+                                               etag)
+            if response is None:
+                result = await handler(request)
+                if result is None:
+                    return None
+                response = self.render(result, encoding)
+                if self.response_cache is not None:
+                    await self.blocking(self.response_cache.store, etag,
+                                        response)
+        if self.compressor is not None:
+            self.compressor.apply(response, encoding)
+        return set_cache_headers(response, etag, last_modified, self.max_age)
+
+    # native handlers, they return the same JSON as the Flask views
+
+    async def format_questions(self, request, rows):
+        # ?stats=true adds the answer statistics of the questions, one query
+        if request.args.get('stats', '').lower() not in ('1', 'true', 'yes'):
+            return [format_question(row) for row in rows]
+        stats = {row['id']: QuestionStats.format_counts(0, 0)
+                 for row in rows}
+        if len(stats) > 0:
+            for counts in await self.fetch(
+                    'SELECT question_id, plays, correct FROM question_stats '
+                    'WHERE question_id = ANY($1::int[])', list(stats)):
+                stats[counts['question_id']] = QuestionStats.format_counts(
+                    counts['plays'], counts['correct'])
+        return [format_question(row, stats[row['id']]) for row in rows]
+
+    async def all_categories(self):
+        rows = await self.fetch('SELECT id, type FROM categories '
+                                'ORDER BY id')
+        return {row['id']: row['type'] for row in rows}
+
+    async def categories(self, request):
+        categories = await self.all_categories()
+        if len(categories) == 0:
+            raise HTTPError(404)
+        return {
+            'success': True,
+            'categories': categories
+        }
+
+    async def questions_after(self, request, category_id=None):
+        after = request.arg('after', 0)
+        limit = request.arg('limit', QUESTIONS_PER_PAGE)
+        if limit < 1:
+            raise HTTPError(400)
+        limit = min(limit, MAX_QUESTIONS_PER_PAGE)
+
+        if category_id is None:
+            rows = await self.fetch(
+                'SELECT {} FROM questions WHERE id > $1 ORDER BY id '
+                'LIMIT $2'.format(QUESTION_COLUMNS), after, limit + 1)
+        else:
+            rows = await self.fetch(
+                'SELECT {} FROM questions WHERE category = $1 AND id > $2 '
+                'ORDER BY id LIMIT $3'.format(QUESTION_COLUMNS),
+                category_id, after, limit + 1)
+        questions = await self.format_questions(request, rows[:limit])
+        next_cursor = questions[-1]['id'] if len(rows) > limit else None
+        return questions, next_cursor
+
+    async def questions(self, request):
+        cursor_mode = 'after' in request.args
+        if cursor_mode:
+            questions, next_cursor = await self.questions_after(request)
+        else:
+            page_num = request.arg('page', 1)
+            rows = [] if page_num < 1 else await self.fetch(
+                'SELECT {} FROM questions ORDER BY id LIMIT $1 OFFSET $2'.
+                format(QUESTION_COLUMNS), QUESTIONS_PER_PAGE,
+                (page_num - 1) * QUESTIONS_PER_PAGE)
+            questions = await self.format_questions(request, rows)
+        if len(questions) == 0:
+            raise HTTPError(404)
+
+        result = {
+            'success': True,
+            'questions': questions,
+            'total_questions': await self.fetchval(
+                'SELECT count(*) FROM questions'),
+            'categories': await self.all_categories(),
+            'current_category': [question['category']
+                                 for question in questions]
+        }
+        if cursor_mode:
+            result['next_cursor'] = next_cursor
+        return result
+
+    async def category_questions(self, request):
+        # streamed responses are left to the Flask view
+        if 'stream' in request.args:
+            return None
+
+        category_id = int(request.params['category_id'])
+        if 'after' in request.args:
+            questions, next_cursor = await self.questions_after(
+                request, category_id)
+            if len(questions) == 0:
+                raise HTTPError(404)
+            return {
+                'success': True,
+                'questions': questions,
+                'total_questions': await self.fetchval(
+                    'SELECT count(*) FROM questions WHERE category = $1',
+                    category_id),
+                'current_category': category_id,
+                'next_cursor': next_cursor
+            }
+
+        rows = await self.fetch(
+            'SELECT {} FROM questions WHERE category = $1'.
+            format(QUESTION_COLUMNS), category_id)
+        if len(rows) == 0:
+            raise HTTPError(404)
+        return {
+            'success': True,
+            'questions': await self.format_questions(request, rows),
+            'total_questions': len(rows),
+            'current_category': category_id
+        }
+
+    async def pool_ids(self, category_id):
+        # shares the id pools, their version checks and their updates on
+        # write with the Flask app
+        ids = question_pool.cached(category_id)
+        if ids is not None:
+            return ids
+        rows = await self.fetch('SELECT version FROM content_versions '
+                                'WHERE name = $1', pool_version(category_id))
+        version = rows[0]['version'] if len(rows) > 0 else None
+        ids = question_pool.revalidate(category_id, version)
+        if ids is None:
+            if category_id == ALL_CATEGORIES:
+                rows = await self.fetch('SELECT id FROM questions')
+            else:
+                rows = await self.fetch('SELECT id FROM questions '
+                                        'WHERE category = $1', category_id)
+            ids = question_pool.store(category_id,
+                                      [row['id'] for row in rows], version)
+        return ids
+
+    async def quiz_question(self, request):
+        data = request.get_json()
+        if not isinstance(data, dict):
+            raise HTTPError(400)
+        category = data.get('quiz_category')
+        previous_questions = data.get('previous_questions')
+        if (category is None) or (previous_questions is None):
+            raise HTTPError(400)
+
+        try:
+            category_id = category_key(category['id'])
+            previous_questions = set(previous_questions)
+        except (TypeError, ValueError, KeyError):
+            raise HTTPError(422)
+
+        while True:
+            question_id = pick_unseen(await self.pool_ids(category_id),
+                                      previous_questions)
+            if question_id is None:
+                return {'success': True, 'question': None}
+            rows = await self.fetch('SELECT {} FROM questions WHERE id = $1'.
+                                    format(QUESTION_COLUMNS), question_id)
+            if len(rows) > 0:
+                return {'success': True, 'question': format_question(rows[0])}
+
+            # deleted by another process, reload the pool and try again
+            question_pool.invalidate(category_id)
+            previous_questions.add(question_id)
+
+    # everything else runs in the Flask app on a worker thread
+
+    def wsgi_environ(self, scope, body):
+        server = scope.get('server') or ('localhost', 80)
+        client = scope.get('client') or ('', 0)
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': scope.get('root_path', ''),
+            'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+            'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+            'SERVER_NAME': server[0],
+            'SERVER_PORT': str(server[1]),
+            'SERVER_PROTOCOL': 'HTTP/' + scope.get('http_version', '1.1'),
+            'REMOTE_ADDR': client[0],
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': io.BytesIO(body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': True,
+            'wsgi.run_once': False,
+            'CONTENT_LENGTH': str(len(body))
+        }
+        for name, value in scope.get('headers', []):
+            name = name.decode('latin-1').upper().replace('-', '_')
+            value = value.decode('latin-1')
+            if name == 'CONTENT_TYPE':
+                environ['CONTENT_TYPE'] = value
+            elif name != 'CONTENT_LENGTH':
+                key = 'HTTP_' + name
+                environ[key] = environ[key] + ',' + value \
+                    if key in environ else value
+        return environ
+
+    def run_wsgi(self, environ, put):
+        # the whole call, iteration included, stays on one thread so Flask
+        # context locals work in streamed responses
+        def start_response(status, headers, exc_info=None):
+            put(('start', int(status.split(' ', 1)[0]), headers))
+
+        try:
+            iterable = self.wsgi_app(environ, start_response)
+            try:
+                for chunk in iterable:
+                    if chunk:
+                        put(('body', chunk))
+            finally:
+                if hasattr(iterable, 'close'):
+                    iterable.close()
+        except ClientDisconnected:
+            pass
+        except Exception as error:
+            # raised when Flask propagates errors, or while streaming
+            self.wsgi_app.logger.exception(
+                'Exception on %s [%s]', environ['PATH_INFO'],
+                environ['REQUEST_METHOD'])
+            put(('error', error))
+        finally:
+            put(('end',))
+
+    async def call_wsgi(self, scope, body, receive, send):
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+        room = threading.Semaphore(WSGI_QUEUE_SIZE)
+        gone = threading.Event()
+
+        def put(item):
+            # blocks the worker thread while the client is slow to read, and
+            # stops the response once it is gone or read nothing for a while
+            if item[0] == 'body' and \
+                    not room.acquire(timeout=self.send_timeout):
+                gone.set()
+            if gone.is_set() and item[0] in ('start', 'body'):
+                raise ClientDisconnected()
+            loop.call_soon_threadsafe(queue.put_nowait, item)
+
+        async def watch():
+            # the body was read, the next message is the disconnect
+            while (await receive())['type'] != 'http.disconnect':
+                pass
+            gone.set()
+            room.release()
+
+        watcher = asyncio.ensure_future(watch())
+        environ = self.wsgi_environ(scope, body)
+        task = loop.run_in_executor(self.executor, self.run_wsgi, environ,
+                                    put)
+        started = ended = False
+        try:
+            while True:
+                item = await queue.get()
+                if item[0] == 'end':
+                    ended = True
+                    break
+                if gone.is_set():
+                    continue
+                if item[0] == 'start':
+                    started = True
+                    await send({
+                        'type': 'http.response.start',
+                        'status': item[1],
+                        'headers': [(name.lower().encode('latin-1'),
+                                     value.encode('latin-1'))
+                                    for name, value in item[2]]
+                    })
+                elif item[0] == 'body':
+                    await send({'type': 'http.response.body',
+                                'body': item[1], 'more_body': True})
+                    room.release()
+                elif not started:
+                    ended = True
+                    await task
+                    return await self.send_response(
+                        send, environ, self.error_response(500))
+        finally:
+            watcher.cancel()
+            # cancelled by the server, the worker stops at its next chunk
+            if not ended:
+                gone.set()
+                room.release()
+        await task
+        if not gone.is_set():
+            await send({'type': 'http.response.body', 'body': b''})
+
+
+def create_asgi_app(test_config=None, wsgi_app=None):
+    wsgi_app = wsgi_app or create_app(test_config)
+    dsn = asyncpg_dsn(wsgi_app.config['SQLALCHEMY_DATABASE_URI'])
+    pool_size = read_setting(wsgi_app, 'DB_POOL_SIZE', int, 5)
+    pool_options = {
+        'min_size': 1,
+        'max_size': pool_size +
+        read_setting(wsgi_app, 'DB_MAX_OVERFLOW', int, 10),
+        'max_inactive_connection_lifetime':
+        read_setting(wsgi_app, 'DB_POOL_RECYCLE', int, 30 * 60)
+    }
+    return AsgiApp(wsgi_app, dsn, pool_options)
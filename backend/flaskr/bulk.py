@@ -0,0 +1,376 @@
+import csv
+import io
+import itertools
+import json
+
+from sqlalchemy import select
+
+from .streaming import buffered
+from .search import search_index
+from .quiz import question_pool, category_key
+from models import db, bump_versions, category_version, log_changes, \
+    Category, Question
+
+QUESTION_FIELDS = ['question', 'answer', 'difficulty', 'category']
+
+# rows sent to the database in one multi-row INSERT
+IMPORT_BATCH_SIZE = 500
+
+# rows fetched per round trip while exporting
+EXPORT_BATCH_SIZE = 1000
+
+# keep the import report small even when every row is wrong
+MAX_REPORTED_ERRORS = 1000
+
+FORMATS = ['ndjson', 'csv']
+
+# ids per IN list of the batch delete and update statements
+WRITE_BATCH_SIZE = 500
+
+# items accepted by one batch delete or update request
+MAX_BATCH_ITEMS = 5000
+
+
+def missing_fields(data):
+    return [item for item in QUESTION_FIELDS
+            if item not in data.keys() or data[item] is None or
+            data[item] == '']
+
+
+def question_row(data):
+    # same checks as POST /questions, plus the types of the columns
+    missing = missing_fields(data)
+    if len(missing) > 0:
+        raise ValueError('missing {}'.format(', '.join(missing)))
+    try:
+        row = {
+            'question': str(data['question']),
+            'answer': str(data['answer']),
+            'difficulty': int(data['difficulty']),
+            'category': int(data['category'])
+        }
+    except (TypeError, ValueError):
+        raise ValueError('difficulty and category must be integers')
+    for field in ('question', 'answer'):
+        # bytes that aren't UTF-8 were read as lone surrogates
+        try:
+            row[field].encode('utf-8')
+        except UnicodeEncodeError:
+            raise ValueError('{} is not valid UTF-8'.format(field))
+    return row
+
+
+'''
+read_rows(stream, format)
+    yields (row number, dict or error) for every record of a binary
+    NDJSON or CSV stream without reading the whole stream in memory
+'''
+
+
+def read_rows(stream, format='ndjson'):
+    # invalid UTF-8 fails the rows it is in, not the whole import
+    text = io.TextIOWrapper(stream, encoding='utf-8',
+                            errors='surrogateescape', newline='')
+    if format == 'csv':
+        for number, data in enumerate(csv.DictReader(text), 1):
+            yield number, data
+        return
+
+    number = 0
+    for line in text:
+        if line.strip() == '':
+            continue
+        number += 1
+        try:
+            data = json.loads(line)
+        except ValueError as error:
+            yield number, ValueError('invalid JSON: {}'.format(error))
+            continue
+        if not isinstance(data, dict):
+            data = ValueError('expected a JSON object')
+        yield number, data
+
+
+'''
+import_questions(rows, batch_size)
+    validates and inserts questions batch_size rows per INSERT and
+    commit, and returns a report with the per-row errors. Each batch
+    updates the content versions, quiz pools and search index in its
+    own transaction
+'''
+
+
+def import_questions(rows, batch_size=IMPORT_BATCH_SIZE):
+    report = {'imported': 0, 'failed': 0, 'errors': []}
+
+    def fail(number, error):
+        report['failed'] += 1
+        if len(report['errors']) < MAX_REPORTED_ERRORS:
+            report['errors'].append({'row': number, 'error': str(error)})
+
+    batch = []
+    for number, data in rows:
+        try:
+            if isinstance(data, Exception):
+                raise data
+            batch.append((number, question_row(data)))
+        except ValueError as error:
+            fail(number, error)
+            continue
+        if len(batch) >= batch_size:
+            insert_batch(batch, report, fail)
+            batch = []
+    if len(batch) > 0:
+        insert_batch(batch, report, fail)
+    return report
+
+
+def insert_rows(connection, rows):
+    # one multi-row INSERT, with the same versions, change log and pool
+    # and index updates as inserting the rows one by one, returns the ids
+    table = Question.__table__
+    if connection.dialect.name == 'postgresql':
+        ids = [question_id for question_id, in connection.execute(
+            table.insert().values(rows).returning(table.c.id))]
+    else:
+        # sqlite numbers the rows of one statement one after the other
+        last_id = connection.execute(
+            table.insert().values(rows)).lastrowid
+        ids = range(last_id - len(rows) + 1, last_id + 1)
+
+    categories = {row['category'] for row in rows}
+    bump_versions(connection, ['questions'] + [
+        category_version(category) for category in categories])
+    log_changes(connection, 'questions', 'insert', ids)
+    for question_id, row in zip(ids, rows):
+        question_pool.add(question_id, category_key(row['category']))
+        search_index.add(question_id, row['question'])
+    question_pool.written(connection, [category_key(category)
+                                       for category in categories])
+    search_index.written(connection)
+    return ids
+
+
+def insert_batch(batch, report, fail):
+    try:
+        insert_rows(db.session.connection(), [row for _, row in batch])
+        db.session.commit()
+        report['imported'] += len(batch)
+        return
+    except Exception:
+        db.session.rollback()
+
+    # the batch was rejected, insert its rows one by one to find the bad ones
+    for number, row in batch:
+        try:
+            insert_rows(db.session.connection(), [row])
+            db.session.commit()
+            report['imported'] += 1
+        except Exception as error:
+            db.session.rollback()
+            fail(number, getattr(error, 'orig', error))
+
+
+'''
+export_questions(format)
+    returns an iterator of NDJSON or CSV chunks of the questions ordered
+    by id, fetching batch_size rows at a time from a streaming cursor
+'''
+
+
+def export_questions(format='ndjson', batch_size=EXPORT_BATCH_SIZE):
+    columns = ['id'] + QUESTION_FIELDS
+    selection = db.session.query(*[getattr(Question, column)
+                                   for column in columns]).\
+        order_by(Question.id).yield_per(batch_size)
+
+    if format == 'csv':
+        return buffered(csv_lines(columns, selection))
+    return buffered(json.dumps(dict(zip(columns, row))) + '\n'
+                    for row in selection)
+
+
+def csv_lines(columns, rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in itertools.chain([columns], rows):
+        writer.writerow(row)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+
+def batch_ids(ids):
+    ids = list(ids)
+    for start in range(0, len(ids), WRITE_BATCH_SIZE):
+        yield ids[start:start + WRITE_BATCH_SIZE]
+
+
+def item_id(value):
+    if isinstance(value, bool) or not isinstance(value, int):
+        raise ValueError('id must be an integer')
+    return value
+
+
+def current_categories(connection, ids):
+    # {id: category} of the given questions that exist
+    table = Question.__table__
+    found = {}
+    for chunk in batch_ids(ids):
+        rows = connection.execute(select([table.c.id, table.c.category]).
+                                  where(table.c.id.in_(chunk)))
+        found.update((row.id, row.category) for row in rows)
+    return found
+
+
+'''
+delete_questions(ids)
+    deletes the questions of the given ids in one transaction, with one
+    DELETE per WRITE_BATCH_SIZE ids, and returns a result per id
+'''
+
+
+def delete_questions(ids):
+    results = []
+    wanted = []
+    for value in ids:
+        try:
+            question_id = item_id(value)
+        except ValueError as error:
+            results.append({'id': value, 'success': False,
+                            'error': str(error)})
+            continue
+        results.append({'id': question_id})
+        wanted.append(question_id)
+
+    table = Question.__table__
+    connection = db.session.connection()
+    found = current_categories(connection, set(wanted))
+    for chunk in batch_ids(found):
+        connection.execute(table.delete().where(table.c.id.in_(chunk)))
+
+    # the same versions and pool updates as deleting them one by one
+    categories = set(found.values())
+    if len(found) > 0:
+        bump_versions(connection, ['questions'] + [
+            category_version(category) for category in categories])
+        log_changes(connection, 'questions', 'delete', sorted(found))
+        for question_id, category in found.items():
+            question_pool.remove(question_id, category_key(category))
+        question_pool.written(connection, [category_key(category)
+                                           for category in categories])
+        for question_id in found:
+            search_index.remove(question_id)
+        search_index.written(connection)
+    db.session.commit()
+
+    deleted = set()
+    for result in results:
+        if 'success' in result:
+            continue
+        question_id = result['id']
+        if question_id in deleted:
+            result.update(success=False, error='duplicate id')
+        elif question_id not in found:
+            result.update(success=False, error='not found')
+        else:
+            result['success'] = True
+            deleted.add(question_id)
+    return results, len(deleted)
+
+
+def patch_fields(patch, categories):
+    # the columns a patch sets, checked like POST /questions does
+    fields = {}
+    for name in QUESTION_FIELDS:
+        if name not in patch:
+            continue
+        value = patch[name]
+        if name in ('question', 'answer'):
+            if not isinstance(value, str) or value == '':
+                raise ValueError('{} must be a non-empty string'.format(name))
+        else:
+            try:
+                value = int(value)
+            except (TypeError, ValueError):
+                raise ValueError('difficulty and category must be integers')
+        if name == 'category' and value not in categories:
+            raise ValueError('unknown category {}'.format(value))
+        fields[name] = value
+    if len(fields) == 0:
+        raise ValueError('nothing to update')
+    return fields
+
+
+'''
+update_questions(patches)
+    applies patches {'id': ..., 'question'/'answer'/'difficulty'/'category':
+    ...} in one transaction. Patches setting the same values share one
+    UPDATE per WRITE_BATCH_SIZE ids, e.g. moving hundreds of questions to
+    a category is a single statement. Returns a result per patch
+'''
+
+
+def update_questions(patches):
+    categories = {category_id for category_id, in
+                  db.session.query(Category.id)}
+    results = []
+    accepted = {}
+    for patch in patches:
+        result = {'id': patch.get('id') if isinstance(patch, dict)
+                  else None}
+        results.append(result)
+        try:
+            if not isinstance(patch, dict):
+                raise ValueError('expected a JSON object')
+            question_id = item_id(patch.get('id'))
+            if question_id in accepted:
+                raise ValueError('duplicate id')
+            accepted[question_id] = (result, patch_fields(patch, categories))
+        except (TypeError, ValueError) as error:
+            result.update(success=False, error=str(error))
+
+    table = Question.__table__
+    connection = db.session.connection()
+    found = current_categories(connection, accepted)
+    groups = {}
+    for question_id, (result, fields) in accepted.items():
+        if question_id not in found:
+            result.update(success=False, error='not found')
+            continue
+        result['success'] = True
+        groups.setdefault(tuple(sorted(fields.items())), []).\
+            append(question_id)
+    for values, ids in groups.items():
+        for chunk in batch_ids(ids):
+            connection.execute(table.update().where(
+                table.c.id.in_(chunk)).values(dict(values)))
+
+    # the same versions and pool updates as updating them one by one
+    moved = {}
+    for values, ids in groups.items():
+        category = dict(values).get('category')
+        if category is not None:
+            moved.update((question_id, category) for question_id in ids)
+    touched = {category_key(found[question_id]) for ids in groups.values()
+               for question_id in ids} | set(moved.values())
+    if len(groups) > 0:
+        bump_versions(connection, ['questions'] + [
+            category_version(category) for category in touched])
+        log_changes(connection, 'questions', 'update', sorted(
+            question_id for ids in groups.values() for question_id in ids))
+        for question_id, category in moved.items():
+            if category_key(found[question_id]) != category:
+                question_pool.move(question_id,
+                                   category_key(found[question_id]),
+                                   category)
+        question_pool.written(connection, list(touched))
+        for values, ids in groups.items():
+            text = dict(values).get('question')
+            if text is not None:
+                for question_id in ids:
+                    search_index.add(question_id, text)
+        search_index.written(connection)
+    db.session.commit()
+
+    return results, sum(len(ids) for ids in groups.values())
@@ -0,0 +1,388 @@
+import socket
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import urlparse
+
+from flask import json, Response
+from sqlalchemy import event
+from sqlalchemy.orm import object_session, Session
+
+from models import Category
+from .fastjson import Fragment
+
+# categories rarely change, but other processes may still write them
+CATEGORY_CACHE_TTL = 5 * 60
+
+# rendered responses, their keys include the content versions so writes
+# make old entries unreachable and they only age out
+RESPONSE_CACHE_TTL = 5 * 60
+RESPONSE_CACHE_SIZE = 1024
+RESPONSE_CACHE_PREFIX = 'trivia:response:'
+
+# how long a miss waits for another worker rendering the same response
+SINGLE_FLIGHT_TIMEOUT = 5
+SINGLE_FLIGHT_POLL = 0.01
+
+# concurrent misses of keys sharing a stripe wait for each other
+LOCK_STRIPES = 64
+
+
+'''
+CategoryCache
+    keeps the {id: type} map of categories in memory so the routes that
+    return it don't query the database, it is cleared whenever a category
+    is written and again when the write commits or rolls back. Callers
+    that key their response on the 'categories' version pass it, so the
+    map is reloaded once another process wrote categories, others get it
+    reloaded after ttl seconds
+'''
+
+
+class CategoryCache:
+
+    def __init__(self, ttl=CATEGORY_CACHE_TTL):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._categories = None
+        self._encoded = None
+        self._version = None
+        self._loaded_at = 0
+        self._lock = threading.Lock()
+
+    def _load(self):
+        # formatting categories as dictionary -> {key(id) : value(type)}
+        return {category.id: category.type
+                for category in Category.query.order_by(Category.id)}
+
+    def get(self, version=None):
+        # version is the 'categories' version the caller read before, the
+        # map is then loaded at that version or a later one
+        with self._lock:
+            categories = self._categories
+            fresh = categories is not None and \
+                time.monotonic() - self._loaded_at <= self.ttl and \
+                (version is None or version == self._version)
+        if fresh:
+            self.hits += 1
+            return categories
+
+        self.misses += 1
+        categories = self._load()
+        with self._lock:
+            # an empty table is not cached so new categories show up at once
+            self._categories = categories if len(categories) > 0 else None
+            self._encoded = None
+            self._version = version
+            self._loaded_at = time.monotonic()
+        return categories
+
+    def fragment(self, categories):
+        # categories as returned by get(), encoded once per load
+        with self._lock:
+            if categories is not self._categories:
+                return Fragment(json.dumps(categories))
+            if self._encoded is None:
+                self._encoded = Fragment(json.dumps(categories))
+            return self._encoded
+
+    def invalidate(self):
+        with self._lock:
+            self._categories = None
+            self._encoded = None
+            self._version = None
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'cached': self._categories is not None,
+            'version': self._version
+        }
+
+
+category_cache = CategoryCache()
+
+
+@event.listens_for(Category, 'after_insert')
+@event.listens_for(Category, 'after_update')
+@event.listens_for(Category, 'after_delete')
+def invalidate_category_cache(mapper, connection, target):
+    category_cache.invalidate()
+    object_session(target).info['categories_written'] = True
+
+
+# other threads may reload the old categories until the write commits
+@event.listens_for(Session, 'after_commit')
+@event.listens_for(Session, 'after_rollback')
+def invalidate_committed_categories(session):
+    if session.info.pop('categories_written', False):
+        category_cache.invalidate()
+
+
+'''
+MemoryCache
+    a bounded LRU of bytes values with a ttl per entry, local to the
+    process. Response cache backends implement get, set, add (set only
+    if missing, used as a lock) and delete
+'''
+
+
+class MemoryCache:
+
+    def __init__(self, max_entries=RESPONSE_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _get(self, key, now):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[1] < now:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry[0]
+
+    def _set(self, key, value, ttl, now):
+        self._entries[key] = (value, now + ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def get(self, key):
+        with self._lock:
+            return self._get(key, time.monotonic())
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._set(key, value, ttl, time.monotonic())
+
+    def add(self, key, value, ttl):
+        now = time.monotonic()
+        with self._lock:
+            if self._get(key, now) is not None:
+                return False
+            self._set(key, value, ttl, now)
+            return True
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+'''
+RedisCache
+    the same interface over the Redis protocol, so every worker shares
+    the entries. It speaks RESP on one socket per thread and fails open:
+    when the server can't be reached, or answers with an error, every
+    lookup is a miss
+'''
+
+
+class RedisCache:
+
+    def __init__(self, url, timeout=1.0):
+        parsed = urlparse(url)
+        self.host = parsed.hostname or 'localhost'
+        self.port = parsed.port or 6379
+        self.database = int(parsed.path.strip('/') or 0)
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            sock = socket.create_connection((self.host, self.port),
+                                            self.timeout)
+            connection = (sock, sock.makefile('rb'))
+            self._local.connection = connection
+            if self.database:
+                self._command('SELECT', self.database)
+        return connection
+
+    def _close(self):
+        connection = getattr(self._local, 'connection', None)
+        self._local.connection = None
+        if connection is not None:
+            connection[1].close()
+            connection[0].close()
+
+    def _read(self, reader):
+        line = reader.readline()
+        if not line:
+            raise ConnectionError('connection closed')
+        kind, data = line[:1], line[1:-2]
+        if kind == b'+':
+            return data.decode('utf-8')
+        if kind == b'-':
+            raise RuntimeError(data.decode('utf-8'))
+        if kind == b':':
+            return int(data)
+        if kind == b'$':
+            length = int(data)
+            if length < 0:
+                return None
+            return reader.read(length + 2)[:-2]
+        if kind == b'*':
+            return [self._read(reader) for _ in range(int(data))]
+        raise ConnectionError('unexpected reply {!r}'.format(line))
+
+    def _command(self, *args):
+        sock, reader = self._connection()
+        parts = [b'*%d\r\n' % len(args)]
+        for arg in args:
+            if not isinstance(arg, bytes):
+                arg = str(arg).encode('utf-8')
+            parts.append(b'$%d\r\n%s\r\n' % (len(arg), arg))
+        try:
+            sock.sendall(b''.join(parts))
+            return self._read(reader)
+        except OSError:
+            self._close()
+            raise
+
+    def get(self, key):
+        try:
+            return self._command('GET', key)
+        except (OSError, RuntimeError):
+            return None
+
+    def set(self, key, value, ttl):
+        try:
+            self._command('SET', key, value, 'PX', int(ttl * 1000))
+        except (OSError, RuntimeError):
+            pass
+
+    def add(self, key, value, ttl):
+        try:
+            return self._command('SET', key, value, 'PX', int(ttl * 1000),
+                                 'NX') is not None
+        except (OSError, RuntimeError):
+            return True
+
+    def delete(self, key):
+        try:
+            self._command('DEL', key)
+        except (OSError, RuntimeError):
+            pass
+
+
+def cache_backend(setting, max_entries=RESPONSE_CACHE_SIZE):
+    if not isinstance(setting, str):
+        return setting
+    if setting == 'memory':
+        return MemoryCache(max_entries)
+    if setting.startswith('redis://'):
+        return RedisCache(setting)
+    raise ValueError('unknown cache backend {!r}'.format(setting))
+
+
+'''
+ResponseCache
+    stores rendered 200 responses in a backend. Concurrent misses of the
+    same key are single-flight: threads of a process wait on a lock, and
+    workers sharing a backend wait for the one holding the key's lock
+'''
+
+
+class ResponseCache:
+
+    def __init__(self, backend, ttl=RESPONSE_CACHE_TTL,
+                 wait_timeout=SINGLE_FLIGHT_TIMEOUT):
+        self.backend = backend
+        self.ttl = ttl
+        self.wait_timeout = wait_timeout
+        self.hits = 0
+        self.misses = 0
+        self.waits = 0
+        self._locks = [threading.Lock() for _ in range(LOCK_STRIPES)]
+
+    @staticmethod
+    def dump(response):
+        # 'mimetype[ content-coding]' on the first line, then the body
+        head = response.mimetype
+        if 'Content-Encoding' in response.headers:
+            head += ' ' + response.headers['Content-Encoding']
+        return head.encode('utf-8') + b'\n' + response.get_data()
+
+    @staticmethod
+    def load(value):
+        head, body = value.split(b'\n', 1)
+        mimetype, _, encoding = head.decode('utf-8').partition(' ')
+        response = Response(body, mimetype=mimetype)
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+        return response
+
+    def _wait(self, key, lock_key):
+        # another worker holds the lock, poll until it stored the response
+        # or let the lock go without storing one, an error page say
+        self.waits += 1
+        deadline = time.monotonic() + self.wait_timeout
+        while time.monotonic() < deadline:
+            time.sleep(SINGLE_FLIGHT_POLL)
+            locked = self.backend.get(lock_key) is not None
+            value = self.backend.get(key)
+            if value is not None or not locked:
+                return value
+        return None
+
+    def _store(self, key, response):
+        if response.status_code == 200 and not response.is_streamed:
+            self.backend.set(key, self.dump(response), self.ttl)
+        return response
+
+    def _render(self, key, render):
+        return self._store(key, render())
+
+    def cached(self, key):
+        # the stored response of key, or None, without waiting for a render
+        value = self.backend.get(RESPONSE_CACHE_PREFIX + key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return self.load(value)
+
+    def store(self, key, response):
+        self._store(RESPONSE_CACHE_PREFIX + key, response)
+
+    def respond(self, key, render):
+        key = RESPONSE_CACHE_PREFIX + key
+        value = self.backend.get(key)
+        if value is not None:
+            self.hits += 1
+            return self.load(value)
+
+        with self._locks[hash(key) % LOCK_STRIPES]:
+            value = self.backend.get(key)
+            if value is not None:
+                self.hits += 1
+                return self.load(value)
+
+            self.misses += 1
+            lock_key = key + ':lock'
+            if self.backend.add(lock_key, b'1', self.wait_timeout):
+                try:
+                    return self._render(key, render)
+                finally:
+                    self.backend.delete(lock_key)
+
+        # polling another worker doesn't hold up the keys of the stripe
+        value = self._wait(key, lock_key)
+        if value is not None:
+            return self.load(value)
+        return self._render(key, render)
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'waits': self.waits
+        }
@@ -0,0 +1,127 @@
+from datetime import datetime, timedelta
+
+from sqlalchemy import func
+
+from .bulk import batch_ids
+from models import db, bump_versions, Change, Category, Question
+
+# log rows read per GET /changes, clients follow 'more' for the rest
+CHANGES_PER_PAGE = 1000
+MAX_CHANGES_PER_PAGE = 10000
+
+# flask prune-changes keeps this many days of the log by default
+CHANGES_RETENTION_DAYS = 30
+
+ENTITIES = ['questions', 'categories']
+
+
+def change_bounds():
+    # (first, last) version still in the log, (None, None) when empty
+    return db.session.query(func.min(Change.version),
+                            func.max(Change.version)).one()
+
+
+def compact(rows):
+    # {entity: {operation: [ids]}}, one final operation per row written:
+    # inserted, updated or deleted since the client's version. Rows both
+    # inserted and deleted in the window are left out altogether
+    operations = {entity: {} for entity in ENTITIES}
+    for _, entity, entity_id, operation in rows:
+        first, _ = operations[entity].get(entity_id, (operation, None))
+        operations[entity][entity_id] = (first, operation)
+
+    result = {entity: {'inserted': [], 'updated': [], 'deleted': []}
+              for entity in ENTITIES}
+    for entity, entities in operations.items():
+        for entity_id, (first, last) in sorted(entities.items()):
+            if last == 'delete':
+                if first != 'insert':
+                    result[entity]['deleted'].append(entity_id)
+            elif first == 'insert':
+                result[entity]['inserted'].append(entity_id)
+            else:
+                result[entity]['updated'].append(entity_id)
+    return result
+
+
+def current_questions(ids):
+    # {id: question} of those still there, deleted ones come in a later page
+    found = {}
+    for chunk in batch_ids(ids):
+        found.update((row.id, Question.format_row(row)) for row in
+                     Question.rows().filter(Question.id.in_(chunk)))
+    return found
+
+
+def current_categories(ids):
+    found = {}
+    for chunk in batch_ids(ids):
+        found.update(db.session.query(Category.id, Category.type).
+                     filter(Category.id.in_(chunk)))
+    return found
+
+
+'''
+read_changes(since, limit)
+    returns the questions and categories written after version since, at
+    most limit log rows of them, in their current state: the version to
+    ask from next, whether there are more, and per entity the rows
+    inserted, the rows updated and the ids deleted. Returns None when the
+    log no longer goes back to since, the client must then fetch it all
+'''
+
+
+def read_changes(since, limit=CHANGES_PER_PAGE):
+    first, last = change_bounds()
+    if since > (last or 0) or \
+            (first is not None and since < first - 1):
+        return None
+
+    rows = db.session.query(Change.version, Change.entity, Change.entity_id,
+                            Change.operation).\
+        filter(Change.version > since).order_by(Change.version).\
+        limit(limit + 1).all()
+    more = len(rows) > limit
+    rows = rows[:limit]
+    changes = compact(rows)
+
+    questions = changes['questions']
+    found = current_questions(questions['inserted'] + questions['updated'])
+    for operation in ('inserted', 'updated'):
+        questions[operation] = [found[question_id] for question_id in
+                                questions[operation] if question_id in found]
+
+    # categories as the {id: type} map of GET /categories
+    categories = changes['categories']
+    found = current_categories(categories['inserted'] +
+                               categories['updated'])
+    for operation in ('inserted', 'updated'):
+        categories[operation] = {
+            category_id: found[category_id]
+            for category_id in categories[operation]
+            if category_id in found}
+
+    return {
+        'since': since,
+        'version': rows[-1].version if len(rows) > 0 else since,
+        'more': more,
+        'questions': questions,
+        'categories': categories
+    }
+
+
+def prune_changes(days=CHANGES_RETENTION_DAYS):
+    # deletes the log older than days, but always keeps the last row so
+    # clients further behind can be told to fetch everything again
+    _, last = change_bounds()
+    if last is None:
+        return 0
+    before = datetime.utcnow() - timedelta(days=days)
+    deleted = Change.query.filter(Change.created_at < before,
+                                  Change.version < last).\
+        delete(synchronize_session=False)
+    if deleted > 0:
+        # cached feed pages from before the prune must not be served
+        bump_versions(db.session.connection(), ['changes'])
+    db.session.commit()
+    return deleted
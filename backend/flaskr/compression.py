@@ -0,0 +1,64 @@
+import gzip
+
+from flask import request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# smaller bodies gain too little to be worth the CPU and the header
+COMPRESS_MIN_SIZE = 1024
+
+# mid levels: most of the size gain for a fraction of the CPU of the
+# highest ones, the same body is usually cached compressed anyway
+COMPRESS_LEVEL = 5
+BROTLI_LEVEL = 4
+
+COMPRESSIBLE_MIMETYPES = ['application/json', 'application/x-ndjson',
+                          'text/csv', 'text/plain', 'text/html']
+
+
+'''
+Compressor(min_size, level, brotli_level)
+    negotiates br (when the brotli package is installed) or gzip from
+    Accept-Encoding and compresses the body of buffered responses of at
+    least min_size bytes
+'''
+
+
+class Compressor:
+
+    def __init__(self, min_size=COMPRESS_MIN_SIZE, level=COMPRESS_LEVEL,
+                 brotli_level=BROTLI_LEVEL):
+        self.min_size = min_size
+        self.level = level
+        self.brotli_level = brotli_level
+        self.encodings = ['br', 'gzip'] if brotli is not None else ['gzip']
+
+    def negotiate(self, request=request):
+        return request.accept_encodings.best_match(self.encodings)
+
+    def compress(self, data, encoding):
+        if encoding == 'br':
+            return brotli.compress(data, quality=self.brotli_level)
+        return gzip.compress(data, self.level)
+
+    def compressible(self, response):
+        return response.status_code == 200 and \
+            not response.direct_passthrough and \
+            not response.is_streamed and \
+            'Content-Encoding' not in response.headers and \
+            response.mimetype in COMPRESSIBLE_MIMETYPES
+
+    def apply(self, response, encoding):
+        # the body depends on Accept-Encoding, even when it is sent as is
+        response.vary.add('Accept-Encoding')
+        if encoding is None or not self.compressible(response):
+            return response
+        data = response.get_data()
+        if len(data) < self.min_size:
+            return response
+        response.set_data(self.compress(data, encoding))
+        response.headers['Content-Encoding'] = encoding
+        return response
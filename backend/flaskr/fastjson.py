@@ -0,0 +1,122 @@
+import uuid
+
+from flask.json import JSONEncoder
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+# in order of preference for JSON_BACKEND = 'auto'
+JSON_BACKENDS = ['orjson', 'ujson', 'json']
+
+# fragments are encoded as this string, then replaced by their text
+FRAGMENT_MARK = 'json-fragment-{}-'.format(uuid.uuid4().hex)
+
+
+'''
+Fragment(text)
+    already encoded JSON, written as is where the object appears, so a
+    value shared by many responses is only encoded once
+'''
+
+
+class Fragment:
+    __slots__ = ('text',)
+
+    def __init__(self, text):
+        self.text = text
+
+
+def installed(name):
+    return name == 'json' or \
+        {'orjson': orjson, 'ujson': ujson}.get(name) is not None
+
+
+def backend_name(name='auto'):
+    if name == 'auto':
+        return next(backend for backend in JSON_BACKENDS
+                    if installed(backend))
+    if name not in JSON_BACKENDS:
+        raise ValueError('unknown JSON backend {!r}'.format(name))
+    if not installed(name):
+        raise ValueError('JSON backend {!r} is not installed'.format(name))
+    return name
+
+
+def splice(text, fragments):
+    for number, fragment in enumerate(fragments):
+        text = text.replace('"{}{}"'.format(FRAGMENT_MARK, number),
+                            fragment, 1)
+    return text
+
+
+'''
+json_encoder(name, compact)
+    returns a subclass of the app's JSONEncoder that encodes with orjson
+    or ujson, whichever is installed first for 'auto', and falls back to
+    the standard library for values they can't encode, pretty printing
+    and ASCII-only output of non-ASCII text. With compact=True the indent
+    jsonify uses in debug mode is ignored too. Fragment values are spliced
+    in as they are with every backend
+'''
+
+
+def json_encoder(name='auto', compact=True, base=JSONEncoder):
+    name = backend_name(name)
+
+    class FastJSONEncoder(base):
+        backend = name
+
+        def default(self, o):
+            if isinstance(o, Fragment):
+                self.fragments.append(o.text)
+                return '{}{}'.format(FRAGMENT_MARK, len(self.fragments) - 1)
+            return super().default(o)
+
+        def encode(self, o):
+            self.fragments = []
+            text = None
+            if compact or self.indent is None:
+                try:
+                    text = self.fast_encode(o)
+                except (TypeError, OverflowError):
+                    text = None
+            if text is None:
+                self.fragments = []
+                if compact:
+                    self.indent = None
+                    self.item_separator = ','
+                    self.key_separator = ':'
+                text = super().encode(o)
+            return splice(text, self.fragments) if self.fragments else text
+
+        def fast_encode(self, o):
+            if name == 'orjson':
+                option = orjson.OPT_PASSTHROUGH_DATETIME
+                if self.sort_keys:
+                    # orjson sorts int keys as strings, "10" before "2",
+                    # the standard library sorts them as numbers: without
+                    # OPT_NON_STR_KEYS such dicts raise and fall back
+                    option |= orjson.OPT_SORT_KEYS
+                else:
+                    option |= orjson.OPT_NON_STR_KEYS
+                text = orjson.dumps(o, default=self.default,
+                                    option=option).decode('utf-8')
+                # orjson only writes UTF-8, escape through the fallback
+                if self.ensure_ascii and not text.isascii():
+                    return None
+                return text
+            if name == 'ujson':
+                return ujson.dumps(o, ensure_ascii=self.ensure_ascii,
+                                   sort_keys=self.sort_keys,
+                                   escape_forward_slashes=False,
+                                   default=self.default)
+            return None
+
+    return FastJSONEncoder
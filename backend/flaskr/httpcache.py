@@ -0,0 +1,99 @@
+import hashlib
+from functools import wraps
+
+from flask import current_app, g, request, Response
+
+from models import read_versions
+
+# clients may reuse a response this long before revalidating it
+HTTP_CACHE_MAX_AGE = 0
+
+
+def compute_etag(names, versions, encoding=None, request=request):
+    # the same URL, versions and content coding always render the same body
+    key = [request.path]
+    key.extend('{}={}'.format(name, value)
+               for name, value in sorted(request.args.items(multi=True)))
+    key.extend('{}@{}'.format(name, versions[name][0]) for name in names)
+    if encoding is not None:
+        key.append('encoding=' + encoding)
+    return hashlib.sha1('|'.join(key).encode('utf-8')).hexdigest()
+
+
+def set_cache_headers(response, etag, last_modified, max_age=None):
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.cache_control.public = True
+    response.cache_control.max_age = max_age if max_age is not None else \
+        current_app.config.get('HTTP_CACHE_MAX_AGE', HTTP_CACHE_MAX_AGE)
+    response.cache_control.must_revalidate = True
+    return response
+
+
+def not_modified(etag, last_modified, request=request):
+    if request.if_none_match:
+        return request.if_none_match.contains(etag)
+    if request.if_modified_since is not None:
+        return last_modified.replace(microsecond=0) <= \
+            request.if_modified_since.replace(tzinfo=None)
+    return False
+
+
+def content_version(name):
+    # the version of name read by conditional() for the current request,
+    # cached parts of the body must be at least that recent
+    return g.content_versions[name][0]
+
+
+'''
+conditional(*names, **optional_names)
+    decorates a GET view whose body only depends on its URL and on the
+    given content versions. Names are formatted with the view arguments,
+    e.g. 'category:{category_id}'. Keyword arguments name the versions of
+    optional parts of the body, read when their query argument is given,
+    e.g. stats='question_stats' for ?stats=true. The ETag and
+    Last-Modified of the response come from the versions, so a matching
+    If-None-Match or If-Modified-Since is answered with 304 before the
+    view runs, and other requests are served from the response cache
+    when it is on. Bodies are compressed before they are cached, so every
+    content coding gets its own ETag and cache entry. The view reads the
+    versions its response is keyed on with content_version(name)
+'''
+
+
+def conditional(*names, **optional_names):
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            version_names = [name.format(**kwargs) for name in names]
+            version_names.extend(name for arg, name in
+                                 sorted(optional_names.items())
+                                 if arg in request.args)
+            versions = read_versions(version_names)
+            g.content_versions = versions
+            compressor = current_app.extensions.get('compression')
+            encoding = compressor.negotiate() if compressor else None
+            etag = compute_etag(version_names, versions, encoding)
+            last_modified = max(updated_at
+                                for _, updated_at in versions.values())
+            if not_modified(etag, last_modified):
+                return set_cache_headers(Response(status=304), etag,
+                                         last_modified)
+
+            def render():
+                response = current_app.make_response(view(*args, **kwargs))
+                if compressor is not None:
+                    compressor.apply(response, encoding)
+                return response
+
+            # the ETag identifies the body, so it keys the response cache
+            response_cache = current_app.extensions.get('response_cache')
+            if response_cache is not None:
+                response = response_cache.respond(etag, render)
+            else:
+                response = render()
+            if response.status_code == 200:
+                set_cache_headers(response, etag, last_modified)
+            return response
+        return wrapper
+    return decorator
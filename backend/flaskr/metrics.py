@@ -0,0 +1,227 @@
+import bisect
+import threading
+import time
+
+from flask import g, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from models import on_rows_loaded
+
+# upper bounds of the histogram buckets, in seconds and in queries
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                    0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+# Server-Timing metric names and descriptions, in header order
+PHASES = [
+    ('db', 'SQL statements'),
+    ('orm', 'row fetching and loading'),
+    ('serialize', 'JSON encoding'),
+]
+
+# the timing of the request being handled by this thread, if any
+current = threading.local()
+
+
+class RequestTiming:
+    __slots__ = ('started', 'queries', 'db', 'orm', 'serialize', 'status')
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.db = 0.0
+        self.orm = 0.0
+        self.serialize = 0.0
+        self.status = 500
+
+
+def active_timing():
+    return getattr(current, 'timing', None)
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    if active_timing() is not None:
+        conn.info.setdefault('query_started', []).append(
+            time.perf_counter())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context,
+                         executemany):
+    timing = active_timing()
+    started = conn.info.get('query_started')
+    if timing is not None and started:
+        timing.queries += 1
+        timing.db += time.perf_counter() - started.pop()
+
+
+def rows_loaded(seconds):
+    timing = active_timing()
+    if timing is not None:
+        timing.orm += seconds
+
+
+def listen():
+    # once per process, for every engine, and idle outside of requests
+    if not event.contains(Engine, 'before_cursor_execute',
+                          before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', after_cursor_execute)
+        on_rows_loaded(rows_loaded)
+
+
+'''
+Histogram(name, help, buckets, labels)
+    a Prometheus histogram with one series of cumulative bucket counts,
+    sum and count per combination of label values
+'''
+
+
+class Histogram:
+
+    def __init__(self, name, help, buckets, labels):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.labels = labels
+        self.series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, values, amount):
+        index = bisect.bisect_left(self.buckets, amount)
+        with self._lock:
+            series = self.series.get(values)
+            if series is None:
+                series = self.series[values] = \
+                    [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += amount
+            series[2] += 1
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help),
+                 '# TYPE {} histogram'.format(self.name)]
+        with self._lock:
+            series = sorted((values, list(counts), total, count)
+                            for values, (counts, total, count)
+                            in self.series.items())
+        for values, counts, total, count in series:
+            labels = ','.join('{}="{}"'.format(name, value)
+                              for name, value in zip(self.labels, values))
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ('+Inf',),
+                                           counts):
+                cumulative += bucket_count
+                lines.append('{}_bucket{{{},le="{}"}} {}'.format(
+                    self.name, labels, bound, cumulative))
+            lines.append('{}_sum{{{}}} {}'.format(self.name, labels, total))
+            lines.append('{}_count{{{}}} {}'.format(self.name, labels,
+                                                    count))
+        return lines
+
+
+'''
+RequestMetrics
+    the histograms of the request duration, SQL query count, DB time, ORM
+    time and JSON encoding time per route, method and status
+'''
+
+
+class RequestMetrics:
+    LABELS = ('route', 'method', 'status')
+
+    def __init__(self):
+        self.histograms = {
+            'total': Histogram('trivia_request_duration_seconds',
+                               'Time spent handling requests.',
+                               DURATION_BUCKETS, self.LABELS),
+            'queries': Histogram('trivia_request_db_queries',
+                                 'SQL statements run per request.',
+                                 QUERY_BUCKETS, self.LABELS),
+            'db': Histogram('trivia_request_db_seconds',
+                            'Time spent running SQL statements.',
+                            DURATION_BUCKETS, self.LABELS),
+            'orm': Histogram('trivia_request_orm_seconds',
+                             'Time spent fetching rows and loading them.',
+                             DURATION_BUCKETS, self.LABELS),
+            'serialize': Histogram('trivia_request_serialize_seconds',
+                                   'Time spent encoding JSON.',
+                                   DURATION_BUCKETS, self.LABELS),
+        }
+
+    def record(self, values, timing, total):
+        self.histograms['total'].observe(values, total)
+        self.histograms['queries'].observe(values, timing.queries)
+        for phase, _ in PHASES:
+            self.histograms[phase].observe(values, getattr(timing, phase))
+
+    def render(self):
+        lines = []
+        for histogram in self.histograms.values():
+            lines.extend(histogram.render())
+        return '\n'.join(lines) + '\n'
+
+
+def server_timing(timing):
+    entries = ['{};desc="{}";dur={:.3f}'.format(
+        phase, description if phase != 'db' else
+        '{} {}'.format(timing.queries, description),
+        getattr(timing, phase) * 1000) for phase, description in PHASES]
+    entries.append('total;dur={:.3f}'.format(
+        (time.perf_counter() - timing.started) * 1000))
+    return ', '.join(entries)
+
+
+def timed_encoder(encoder):
+    class TimedJSONEncoder(encoder):
+        def encode(self, o):
+            timing = active_timing()
+            if timing is None:
+                return super().encode(o)
+            started = time.perf_counter()
+            try:
+                return super().encode(o)
+            finally:
+                timing.serialize += time.perf_counter() - started
+    return TimedJSONEncoder
+
+
+'''
+instrument(app)
+    times every request of the app: SQL statements and their duration,
+    row loading and JSON encoding. The timings are sent in a Server-Timing
+    header and recorded, once the response is sent, in the histograms of
+    the returned RequestMetrics
+'''
+
+
+def instrument(app):
+    metrics = RequestMetrics()
+    listen()
+    app.json_encoder = timed_encoder(app.json_encoder)
+
+    @app.before_request
+    def start_timing():
+        current.timing = g.request_timing = RequestTiming()
+
+    @app.after_request
+    def add_server_timing(response):
+        timing = g.get('request_timing')
+        if timing is not None:
+            timing.status = response.status_code
+            response.headers['Server-Timing'] = server_timing(timing)
+        return response
+
+    # runs after streamed bodies are written too
+    @app.teardown_request
+    def record_timing(exc):
+        timing = g.get('request_timing')
+        current.timing = None
+        if timing is None:
+            return
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        metrics.record((route, request.method, str(timing.status)), timing,
+                       time.perf_counter() - timing.started)
+
+    return metrics
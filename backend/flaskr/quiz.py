@@ -0,0 +1,343 @@
+import random
+import threading
+import time
+import uuid
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+
+from sqlalchemy import event, inspect, select
+
+from models import db, on_bulk_write, read_versions, category_version, \
+    ContentVersion, Question
+
+# id 0 is used by the frontend for "All" categories
+ALL_CATEGORIES = 0
+
+# how many random draws to try before scanning the pool for unseen ids
+MAX_PROBES = 16
+
+# pools are checked against the content versions at most this often, to
+# pick up writes of other processes, writes of this one update them at once
+POOL_CHECK_INTERVAL = 1
+
+# question ids are 32 bit integers, 4 bytes each in the pools
+ID_TYPECODE = 'i'
+
+# defaults for the in-memory quiz session store
+MAX_QUIZ_SESSIONS = 10000
+QUIZ_SESSION_TTL = 60 * 60
+
+
+def category_key(category_id):
+    return int(category_id) if category_id is not None else None
+
+
+def pool_version(category_id):
+    # the content version counting the writes to a pool
+    if category_id == ALL_CATEGORIES:
+        return 'questions'
+    return category_version(category_id)
+
+
+def pick_unseen(ids, previous_questions):
+    excluded = set(previous_questions)
+
+    # random probing finds an unseen id quickly while most are unseen
+    if len(excluded) < len(ids):
+        for _ in range(MAX_PROBES):
+            question_id = random.choice(ids)
+            if question_id not in excluded:
+                return question_id
+
+    # fall back to scanning the ids once the pool is nearly exhausted
+    remaining = [question_id for question_id in ids
+                 if question_id not in excluded]
+    return random.choice(remaining) if len(remaining) > 0 else None
+
+
+class PoolEntry:
+    __slots__ = ('ids', 'version', 'checked_at')
+
+    def __init__(self, ids, version):
+        self.ids = ids
+        self.version = version
+        self.checked_at = time.monotonic()
+
+
+'''
+QuestionPool
+    keeps the sorted question ids of every category, and of all of them,
+    in typed arrays built on first use, so a quiz turn picks a random
+    unseen question and only loads that row. Writes of this process add
+    and remove ids as they happen, a pool is reloaded when its content
+    version shows another process wrote to it
+'''
+
+
+class QuestionPool:
+
+    def __init__(self, check_interval=POOL_CHECK_INTERVAL):
+        self.check_interval = check_interval
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def _load(self, category_id):
+        query = db.session.query(Question.id)
+        if category_id != ALL_CATEGORIES:
+            query = query.filter(Question.category == category_id)
+        return [row.id for row in query.order_by(Question.id)]
+
+    def cached(self, category_id):
+        # the ids if they were checked recently enough, else None
+        entry = self._entries.get(category_id)
+        if entry is None or \
+                time.monotonic() - entry.checked_at > self.check_interval:
+            return None
+        return entry.ids
+
+    def revalidate(self, category_id, version):
+        # the ids if the pool is still at the given version, else None
+        entry = self._entries.get(category_id)
+        if entry is None or entry.version != version:
+            return None
+        entry.checked_at = time.monotonic()
+        return entry.ids
+
+    def store(self, category_id, ids, version=None):
+        ids = array(ID_TYPECODE, sorted(ids))
+        with self._lock:
+            self._entries[category_id] = PoolEntry(ids, version)
+        return ids
+
+    def ids(self, category_id):
+        ids = self.cached(category_id)
+        if ids is not None:
+            return ids
+        # the version is read first, a write made while the ids are
+        # loaded then shows up as a new version at the next check
+        name = pool_version(category_id)
+        version = read_versions([name])[name][0]
+        ids = self.revalidate(category_id, version)
+        if ids is None:
+            ids = self.store(category_id, self._load(category_id), version)
+        return ids
+
+    def invalidate(self, category_id=None):
+        with self._lock:
+            if category_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(category_id, None)
+                self._entries.pop(ALL_CATEGORIES, None)
+
+    def _insert(self, key, question_id):
+        entry = self._entries.get(key)
+        if entry is None:
+            return
+        ids = entry.ids
+        # new ids are usually the largest ones
+        if len(ids) == 0 or question_id > ids[-1]:
+            ids.append(question_id)
+            return
+        position = bisect_left(ids, question_id)
+        if position == len(ids) or ids[position] != question_id:
+            ids.insert(position, question_id)
+
+    def _discard(self, key, question_id):
+        entry = self._entries.get(key)
+        if entry is None:
+            return
+        position = bisect_left(entry.ids, question_id)
+        if position < len(entry.ids) and entry.ids[position] == question_id:
+            del entry.ids[position]
+
+    def add(self, question_id, category_id):
+        with self._lock:
+            self._insert(ALL_CATEGORIES, question_id)
+            self._insert(category_id, question_id)
+
+    def remove(self, question_id, category_id):
+        with self._lock:
+            self._discard(ALL_CATEGORIES, question_id)
+            self._discard(category_id, question_id)
+
+    def move(self, question_id, old_category_id, category_id):
+        with self._lock:
+            self._discard(old_category_id, question_id)
+            self._insert(category_id, question_id)
+
+    def written(self, connection, category_ids):
+        # after a write of this process, in its transaction: the pools it
+        # touched stay current if their version moved by exactly one,
+        # else another process wrote too and they are checked again
+        keys = {pool_version(key): key for key in
+                [ALL_CATEGORIES] + list(category_ids)
+                if key in self._entries}
+        if len(keys) == 0:
+            return
+        table = ContentVersion.__table__
+        rows = connection.execute(select([table.c.name, table.c.version]).
+                                  where(table.c.name.in_(list(keys))))
+        with self._lock:
+            for name, version in rows:
+                entry = self._entries.get(keys[name])
+                if entry is None:
+                    continue
+                if entry.version is not None and \
+                        version == entry.version + 1:
+                    entry.version = version
+                else:
+                    entry.version = None
+                    entry.checked_at = float('-inf')
+
+    def pick_id(self, category_id, previous_questions):
+        return pick_unseen(self.ids(category_id), previous_questions)
+
+    def pick(self, category_id, previous_questions):
+        category_id = category_key(category_id)
+        previous_questions = set(previous_questions)
+        while True:
+            question_id = self.pick_id(category_id, previous_questions)
+            if question_id is None:
+                return None
+            question = Question.rows().filter(Question.id == question_id).\
+                first()
+            if question is not None:
+                return question
+
+            # deleted by another process, reload the pool and try again
+            self.invalidate(category_id)
+            previous_questions.add(question_id)
+
+
+question_pool = QuestionPool()
+
+
+'''
+QuizSession
+    a pre-shuffled deck of question ids, each turn pops the next one
+'''
+
+
+class QuizSession:
+
+    def __init__(self, category_id, deck):
+        self.id = uuid.uuid4().hex
+        self.category_id = category_id
+        self.deck = deck
+        self.played = 0
+
+    @classmethod
+    def start(cls, category_id, pool=question_pool):
+        category_id = category_key(category_id)
+        deck = list(pool.ids(category_id))
+        random.shuffle(deck)
+        return cls(category_id, deck)
+
+    def next_question(self):
+        while len(self.deck) > 0:
+            question = Question.rows().\
+                filter(Question.id == self.deck.pop()).first()
+            # skip questions deleted since the deck was shuffled
+            if question is not None:
+                self.played += 1
+                return question
+        return None
+
+
+'''
+MemorySessionStore
+    keeps quiz sessions in process, evicting the least recently used
+    session when full and any session idle for longer than ttl seconds.
+    Any object with get(session_id), add(session), save(session) and
+    remove(session_id) can be passed as the QUIZ_SESSION_STORE config to
+    keep them elsewhere. Sessions are saved after every turn, so stores
+    that serialize them keep the deck they were given last
+'''
+
+
+class MemorySessionStore:
+
+    def __init__(self, max_sessions=MAX_QUIZ_SESSIONS, ttl=QUIZ_SESSION_TTL):
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def _evict(self, now):
+        # sessions are kept in access order so expired ones are at the front
+        while len(self._sessions) > 0:
+            session_id, (session, last_used) = next(iter(
+                self._sessions.items()))
+            if len(self._sessions) <= self.max_sessions and \
+                    now - last_used <= self.ttl:
+                break
+            del self._sessions[session_id]
+
+    def get(self, session_id):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._sessions.get(session_id)
+            if entry is None:
+                return None
+            if now - entry[1] > self.ttl:
+                del self._sessions[session_id]
+                return None
+            self._sessions[session_id] = (entry[0], now)
+            self._sessions.move_to_end(session_id)
+            return entry[0]
+
+    def add(self, session):
+        now = time.monotonic()
+        with self._lock:
+            self._sessions[session.id] = (session, now)
+            self._sessions.move_to_end(session.id)
+            self._evict(now)
+
+    def save(self, session):
+        # the session is the object it keeps, only a removed or evicted
+        # one would need storing and it is not brought back
+        with self._lock:
+            if session.id in self._sessions:
+                self._sessions[session.id] = (session, time.monotonic())
+                self._sessions.move_to_end(session.id)
+
+    def remove(self, session_id):
+        with self._lock:
+            return self._sessions.pop(session_id, None) is not None
+
+
+@event.listens_for(Question, 'after_insert')
+def add_to_question_pools(mapper, connection, target):
+    category_id = category_key(target.category)
+    question_pool.add(target.id, category_id)
+    question_pool.written(connection, [category_id])
+
+
+@event.listens_for(Question, 'after_delete')
+def remove_from_question_pools(mapper, connection, target):
+    category_id = category_key(target.category)
+    question_pool.remove(target.id, category_id)
+    question_pool.written(connection, [category_id])
+
+
+@event.listens_for(Question, 'after_update')
+def move_in_question_pools(mapper, connection, target):
+    # the pools only change when the question moved to another category
+    history = inspect(target).attrs.category.history
+    old_categories = [category_key(category)
+                      for category in history.deleted or ()]
+    category_id = category_key(target.category)
+    for old_category in old_categories:
+        if old_category != category_id:
+            question_pool.move(target.id, old_category, category_id)
+    question_pool.written(connection, old_categories + [category_id])
+
+
+@on_bulk_write
+def reload_question_pools():
+    question_pool.invalidate()
@@ -0,0 +1,347 @@
+import heapq
+import itertools
+import re
+import threading
+import time
+from bisect import bisect_left, insort
+
+from sqlalchemy import event, select
+
+from models import db, on_bulk_write, read_versions, Category, \
+    ContentVersion, Question
+
+# the index is checked against the 'questions' content version at most
+# this often, to pick up writes of other processes, writes of this one
+# update it at once
+SEARCH_INDEX_CHECK_INTERVAL = 1
+
+# suggestions complete the last word once it is this long, and rank at
+# most MAX_SUGGEST_SCAN words of the vocabulary per lookup
+MIN_SUGGEST_PREFIX = 2
+MAX_SUGGEST_SCAN = 1000
+SUGGESTIONS = 5
+MAX_SUGGESTIONS = 20
+
+WORD = re.compile(r'\w+', re.UNICODE)
+
+
+def tokenize(text):
+    return WORD.findall(text.lower()) if text else []
+
+
+'''
+SubstringSearch
+    today's search semantics, any question containing the term, it scans
+    the whole table so it is kept as a fallback mode
+'''
+
+
+class SubstringSearch:
+    name = 'substring'
+
+    def search(self, term, offset=0, limit=None):
+        selection = Question.rows().filter(Question.question.ilike
+                                           ("%{}%".format(term)))
+        total = selection.count()
+        page = selection.order_by(Question.id).offset(offset)
+        if limit is not None:
+            page = page.limit(limit)
+        return page.all(), total
+
+    def iterate(self, term, batch_size):
+        # every match, read from a streaming cursor batch_size rows at a time
+        selection = Question.rows().filter(Question.question.ilike
+                                           ("%{}%".format(term)))
+        return selection.order_by(Question.id).yield_per(batch_size), \
+            selection.count()
+
+
+'''
+InvertedIndexSearch
+    keeps an in-process inverted index {word: set(question ids)} of the
+    question text, updated by Question inserts, updates and deletes.
+    Every word of the term must match a word of the question, the last
+    one as a prefix, results are ranked by the number of exact matches.
+    Searches build it when they need it, suggestions never wait: warm()
+    builds it on a background thread and they are empty until it is ready
+'''
+
+
+class InvertedIndexSearch:
+    name = 'index'
+
+    def __init__(self, check_interval=SEARCH_INDEX_CHECK_INTERVAL):
+        self.check_interval = check_interval
+        self.version = None
+        self._postings = None
+        self._documents = {}
+        self._words = []
+        self._checked_at = float('-inf')
+        self._pending = None
+        self._warmer = None
+        self._lock = threading.RLock()
+        self._build_lock = threading.Lock()
+
+    @property
+    def built(self):
+        return self._postings is not None
+
+    def build(self):
+        # the version is read before the rows, and writes of this process
+        # made while they load are replayed on the new index
+        version = read_versions(['questions'])['questions'][0]
+        with self._lock:
+            self._pending = []
+        rows = db.session.query(Question.id, Question.question).all()
+        with self._lock:
+            # invalidated meanwhile, the next search builds it again
+            if self._pending is None:
+                version = None
+            self._postings = {}
+            self._documents = {}
+            for row in rows:
+                self._add(row.id, row.question, sort=False)
+            for question_id, text in self._pending or ():
+                self._remove(question_id)
+                if text is not None:
+                    self._add(question_id, text, sort=False)
+            self._words = sorted(self._postings)
+            self._pending = None
+            self.version = version
+            self._checked_at = time.monotonic()
+
+    def invalidate(self):
+        with self._lock:
+            self._postings = None
+            self._documents = {}
+            self._words = []
+            self._pending = None
+            self.version = None
+
+    def stale(self):
+        # whether another process wrote questions since the index was built
+        if self.version is None:
+            return True
+        if time.monotonic() - self._checked_at <= self.check_interval:
+            return False
+        version = read_versions(['questions'])['questions'][0]
+        with self._lock:
+            if version != self.version:
+                return True
+            self._checked_at = time.monotonic()
+            return False
+
+    def _ensure_built(self):
+        if self.built and not self.stale():
+            return
+        # one thread rebuilds, the others search the index as it is, or
+        # wait for the first build
+        if not self._build_lock.acquire(blocking=not self.built):
+            return
+        try:
+            if not self.built or self.stale():
+                self.build()
+        finally:
+            self._build_lock.release()
+
+    def warm(self, app):
+        # builds the index on a background thread when it is missing or
+        # stale, one thread at a time. Returns the thread, if any
+        if self.built and not self.stale():
+            return None
+        with self._lock:
+            if self._warmer is None or not self._warmer.is_alive():
+                self._warmer = threading.Thread(target=self._warm,
+                                                args=(app,),
+                                                name='search-index',
+                                                daemon=True)
+                self._warmer.start()
+            return self._warmer
+
+    def _warm(self, app):
+        with app.app_context():
+            try:
+                self._ensure_built()
+            except Exception:
+                # the next suggestion tries again
+                app.logger.exception('Building the search index failed')
+            finally:
+                db.session.remove()
+
+    def written(self, connection):
+        # after a write of this process, in its transaction: the index
+        # stays current if the version moved by exactly one, else another
+        # process wrote too and it is rebuilt at the next search
+        table = ContentVersion.__table__
+        version = connection.execute(select([table.c.version]).where(
+            table.c.name == 'questions')).scalar()
+        with self._lock:
+            if self.version is not None and version == self.version + 1:
+                self.version = version
+            else:
+                self.version = None
+
+    def _add(self, question_id, text, sort=True):
+        # a build sorts the vocabulary once, single writes keep it sorted
+        words = set(tokenize(text))
+        self._documents[question_id] = words
+        for word in words:
+            if word not in self._postings:
+                self._postings[word] = set()
+                if sort:
+                    insort(self._words, word)
+            self._postings[word].add(question_id)
+
+    def _remove(self, question_id):
+        for word in self._documents.pop(question_id, ()):
+            ids = self._postings.get(word)
+            if ids is None:
+                continue
+            ids.discard(question_id)
+            if len(ids) == 0:
+                del self._postings[word]
+                del self._words[bisect_left(self._words, word)]
+
+    def add(self, question_id, text):
+        with self._lock:
+            if self._pending is not None:
+                self._pending.append((question_id, text))
+            if self.built:
+                self._remove(question_id)
+                self._add(question_id, text)
+
+    def remove(self, question_id):
+        with self._lock:
+            if self._pending is not None:
+                self._pending.append((question_id, None))
+            if self.built:
+                self._remove(question_id)
+
+    def words(self):
+        # sorted vocabulary, used to expand prefixes with a binary search
+        return self._words
+
+    def prefixed(self, prefix):
+        words = self.words()
+        start = bisect_left(words, prefix)
+        for word in words[start:]:
+            if not word.startswith(prefix):
+                break
+            yield word
+
+    def suggest(self, term, limit=SUGGESTIONS):
+        # completions of the last word of the term, the words found in the
+        # most questions first, without running any SQL, and none until
+        # the index is built
+        words = tokenize(term)
+        if len(words) == 0 or len(words[-1]) < MIN_SUGGEST_PREFIX:
+            return []
+        with self._lock:
+            if not self.built:
+                return []
+            counted = [(len(self._postings[word]), word) for word in
+                       itertools.islice(self.prefixed(words[-1]),
+                                        MAX_SUGGEST_SCAN)]
+        best = heapq.nsmallest(limit, counted,
+                               key=lambda item: (-item[0], item[1]))
+        return [{'text': ' '.join(words[:-1] + [word]), 'questions': count}
+                for count, word in best]
+
+    def _match(self, words):
+        scores = None
+        for position, word in enumerate(words):
+            exact = self._postings.get(word, set())
+            matched = set(exact)
+            # the last word may still be typed, so it also matches prefixes
+            if position == len(words) - 1:
+                for prefixed in self.prefixed(word):
+                    matched |= self._postings[prefixed]
+            if scores is None:
+                scores = {question_id: 0 for question_id in matched}
+            else:
+                scores = {question_id: score for question_id, score
+                          in scores.items() if question_id in matched}
+            for question_id in exact:
+                if question_id in scores:
+                    scores[question_id] += 1
+            if len(scores) == 0:
+                break
+        return scores or {}
+
+    def ranked(self, words):
+        self._ensure_built()
+        with self._lock:
+            scores = self._match(words)
+        return sorted(scores, key=lambda question_id:
+                      (-scores[question_id], question_id))
+
+    def load(self, question_ids):
+        # load the rows of the given ids, in the same order
+        if len(question_ids) == 0:
+            return []
+        rows = {question.id: question for question in
+                Question.rows().filter(Question.id.in_(question_ids))}
+        return [rows[question_id] for question_id in question_ids
+                if question_id in rows]
+
+    def search(self, term, offset=0, limit=None):
+        words = tokenize(term)
+        if len(words) == 0:
+            return substring_search.search(term, offset, limit)
+
+        # load only the rows of the requested page, in rank order
+        ranked = self.ranked(words)
+        page_ids = ranked[offset:] if limit is None \
+            else ranked[offset:offset + limit]
+        return self.load(page_ids), len(ranked)
+
+    def iterate(self, term, batch_size):
+        words = tokenize(term)
+        if len(words) == 0:
+            return substring_search.iterate(term, batch_size)
+
+        ranked = self.ranked(words)
+
+        def questions():
+            for start in range(0, len(ranked), batch_size):
+                for question in self.load(ranked[start:start + batch_size]):
+                    yield question
+        return questions(), len(ranked)
+
+
+search_index = InvertedIndexSearch()
+substring_search = SubstringSearch()
+
+
+def get_search_backend(name):
+    if name == SubstringSearch.name:
+        return substring_search
+    if name == InvertedIndexSearch.name:
+        return search_index
+    raise ValueError('unknown search backend {!r}'.format(name))
+
+
+@event.listens_for(Question, 'after_insert')
+@event.listens_for(Question, 'after_update')
+def index_question(mapper, connection, target):
+    search_index.add(target.id, target.question)
+    search_index.written(connection)
+
+
+@event.listens_for(Question, 'after_delete')
+def unindex_question(mapper, connection, target):
+    search_index.remove(target.id)
+    search_index.written(connection)
+
+
+# category writes move the 'questions' version but not the question text
+@event.listens_for(Category, 'after_insert')
+@event.listens_for(Category, 'after_update')
+@event.listens_for(Category, 'after_delete')
+def category_written(mapper, connection, target):
+    search_index.written(connection)
+
+
+@on_bulk_write
+def reload_search_index():
+    search_index.invalidate()
@@ -0,0 +1,70 @@
+import io
+
+from flask import json, Response, stream_with_context
+
+from models import Question
+
+# rows fetched per round trip while streaming
+STREAM_BATCH_SIZE = 500
+
+# bytes buffered before a chunk is sent
+STREAM_CHUNK_SIZE = 64 * 1024
+
+STREAM_FORMATS = ['json', 'ndjson']
+
+
+def buffered(parts, size=STREAM_CHUNK_SIZE):
+    buffer = io.StringIO()
+    for part in parts:
+        buffer.write(part)
+        if buffer.tell() >= size:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def json_parts(envelope, questions, categories):
+    # the envelope keys first, then the questions as they are read and the
+    # category of every question once they are all written
+    yield json.dumps(envelope)[:-1] + ',"questions":['
+    current_category = []
+    for position, question in enumerate(questions):
+        if position > 0:
+            yield ','
+        yield json.dumps(Question.format_row(question))
+        current_category.append(question.category)
+    yield ']'
+    if categories:
+        yield ',"current_category":' + json.dumps(current_category)
+    yield '}'
+
+
+def ndjson_parts(envelope, questions, categories):
+    # a first line with the envelope, then one line per question and, if
+    # asked, a last line with the category of every question
+    yield json.dumps(envelope) + '\n'
+    current_category = []
+    for question in questions:
+        yield json.dumps(Question.format_row(question)) + '\n'
+        current_category.append(question.category)
+    if categories:
+        yield json.dumps({'current_category': current_category}) + '\n'
+
+
+'''
+stream_questions(envelope, questions, format)
+    streams the envelope and the questions of an iterator as a chunked
+    JSON object or NDJSON, so rows are written as the cursor reads them.
+    With categories=True the current_category list is written last
+'''
+
+
+def stream_questions(envelope, questions, format='json', categories=False):
+    if format == 'ndjson':
+        parts = ndjson_parts(envelope, questions, categories)
+        mimetype = 'application/x-ndjson'
+    else:
+        parts = json_parts(envelope, questions, categories)
+        mimetype = 'application/json'
+    return Response(stream_with_context(buffered(parts)), mimetype=mimetype)
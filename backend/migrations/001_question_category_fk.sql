@@ -0,0 +1,34 @@
+--
+-- Turns questions.category into an indexed integer foreign key to
+-- categories.id. Databases restored from trivia.psql already have the
+-- integer column and the foreign key, databases created by db.create_all()
+-- before this migration have a varchar column. Safe to run more than once:
+--
+--     psql trivia < migrations/001_question_category_fk.sql
+--
+
+BEGIN;
+
+ALTER TABLE public.questions
+    ALTER COLUMN category TYPE integer USING NULLIF(category::text, '')::integer;
+
+DO $$
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM pg_constraint
+                   WHERE conrelid = 'public.questions'::regclass
+                   AND contype = 'f') THEN
+        ALTER TABLE ONLY public.questions
+            ADD CONSTRAINT category FOREIGN KEY (category)
+            REFERENCES public.categories(id)
+            ON UPDATE CASCADE ON DELETE SET NULL;
+    END IF;
+END
+$$;
+
+-- category filters, category pages seeking on id and quiz id pools
+CREATE INDEX IF NOT EXISTS ix_questions_category_id
+    ON public.questions USING btree (category, id);
+
+ANALYZE public.questions;
+
+COMMIT;
@@ -0,0 +1,21 @@
+--
+-- Adds the content_versions counters used for ETags and cache
+-- invalidation. Safe to run more than once:
+--
+--     psql trivia < migrations/002_content_versions.sql
+--
+
+BEGIN;
+
+CREATE TABLE IF NOT EXISTS public.content_versions (
+    name character varying NOT NULL PRIMARY KEY,
+    version integer DEFAULT 0 NOT NULL,
+    updated_at timestamp without time zone DEFAULT (now() AT TIME ZONE 'utc') NOT NULL
+);
+
+INSERT INTO public.content_versions (name)
+    SELECT 'questions' UNION ALL SELECT 'categories'
+    UNION ALL SELECT 'category:' || id FROM public.categories
+    ON CONFLICT (name) DO NOTHING;
+
+COMMIT;
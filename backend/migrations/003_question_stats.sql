@@ -0,0 +1,20 @@
+--
+-- Adds the question_stats counters of quiz answers, written in batches by
+-- the answer recorder. Safe to run more than once:
+--
+--     psql trivia < migrations/003_question_stats.sql
+--
+
+BEGIN;
+
+CREATE TABLE IF NOT EXISTS public.question_stats (
+    question_id integer NOT NULL PRIMARY KEY
+        REFERENCES public.questions(id) ON DELETE CASCADE,
+    plays integer DEFAULT 0 NOT NULL,
+    correct integer DEFAULT 0 NOT NULL
+);
+
+INSERT INTO public.content_versions (name) VALUES ('question_stats')
+    ON CONFLICT (name) DO NOTHING;
+
+COMMIT;
@@ -0,0 +1,23 @@
+--
+-- Adds the changes log read by GET /changes. Every question and category
+-- write adds rows to it from now on, earlier content is not in the log, so
+-- clients start from a full fetch. Safe to run more than once:
+--
+--     psql trivia < migrations/004_changes.sql
+--
+
+BEGIN;
+
+CREATE TABLE IF NOT EXISTS public.changes (
+    version serial NOT NULL PRIMARY KEY,
+    entity character varying NOT NULL,
+    entity_id integer NOT NULL,
+    operation character varying NOT NULL,
+    created_at timestamp without time zone DEFAULT (now() AT TIME ZONE 'utc') NOT NULL
+);
+
+-- writers lock this counter while they log, see log_changes in models.py
+INSERT INTO public.content_versions (name) VALUES ('changes')
+    ON CONFLICT (name) DO NOTHING;
+
+COMMIT;
@@ -1,26 +1,314 @@
+import itertools
 import os
-from sqlalchemy import Column, String, Integer, create_engine
-from flask_sqlalchemy import SQLAlchemy
+import threading
+import time
+from datetime import datetime
+from sqlalchemy import Column, String, Integer, DateTime, ForeignKey, \
+    Index, bindparam, create_engine, event, inspect, orm, select, text
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.exc import DBAPIError, IntegrityError, \
+    TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import QueuePool
+from flask_sqlalchemy import SQLAlchemy, SignallingSession, BaseQuery
 import json
 
 database_name = "trivia"
-database_path = "postgres://{}:{}@{}/{}". \
-    format('postgres', '0000', 'localhost:5432', database_name)
+database_path = os.environ.get('DATABASE_URL', "postgres://{}:{}@{}/{}".
+                               format('postgres', '0000', 'localhost:5432',
+                                      database_name))
+
+# callbacks given the seconds spent fetching and loading the rows of every
+# query, e.g. by the request instrumentation
+row_load_listeners = []
+
+
+def on_rows_loaded(listener):
+    row_load_listeners.append(listener)
+    return listener
+
+
+def timed_rows(rows):
+    # time each step of the iteration, not the code consuming the rows
+    spent = 0.0
+    try:
+        while True:
+            started = time.perf_counter()
+            try:
+                row = next(rows)
+            except StopIteration:
+                return
+            finally:
+                spent += time.perf_counter() - started
+            yield row
+    finally:
+        for listener in row_load_listeners:
+            listener(spent)
+
+
+'''
+TimedQuery
+    the query class of the models and session. The statement is executed
+    when iteration starts, the time spent fetching rows and building the
+    objects is then reported to the row load listeners, if there are any
+'''
+
+
+class TimedQuery(BaseQuery):
+
+    def __iter__(self):
+        rows = super().__iter__()
+        if not row_load_listeners:
+            return rows
+        return timed_rows(iter(rows))
+
+
+'''
+RoutingSession
+    sends the statements of a session marked with use_replica() to one
+    healthy replica, chosen when the session first needs a connection.
+    Flushes, and sessions not marked, use the primary database
+'''
+
+
+class RoutingSession(SignallingSession):
+    use_replica = False
+    replica = None
+
+    def get_bind(self, mapper=None, clause=None):
+        if self.use_replica and not self._flushing:
+            if self.replica is None:
+                replicas = self.app.extensions.get('replicas')
+                self.replica = replicas.engine() if replicas else False
+            if self.replica:
+                return self.replica
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+db = RoutingSQLAlchemy(query_class=TimedQuery)
+
+# (setting, engine option, type, default), each setting is read from the
+# app config, then from the environment variable of the same name
+POOL_SETTINGS = [
+    ('DB_POOL_SIZE', 'pool_size', int, 5),
+    ('DB_MAX_OVERFLOW', 'max_overflow', int, 10),
+    ('DB_POOL_TIMEOUT', 'pool_timeout', float, 30),
+    ('DB_POOL_RECYCLE', 'pool_recycle', int, 30 * 60),
+    ('DB_POOL_PRE_PING', 'pool_pre_ping', bool, True),
+]
+
+# sqlite doesn't use a queue pool, so it only accepts these options
+SQLITE_POOL_OPTIONS = ('pool_recycle', 'pool_pre_ping')
+
+
+def read_setting(app, name, type_, default):
+    value = app.config.get(name, os.environ.get(name))
+    if value is None:
+        return default
+    if type_ is bool and isinstance(value, str):
+        return value.strip().lower() in ('1', 'true', 'yes', 'on')
+    return type_(value)
+
+
+'''
+TimedQueuePool
+    a QueuePool that counts checkouts, time spent waiting for a
+    connection and checkout timeouts, used to size workers under load
+'''
+
+
+class TimedQueuePool(QueuePool):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+        self._stats_lock = threading.Lock()
+
+    def connect(self):
+        started = time.perf_counter()
+        try:
+            connection = super().connect()
+        except PoolTimeoutError:
+            with self._stats_lock:
+                self.timeouts += 1
+            raise
+        waited = time.perf_counter() - started
+        with self._stats_lock:
+            self.checkouts += 1
+            self.wait_time += waited
+            self.max_wait_time = max(self.max_wait_time, waited)
+        return connection
+
+    def stats(self):
+        return {
+            'size': self.size(),
+            'checked_out': self.checkedout(),
+            'checked_in': self.checkedin(),
+            'overflow': self.overflow(),
+            'checkouts': self.checkouts,
+            'timeouts': self.timeouts,
+            'wait_time': self.wait_time,
+            'max_wait_time': self.max_wait_time,
+            'avg_wait_time': self.wait_time / self.checkouts
+            if self.checkouts else 0.0
+        }
+
+
+def engine_options(app, database_path):
+    options = {}
+    for name, option, type_, default in POOL_SETTINGS:
+        options[option] = read_setting(app, name, type_, default)
+    if make_url(database_path).drivername.startswith('sqlite'):
+        return {option: value for option, value in options.items()
+                if option in SQLITE_POOL_OPTIONS}
+    options['poolclass'] = TimedQueuePool
+    return options
+
+
+# a failed replica is left alone this long before it is probed again
+REPLICA_RETRY_INTERVAL = 10
+
+
+'''
+ReplicaSet(engines)
+    hands out read replicas round-robin. A replica whose connection fails
+    is skipped for retry_interval seconds, then probed with SELECT 1 by
+    the next request that would use it
+'''
+
+
+class ReplicaSet:
+
+    def __init__(self, engines, retry_interval=REPLICA_RETRY_INTERVAL):
+        self.engines = engines
+        self.retry_interval = retry_interval
+        self._down = {}
+        self._turn = itertools.count()
+        for engine in engines:
+            event.listen(engine, 'handle_error', self._failed)
+
+    def _failed(self, context):
+        # connection failures and lost connections, not bad statements
+        if context.connection is None or context.is_disconnect:
+            self.mark_down(context.engine)
+
+    def mark_down(self, engine):
+        self._down[engine] = time.monotonic() + self.retry_interval
+
+    def mark_up(self, engine):
+        self._down.pop(engine, None)
+
+    def probe(self, engine):
+        try:
+            with engine.connect() as connection:
+                connection.execute(text('SELECT 1'))
+        except DBAPIError:
+            self.mark_down(engine)
+            return False
+        self.mark_up(engine)
+        return True
+
+    def next_engine(self):
+        # the next replica in turn and whether it is up: True, False while
+        # it is skipped, or None once it is due to be probed
+        engine = self.engines[next(self._turn) % len(self.engines)]
+        retry_at = self._down.get(engine)
+        if retry_at is None:
+            return engine, True
+        return engine, None if time.monotonic() >= retry_at else False
+
+    def engine(self):
+        # the next healthy replica, or None to read from the primary
+        for _ in range(len(self.engines)):
+            engine, up = self.next_engine()
+            if up or (up is None and self.probe(engine)):
+                return engine
+        return None
+
+    def stats(self):
+        return [{'url': repr(engine.url), 'healthy': engine not in self._down}
+                for engine in self.engines]
+
+
+def replica_urls(app):
+    # DATABASE_REPLICA_URLS, a list or a comma separated string
+    urls = app.config.get('DATABASE_REPLICA_URLS',
+                          os.environ.get('DATABASE_REPLICA_URLS'))
+    if isinstance(urls, str):
+        urls = urls.split(',')
+    return [url.strip() for url in urls or () if url.strip()]
+
+
+def use_replica():
+    # reads of the current session may go to a replica, call it before the
+    # session runs its first statement
+    db.session().use_replica = True
+
+
+def pool_stats(engine=None):
+    pool = (engine or db.engine).pool
+    if isinstance(pool, TimedQueuePool):
+        return pool.stats()
+    return {'status': pool.status()}
 
-db = SQLAlchemy()
 
 '''
 setup_db(app)
-    binds a flask application and a SQLAlchemy service
+    binds a flask application and a SQLAlchemy service, the engine and
+    pool are tuned with the POOL_SETTINGS. Tables are only created when
+    DB_CREATE_ALL is set, or explicitly with create_tables(app)
 '''
 
 
 def setup_db(app, database_path=database_path):
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(app,
+                                                             database_path)
     db.app = app
     db.init_app(app)
-    db.create_all()
+    urls = replica_urls(app)
+    app.extensions['replicas'] = ReplicaSet([
+        create_engine(url, **engine_options(app, url)) for url in urls]) \
+        if urls else None
+    if read_setting(app, 'DB_CREATE_ALL', bool, False):
+        create_tables(app)
+
+
+def create_tables(app):
+    with app.app_context():
+        db.create_all()
+        # the counters are seeded like trivia.psql and the migrations do,
+        # writers lock the 'changes' one to number the log in commit order
+        with db.engine.begin() as connection:
+            categories = connection.execute(select([Category.id]))
+            seed_versions(connection, VERSION_NAMES + [
+                category_version(category_id)
+                for category_id, in categories])
+
+
+# callbacks run after questions are written by bulk statements, which
+# skip the ORM events the in-memory indexes listen to
+bulk_write_listeners = []
+
+
+def on_bulk_write(listener):
+    bulk_write_listeners.append(listener)
+    return listener
+
+
+def questions_bulk_written():
+    for listener in bulk_write_listeners:
+        listener()
 
 
 '''
@@ -35,9 +323,17 @@ class Question(db.Model):
     id = Column(Integer, primary_key=True)
     question = Column(String)
     answer = Column(String)
-    category = Column(String)
+    category = Column(Integer, ForeignKey('categories.id',
+                                          name='category',
+                                          onupdate='CASCADE',
+                                          ondelete='SET NULL'))
     difficulty = Column(Integer)
 
+    # serves category filters, category pages seeking on id and quiz pools
+    __table_args__ = (
+        Index('ix_questions_category_id', 'category', 'id'),
+    )
+
     def __init__(self, question, answer, category, difficulty):
         self.question = question
         self.answer = answer
@@ -55,14 +351,39 @@ class Question(db.Model):
         db.session.delete(self)
         db.session.commit()
 
-    def format(self):
-        return {
+    # stats, e.g. from QuestionStats.for_questions(), is only added when
+    # given, so lists pay for the answer statistics when asked to
+    def format(self, stats=None):
+        result = {
             'id': self.id,
             'question': self.question,
             'answer': self.answer,
             'category': self.category,
             'difficulty': self.difficulty
         }
+        if stats is not None:
+            result['stats'] = stats
+        return result
+
+    # the columns of format() as plain row tuples, for the read routes:
+    # no objects, identity map or attribute tracking per row
+    @classmethod
+    def rows(cls):
+        return db.session.query(cls.id, cls.question, cls.answer,
+                                cls.category, cls.difficulty)
+
+    @staticmethod
+    def format_row(row, stats=None):
+        result = {
+            'id': row.id,
+            'question': row.question,
+            'answer': row.answer,
+            'category': row.category,
+            'difficulty': row.difficulty
+        }
+        if stats is not None:
+            result['stats'] = stats
+        return result
 
 
 '''
@@ -80,8 +401,289 @@ class Category(db.Model):
     def __init__(self, type):
         self.type = type
 
+    def insert(self):
+        db.session.add(self)
+        db.session.commit()
+
+    def update(self):
+        db.session.commit()
+
+    def delete(self):
+        db.session.delete(self)
+        db.session.commit()
+
     def format(self):
         return {
             'id': self.id,
             'type': self.type
         }
+
+
+'''
+QuestionStats
+    how many times a question was answered in quizzes and how many of
+    the answers were correct, added to in batches by the answer recorder
+'''
+
+
+class QuestionStats(db.Model):
+    __tablename__ = 'question_stats'
+
+    question_id = Column(Integer, ForeignKey('questions.id',
+                                             ondelete='CASCADE'),
+                         primary_key=True)
+    plays = Column(Integer, nullable=False, default=0)
+    correct = Column(Integer, nullable=False, default=0)
+
+    def __init__(self, question_id, plays=0, correct=0):
+        self.question_id = question_id
+        self.plays = plays
+        self.correct = correct
+
+    def format(self):
+        return self.format_counts(self.plays, self.correct)
+
+    @staticmethod
+    def format_counts(plays, correct):
+        return {
+            'plays': plays,
+            'correct': correct,
+            'correct_rate': round(correct / plays, 3) if plays else None
+        }
+
+    @classmethod
+    def for_questions(cls, question_ids):
+        # {question_id: stats} in one query, unplayed questions included
+        stats = {question_id: cls.format_counts(0, 0)
+                 for question_id in question_ids}
+        if len(stats) > 0:
+            rows = db.session.query(cls.question_id, cls.plays,
+                                    cls.correct).\
+                filter(cls.question_id.in_(list(stats)))
+            for question_id, plays, correct in rows:
+                stats[question_id] = cls.format_counts(plays, correct)
+        return stats
+
+
+'''
+ContentVersion
+    a counter per table ('questions', 'categories') and per category
+    ('category:<id>') bumped in the same transaction as every write, so
+    readers can tell whether content changed without loading it
+'''
+
+
+class ContentVersion(db.Model):
+    __tablename__ = 'content_versions'
+
+    name = Column(String, primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+    updated_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+    def __init__(self, name, version=0):
+        self.name = name
+        self.version = version
+
+
+'''
+Change
+    one row per question or category written, numbered in the order the
+    writes commit, so GET /changes can send clients what changed since the
+    last version they saw. Operations are 'insert', 'update' and 'delete'
+'''
+
+
+class Change(db.Model):
+    __tablename__ = 'changes'
+
+    version = Column(Integer, primary_key=True)
+    entity = Column(String, nullable=False)
+    entity_id = Column(Integer, nullable=False)
+    operation = Column(String, nullable=False)
+    created_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+
+# the counters every database has, besides one per category
+VERSION_NAMES = ['questions', 'categories', 'changes', 'question_stats']
+
+
+def category_version(category_id):
+    return 'category:{}'.format(category_id)
+
+
+def seed_versions(connection, names):
+    # creates the counters not there yet, at version 0
+    table = ContentVersion.__table__
+    if len(names) == 0:
+        return
+    if connection.dialect.name == 'postgresql':
+        connection.execute(postgresql.insert(table).values(
+            [{'name': name} for name in names]).on_conflict_do_nothing())
+        return
+    existing = {name for name, in connection.execute(
+        select([table.c.name]).where(table.c.name.in_(names)))}
+    missing = [{'name': name} for name in names if name not in existing]
+    if len(missing) > 0:
+        connection.execute(table.insert(), missing)
+
+
+def bump_versions(connection, names, like=None):
+    # returns the number of counters bumped
+    table = ContentVersion.__table__
+    condition = table.c.name.in_(names)
+    if like is not None:
+        condition = condition | table.c.name.like(like)
+    return connection.execute(table.update().where(condition).values(
+        version=table.c.version + 1, updated_at=datetime.utcnow())).rowcount
+
+
+def log_changes(connection, entity, operation, ids):
+    # the 'changes' counter stays locked until the transaction ends, so
+    # writers take their versions in commit order and a reader that saw
+    # a version has seen every version before it
+    ids = list(ids)
+    if len(ids) == 0:
+        return
+    if bump_versions(connection, ['changes']) == 0:
+        # a database created before its counters were seeded
+        seed_versions(connection, ['changes'])
+        bump_versions(connection, ['changes'])
+    now = datetime.utcnow()
+    connection.execute(Change.__table__.insert(), [
+        {'entity': entity, 'entity_id': entity_id, 'operation': operation,
+         'created_at': now} for entity_id in ids])
+
+
+def add_question_stats(connection, counts):
+    # adds {question_id: (plays, correct)} to the counters in a few
+    # statements, answers to questions deleted since are dropped
+    stats = QuestionStats.__table__
+    questions = Question.__table__
+    known = {question_id for question_id, in connection.execute(
+        select([questions.c.id]).where(questions.c.id.in_(list(counts))))}
+    rows = [{'question_id': question_id, 'plays': plays, 'correct': correct}
+            for question_id, (plays, correct) in sorted(counts.items())
+            if question_id in known]
+    if len(rows) == 0:
+        return 0
+    if connection.dialect.name == 'postgresql':
+        insert = postgresql.insert(stats).values(rows)
+        connection.execute(insert.on_conflict_do_update(
+            index_elements=[stats.c.question_id],
+            set_={'plays': stats.c.plays + insert.excluded.plays,
+                  'correct': stats.c.correct + insert.excluded.correct}))
+    else:
+        existing = {question_id for question_id, in connection.execute(
+            select([stats.c.question_id]).where(
+                stats.c.question_id.in_([row['question_id']
+                                         for row in rows])))}
+        updates = [{'id': row['question_id'], 'add_plays': row['plays'],
+                    'add_correct': row['correct']}
+                   for row in rows if row['question_id'] in existing]
+        inserts = [row for row in rows if row['question_id'] not in existing]
+        if len(updates) > 0:
+            connection.execute(
+                stats.update().where(stats.c.question_id == bindparam('id')).
+                values(plays=stats.c.plays + bindparam('add_plays'),
+                       correct=stats.c.correct + bindparam('add_correct')),
+                updates)
+        if len(inserts) > 0:
+            connection.execute(stats.insert(), inserts)
+    bump_versions(connection, ['question_stats'])
+    return sum(row['plays'] for row in rows)
+
+
+def read_versions(names):
+    # {name: (version, updated_at)}, creating the counters not seen yet
+    table = ContentVersion.__table__
+    rows = db.session.execute(table.select().where(table.c.name.in_(names)))
+    versions = {row.name: (row.version, row.updated_at) for row in rows}
+    missing = [name for name in names if name not in versions]
+    if len(missing) > 0:
+        # created on the primary, where they are read back, replicas may
+        # not have them yet
+        with db.engine.connect() as connection:
+            for name in missing:
+                try:
+                    connection.execute(table.insert().values(name=name))
+                except IntegrityError:
+                    # created at the same time by another request
+                    pass
+            rows = connection.execute(table.select().where(
+                table.c.name.in_(names)))
+            return {row.name: (row.version, row.updated_at) for row in rows}
+    return versions
+
+
+@event.listens_for(Question, 'after_insert')
+@event.listens_for(Question, 'after_delete')
+def bump_question_versions(mapper, connection, target):
+    bump_versions(connection, ['questions',
+                               category_version(target.category)])
+
+
+@event.listens_for(Question, 'after_update')
+def bump_updated_question_versions(mapper, connection, target):
+    history = inspect(target).attrs.category.history
+    categories = set(history.deleted or ()) | {target.category}
+    bump_versions(connection, ['questions'] + [category_version(category)
+                                               for category in categories])
+
+
+@event.listens_for(Category, 'after_insert')
+@event.listens_for(Category, 'after_update')
+@event.listens_for(Category, 'after_delete')
+def bump_category_versions(mapper, connection, target):
+    # deleting a category also sets the category of its questions to null
+    bump_versions(connection, ['categories', 'questions',
+                               category_version(target.id)])
+
+
+@event.listens_for(Question, 'after_insert')
+def log_question_insert(mapper, connection, target):
+    log_changes(connection, 'questions', 'insert', [target.id])
+
+
+@event.listens_for(Question, 'after_update')
+def log_question_update(mapper, connection, target):
+    log_changes(connection, 'questions', 'update', [target.id])
+
+
+@event.listens_for(Question, 'after_delete')
+def log_question_delete(mapper, connection, target):
+    log_changes(connection, 'questions', 'delete', [target.id])
+
+
+@event.listens_for(Category, 'after_insert')
+def log_category_insert(mapper, connection, target):
+    log_changes(connection, 'categories', 'insert', [target.id])
+
+
+@event.listens_for(Category, 'after_update')
+def log_category_update(mapper, connection, target):
+    log_changes(connection, 'categories', 'update', [target.id])
+
+
+@event.listens_for(Category, 'before_delete')
+def find_category_questions(mapper, connection, target):
+    # the foreign key sets the category of these questions to null, they
+    # are logged after the delete: versions are always locked before the
+    # 'changes' counter, in the same order as every other write
+    questions = Question.__table__
+    inspect(target).info['questions'] = [
+        question_id for question_id, in connection.execute(
+            select([questions.c.id]).where(
+                questions.c.category == target.id))]
+
+
+@event.listens_for(Category, 'after_delete')
+def log_category_delete(mapper, connection, target):
+    log_changes(connection, 'questions', 'update',
+                inspect(target).info.pop('questions', ()))
+    log_changes(connection, 'categories', 'delete', [target.id])
+
+
+@on_bulk_write
+def bump_bulk_versions():
+    with db.engine.begin() as connection:
+        bump_versions(connection, ['questions'], like='category:%')
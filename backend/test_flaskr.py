@@ -1,10 +1,135 @@
+import asyncio
+import gzip
 import os
+import pickle
+import socketserver
+import tempfile
+import threading
+import time
 import unittest
 import json
+from flask import Response
+try:
+    import asyncpg
+except ImportError:
+    asyncpg = None
+try:
+    import brotli
+except ImportError:
+    brotli = None
 from flask_sqlalchemy import SQLAlchemy
-
-from flaskr import create_app
-from models import setup_db, Question, Category
+from sqlalchemy import create_engine, event
+
+from flaskr import create_app, READ_PRIMARY_COOKIE
+from flaskr.asgi import create_asgi_app
+from flaskr.fastjson import json_encoder, Fragment, JSON_BACKENDS, \
+    installed
+from flaskr.cache import category_cache, MemoryCache, RedisCache, \
+    ResponseCache, LOCK_STRIPES, RESPONSE_CACHE_PREFIX
+from flaskr.search import search_index
+from flaskr.quiz import question_pool, QuizSession, MemorySessionStore
+from flaskr.admission import ConcurrencyLimit
+from flaskr.changes import prune_changes
+from benchmarks.suite import regressions
+from models import setup_db, create_tables, engine_options, bump_versions, \
+    read_versions, ReplicaSet, db, ContentVersion, Question, Category, \
+    QuestionStats
+
+
+class FakeRedisHandler(socketserver.StreamRequestHandler):
+    """Answers the GET, SET (with PX and NX), DEL and SELECT commands,
+    or every command with the server's error when it is set."""
+
+    def read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        args = []
+        for _ in range(int(line[1:])):
+            length = int(self.rfile.readline()[1:])
+            args.append(self.rfile.read(length + 2)[:-2])
+        return args
+
+    def handle(self):
+        data = self.server.data
+        while True:
+            args = self.read_command()
+            if args is None:
+                return
+            command = args[0].upper()
+            if self.server.error is not None:
+                reply = b'-%s\r\n' % self.server.error
+            elif command == b'GET':
+                value = data.get(args[1])
+                reply = b'$-1\r\n' if value is None else \
+                    b'$%d\r\n%s\r\n' % (len(value), value)
+            elif command == b'SET':
+                if b'NX' in args[3:] and args[1] in data:
+                    reply = b'$-1\r\n'
+                else:
+                    data[args[1]] = args[2]
+                    reply = b'+OK\r\n'
+            elif command == b'DEL':
+                reply = b':%d\r\n' % int(data.pop(args[1], None) is not None)
+            else:
+                reply = b'+OK\r\n'
+            self.wfile.write(reply)
+
+
+class FakeRedisServer(socketserver.ThreadingTCPServer):
+    """A local stand-in for a Redis server, keeping keys in a dict."""
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), FakeRedisHandler)
+        self.data = {}
+        self.error = None
+        self.port = self.server_address[1]
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def asgi_response(app, method, path, query=b'', body=b'', headers=()):
+    """Runs one request through an ASGI app, returns (status, headers,
+    body) with the header names in lower case."""
+    messages = []
+    received = []
+
+    async def receive():
+        # the body, then nothing until the client goes away
+        if len(received) > 0:
+            await asyncio.Event().wait()
+        received.append(body)
+        return {'type': 'http.request', 'body': body, 'more_body': False}
+
+    async def send(message):
+        messages.append(message)
+
+    async def run():
+        scope = {'type': 'http', 'method': method, 'path': path,
+                 'query_string': query, 'headers': [
+                     (b'content-type', b'application/json')] + [
+                     (name.encode('latin-1'), value.encode('latin-1'))
+                     for name, value in headers]}
+        try:
+            await app(scope, receive, send)
+        finally:
+            await app.close()
+
+    asyncio.run(run())
+    return messages[0]['status'], \
+        {name.decode('latin-1'): value.decode('latin-1')
+         for name, value in messages[0]['headers']}, \
+        b''.join(message.get('body', b'') for message in messages[1:])
+
+
+def asgi_request(app, method, path, query=b'', body=b''):
+    """Runs one request through an ASGI app, returns (status, body)."""
+    status, _, body = asgi_response(app, method, path, query, body)
+    return status, body
 
 
 class TriviaTestCase(unittest.TestCase):
@@ -46,6 +171,324 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data['success'], True)
         self.assertTrue(data['categories'])
 
+    def create_test_app(self, test_config):
+        app = create_app(test_config)
+        setup_db(app, self.database_path)
+        return app
+
+    def test_categories_are_served_from_cache(self):
+
+        # without the response cache every request reads the categories
+        client = self.create_test_app({'RESPONSE_CACHE': None}).test_client
+        category_cache.invalidate()
+        client().get('/categories')
+        stats = category_cache.stats()
+        client().get('/categories')
+        client().get('/questions?page=1')
+
+        # check only the first request missed the cache
+        self.assertEqual(category_cache.misses, stats['misses'])
+        self.assertEqual(category_cache.hits, stats['hits'] + 2)
+
+    def test_request_timing_and_metrics(self):
+        client = self.create_test_app({'METRICS': True,
+                                       'RESPONSE_CACHE': None}).test_client
+        res = client().get('/questions?page=1')
+        timing = dict(entry.split(';', 1)[0:2] for entry in
+                      res.headers['Server-Timing'].split(', '))
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(list(timing), ['db', 'orm', 'serialize', 'total'])
+        self.assertRegex(timing['db'], r'desc="[1-9]\d* SQL statements"')
+
+        res = client().get('/metrics')
+        body = res.data.decode('utf-8')
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('# TYPE trivia_request_db_queries histogram', body)
+        self.assertIn('trivia_request_duration_seconds_count{route='
+                      '"/questions",method="GET",status="200"} 1', body)
+        self.assertIn('trivia_admission_rejected_total{endpoint='
+                      '"search_question"} 0', body)
+
+    def test_404_metrics_off(self):
+        res = self.client().get('/metrics')
+
+        self.assertEqual(res.status_code, 404)
+        self.assertNotIn('Server-Timing', res.headers)
+
+    def test_json_backends_encode_alike(self):
+        data = {'b': [1, 2.5, None, True], 'a': {'x': 'caf\u00e9'},
+                'c': Fragment('{"1":"Science"}'), 'd': {10: 'b', 2: 'a'}}
+        expected = '{"a":{"x":"caf\\u00e9"},"b":[1,2.5,null,true],' \
+            '"c":{"1":"Science"},"d":{"2":"a","10":"b"}}'
+        for name in JSON_BACKENDS:
+            if installed(name):
+                self.assertEqual(json.dumps(data, cls=json_encoder(name),
+                                            sort_keys=True), expected)
+
+    def test_json_backend_must_be_known(self):
+        with self.assertRaises(ValueError):
+            json_encoder('simdjson')
+
+    def test_category_cache_invalidated_on_write(self):
+        category_cache.get()
+
+        # add a category and check the cached map includes it at once
+        category = Category(type="Music")
+        category.insert()
+        try:
+            res = self.client().get('/categories')
+            data = json.loads(res.data.decode('utf-8'))
+            self.assertEqual(data['categories'][str(category.id)], "Music")
+        finally:
+            category.delete()
+        self.assertNotIn(category.id, category_cache.get())
+
+    def test_category_cache_invalidated_on_commit(self):
+        with self.app.app_context():
+            category = Category(type="Music")
+            db.session.add(category)
+            db.session.flush()
+
+            # another thread reloads the categories before the commit
+            def reload():
+                with self.app.app_context():
+                    category_cache.get()
+            thread = threading.Thread(target=reload)
+            thread.start()
+            thread.join()
+
+            db.session.commit()
+            category_id = category.id
+            try:
+                self.assertIn(category_id, category_cache.get())
+            finally:
+                db.session.delete(category)
+                db.session.commit()
+            self.assertNotIn(category_id, category_cache.get())
+
+    def test_category_cache_follows_writes_of_other_processes(self):
+        res = self.client().get('/categories')
+        etag = res.headers['ETag']
+        self.assertEqual(res.get_json()['categories']['1'], 'Science')
+
+        # a category renamed by another process, without ORM events
+        table = Category.__table__
+        names = ['categories', 'questions', 'category:1']
+        with self.app.app_context():
+            with db.engine.begin() as connection:
+                connection.execute(table.update().where(
+                    table.c.id == 1).values(type='Physics'))
+                bump_versions(connection, names)
+            try:
+                res = self.client().get('/categories')
+                self.assertNotEqual(res.headers['ETag'], etag)
+                self.assertEqual(res.get_json()['categories']['1'],
+                                 'Physics')
+                res = self.client().get('/questions?page=1')
+                self.assertEqual(res.get_json()['categories']['1'],
+                                 'Physics')
+            finally:
+                with db.engine.begin() as connection:
+                    connection.execute(table.update().where(
+                        table.c.id == 1).values(type='Science'))
+                    bump_versions(connection, names)
+
+    def test_retrieve_pool_stats(self):
+        self.client().get('/categories/1/questions')
+        res = self.client().get('/stats/pool')
+        data = json.loads(res.data.decode('utf-8'))
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+
+        # check checkouts and wait times are counted
+        self.assertGreater(data['pool']['checkouts'], 0)
+        self.assertGreaterEqual(data['pool']['max_wait_time'], 0)
+
+    def test_engine_options_read_from_config(self):
+        app = create_app({'DB_POOL_SIZE': 3, 'DB_POOL_PRE_PING': 'false'})
+        options = app.config['SQLALCHEMY_ENGINE_OPTIONS']
+        self.assertEqual(options['pool_size'], 3)
+        self.assertEqual(options['pool_pre_ping'], False)
+
+        # check sqlite only gets the options its pool accepts
+        options = engine_options(app, 'sqlite:///trivia.db')
+        self.assertNotIn('pool_size', options)
+        self.assertIn('pool_recycle', options)
+
+    def test_conditional_get_returns_304(self):
+        res = self.client().get('/questions?page=1')
+        etag = res.headers['ETag']
+        self.assertIn('must-revalidate', res.headers['Cache-Control'])
+
+        # check the same page is not sent again while nothing changed
+        res = self.client().get('/questions?page=1',
+                                headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.data, b'')
+
+        # check another page has another ETag
+        res = self.client().get('/questions?page=2',
+                                headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 200)
+
+    def test_etag_changes_after_question_write(self):
+        res = self.client().get('/categories/3/questions')
+        etag = res.headers['ETag']
+        other_etag = self.client().get('/categories/4/questions').\
+            headers['ETag']
+
+        question = Question(question="Where is Petra?", answer="Jordan",
+                            category=3, difficulty=2)
+        question.insert()
+        try:
+            # check only the category of the question changed
+            res = self.client().get('/categories/3/questions',
+                                    headers={'If-None-Match': etag})
+            self.assertEqual(res.status_code, 200)
+            self.assertNotEqual(res.headers['ETag'], etag)
+            res = self.client().get('/categories/4/questions',
+                                    headers={'If-None-Match': other_etag})
+            self.assertEqual(res.status_code, 304)
+        finally:
+            question.delete()
+
+    def test_response_cache_serves_repeated_pages(self):
+        res = self.client().get('/questions?page=1')
+        cached = self.client().get('/questions?page=1')
+        self.assertEqual(cached.data, res.data)
+        self.assertEqual(cached.headers['ETag'], res.headers['ETag'])
+
+        # check the second request was a hit
+        res = self.client().get('/stats/cache')
+        data = json.loads(res.data.decode('utf-8'))
+        self.assertEqual(data['responses']['hits'], 1)
+        self.assertEqual(data['responses']['misses'], 1)
+
+    def test_compressed_pages_are_cached_per_encoding(self):
+        plain = self.client().get('/questions?page=1')
+        res = self.client().get('/questions?page=1',
+                                headers={'Accept-Encoding': 'gzip'})
+
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', res.headers['Vary'])
+        self.assertEqual(gzip.decompress(res.data), plain.data)
+        self.assertNotEqual(res.headers['ETag'], plain.headers['ETag'])
+
+        # check the compressed body is cached and revalidated by its ETag
+        cached = self.client().get('/questions?page=1',
+                                   headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(cached.data, res.data)
+        self.assertEqual(cached.headers['Content-Encoding'], 'gzip')
+        res = self.client().get('/questions?page=1', headers={
+            'Accept-Encoding': 'gzip', 'If-None-Match': res.headers['ETag']})
+        self.assertEqual(res.status_code, 304)
+
+        data = json.loads(self.client().get('/stats/cache').data)
+        self.assertEqual(data['responses']['hits'], 1)
+
+    def test_compression_threshold_and_brotli(self):
+        # check small bodies are sent as they are
+        res = self.client().get('/categories',
+                                headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', res.headers)
+
+        res = self.client().post('/questions',
+                                 json={'searchTerm': 'e',
+                                       'mode': 'substring'},
+                                 headers={'Accept-Encoding': 'br, gzip'})
+        self.assertEqual(res.headers['Content-Encoding'],
+                         'br' if brotli is not None else 'gzip')
+
+    def test_response_cache_single_flight(self):
+        cache = ResponseCache(MemoryCache())
+        renders = []
+
+        def render():
+            renders.append(1)
+            time.sleep(0.05)
+            return Response(b'{}', mimetype='application/json')
+
+        # check concurrent misses of one key render it once
+        threads = [threading.Thread(target=cache.respond,
+                                    args=('key', render))
+                   for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(renders), 1)
+        self.assertEqual(cache.hits, 7)
+
+    def test_response_cache_waits_only_while_locked(self):
+        backend = MemoryCache()
+        cache = ResponseCache(backend, wait_timeout=5)
+
+        def render():
+            return Response(b'{}', mimetype='application/json')
+
+        # another worker renders 'key' and gives up without storing it
+        lock_key = RESPONSE_CACHE_PREFIX + 'key:lock'
+        backend.add(lock_key, b'1', 5)
+        started = time.monotonic()
+        waiter = threading.Thread(target=cache.respond, args=('key', render))
+        waiter.start()
+        time.sleep(0.05)
+
+        # check a key of the same stripe is not held up by the waiter
+        stripe = hash(RESPONSE_CACHE_PREFIX + 'key') % LOCK_STRIPES
+        other = next(name for name in ('other{}'.format(number)
+                                       for number in range(10000))
+                     if hash(RESPONSE_CACHE_PREFIX + name) % LOCK_STRIPES ==
+                     stripe)
+        cache.respond(other, render)
+        self.assertLess(time.monotonic() - started, 1)
+
+        # check the waiter renders once the lock is gone
+        backend.delete(lock_key)
+        waiter.join()
+        self.assertLess(time.monotonic() - started, 1)
+        self.assertEqual(cache.waits, 1)
+        self.assertIsNotNone(backend.get(RESPONSE_CACHE_PREFIX + 'key'))
+
+    def test_redis_response_cache_shared_between_apps(self):
+        server = FakeRedisServer()
+        try:
+            url = 'redis://127.0.0.1:{}/0'.format(server.port)
+            first = self.create_test_app({'RESPONSE_CACHE': url})
+            second = self.create_test_app({'RESPONSE_CACHE': url})
+            res = first.test_client().get('/categories/1/questions')
+
+            # check the second app is served what the first one rendered
+            cached = second.test_client().get('/categories/1/questions')
+            self.assertEqual(cached.data, res.data)
+            stats = second.extensions['response_cache'].stats()
+            self.assertEqual(stats['hits'], 1)
+        finally:
+            server.stop()
+
+    def test_redis_response_cache_fails_open(self):
+        cache = RedisCache('redis://127.0.0.1:1/0')
+        self.assertIsNone(cache.get('key'))
+        self.assertTrue(cache.add('key', b'1', 1))
+
+    def test_redis_response_cache_fails_open_on_error_replies(self):
+        server = FakeRedisServer()
+        try:
+            cache = RedisCache('redis://127.0.0.1:{}/0'.format(server.port))
+            cache.set('key', b'value', 1)
+            server.error = b'ERR OOM command not allowed'
+            self.assertIsNone(cache.get('key'))
+            self.assertTrue(cache.add('lock', b'1', 1))
+            cache.set('key', b'other', 1)
+            cache.delete('key')
+
+            # check the connection is still usable once the server recovers
+            server.error = None
+            self.assertEqual(cache.get('key'), b'value')
+        finally:
+            server.stop()
+
     def test_404_browse_wrong_categories_route(self):
 
         # get response and loading data
@@ -71,6 +514,53 @@ class TriviaTestCase(unittest.TestCase):
         self.assertTrue(len(data['categories']))
         self.assertTrue(data['current_category'])
 
+    def test_paginated_questions_are_sliced_in_order(self):
+        res_first = self.client().get('/questions?page=1')
+        res_second = self.client().get('/questions?page=2')
+        first = json.loads(res_first.data.decode('utf-8'))
+        second = json.loads(res_second.data.decode('utf-8'))
+        self.assertEqual(res_second.status_code, 200)
+
+        # check pages are ordered by id and don't overlap
+        first_ids = [question['id'] for question in first['questions']]
+        second_ids = [question['id'] for question in second['questions']]
+        self.assertEqual(len(first_ids), 10)
+        self.assertEqual(first_ids, sorted(first_ids))
+        self.assertLess(first_ids[-1], second_ids[0])
+
+        # check total_questions is the count of the whole table
+        self.assertEqual(first['total_questions'], Question.query.count())
+
+    def test_cursor_pagination_of_questions(self):
+        res = self.client().get('/questions?after=0&limit=5')
+        data = json.loads(res.data.decode('utf-8'))
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(data['questions']), 5)
+
+        # check next_cursor is the last id and the next page starts after it
+        self.assertEqual(data['next_cursor'], data['questions'][-1]['id'])
+        res = self.client().get('/questions?after={}&limit=5'.
+                                format(data['next_cursor']))
+        next_data = json.loads(res.data.decode('utf-8'))
+        self.assertGreater(next_data['questions'][0]['id'],
+                           data['next_cursor'])
+
+    def test_cursor_pagination_of_category_questions(self):
+        res = self.client().get('/categories/1/questions?after=0&limit=1000')
+        data = json.loads(res.data.decode('utf-8'))
+        self.assertEqual(res.status_code, 200)
+
+        # check last page has no cursor and is capped to the max page size
+        self.assertIsNone(data['next_cursor'])
+        self.assertLessEqual(len(data['questions']), 100)
+        self.assertEqual(data['current_category'], 1)
+
+    def test_400_cursor_pagination_with_bad_limit(self):
+        res = self.client().get('/questions?after=0&limit=0')
+        data = json.loads(res.data.decode('utf-8'))
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+
     def test_404_requesting_beyond_pages_range(self):
 
         # make get request with page number out of range
@@ -156,6 +646,184 @@ class TriviaTestCase(unittest.TestCase):
         # check question is not None
         self.assertNotEqual(question_after_insertion, None)
 
+    def test_bulk_import_questions(self):
+        rows = [{'question': "Bulk question {}?".format(number),
+                 'answer': "Bulk", 'category': 2, 'difficulty': 1}
+                for number in range(5)]
+        rows.append({'question': "Bulk question without answer?",
+                     'category': 2, 'difficulty': 1})
+        body = '\n'.join(json.dumps(row) for row in rows) + '\nnot json\n'
+        count_before = Question.query.count()
+
+        res = self.client().post('/questions/import?batch_size=2', data=body,
+                                 content_type='application/x-ndjson')
+        data = json.loads(res.data.decode('utf-8'))
+        try:
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(data['imported'], 5)
+
+            # check the invalid rows are reported by row number
+            self.assertEqual(data['failed'], 2)
+            self.assertEqual([error['row'] for error in data['errors']],
+                             [6, 7])
+            self.assertEqual(Question.query.count(), count_before + 5)
+        finally:
+            Question.query.filter(Question.answer == "Bulk").delete()
+            db.session.commit()
+
+    def test_bulk_import_questions_from_csv(self):
+        body = ('question,answer,difficulty,category\n'
+                '"Bulk, from csv?",Bulk,2,3\n'
+                'Bulk with a wrong category?,Bulk,2,12345\n')
+        res = self.client().post('/questions/import', data=body,
+                                 content_type='text/csv')
+        data = json.loads(res.data.decode('utf-8'))
+        try:
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(data['imported'], 1)
+
+            # check the row rejected by the foreign key is reported
+            self.assertEqual(data['errors'][0]['row'], 2)
+        finally:
+            Question.query.filter(Question.answer == "Bulk").delete()
+            db.session.commit()
+
+    def test_bulk_import_reports_invalid_utf8(self):
+        body = ('question,answer,difficulty,category\n'.encode('utf-8') +
+                b'Bulk caf\xe9?,Bulk,2,3\n' +
+                'Bulk café?,Bulk,2,3\n'.encode('utf-8'))
+        res = self.client().post('/questions/import', data=body,
+                                 content_type='text/csv')
+        data = json.loads(res.data.decode('utf-8'))
+        try:
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(data['imported'], 1)
+            self.assertEqual(data['errors'], [
+                {'row': 1, 'error': 'question is not valid UTF-8'}])
+        finally:
+            Question.query.filter(Question.answer == "Bulk").delete()
+            db.session.commit()
+
+    def test_bulk_import_updates_pools_and_index(self):
+        with self.app.app_context():
+            pool = question_pool.ids(3)
+            search_index.ranked(['zeppelinq'])
+        body = json.dumps({'question': "Bulk zeppelinq?", 'answer': "Bulk",
+                           'category': 3, 'difficulty': 1})
+        res = self.client().post('/questions/import', data=body,
+                                 content_type='application/x-ndjson')
+        self.assertEqual(res.status_code, 200)
+        with self.app.app_context():
+            question_id = Question.query.filter(
+                Question.answer == "Bulk").one().id
+            try:
+                # check both were updated in place, at the current version
+                self.assertIs(question_pool.ids(3), pool)
+                self.assertIn(question_id, pool)
+                self.assertEqual(search_index.ranked(['zeppelinq']),
+                                 [question_id])
+                self.assertEqual(search_index.version, read_versions(
+                    ['questions'])['questions'][0])
+            finally:
+                Question.query.filter(Question.answer == "Bulk").delete()
+                db.session.commit()
+                question_pool.invalidate()
+                search_index.invalidate()
+
+    def test_bulk_export_questions(self):
+        res = self.client().get('/questions/export')
+        self.assertEqual(res.status_code, 200)
+
+        # check every question is exported as one JSON line ordered by id
+        lines = res.data.decode('utf-8').splitlines()
+        ids = [json.loads(line)['id'] for line in lines]
+        self.assertEqual(len(ids), Question.query.count())
+        self.assertEqual(ids, sorted(ids))
+
+    def insert_questions(self, count, category=3):
+        ids = []
+        for number in range(count):
+            question = Question(question='Batch zeppeliny {}?'.format(number),
+                                answer='yes', category=category,
+                                difficulty=1)
+            question.insert()
+            ids.append(question.id)
+        return ids
+
+    def test_batch_delete_questions(self):
+        ids = self.insert_questions(3)
+        with self.app.app_context():
+            pool = question_pool.ids(3)
+        res = self.client().post('/questions/delete', json={
+            'ids': [ids[0], ids[1], 999999, 'x', ids[0]]})
+        data = json.loads(res.data)
+        try:
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(data['deleted'], 2)
+            self.assertEqual(data['failed'], 3)
+            self.assertEqual([result['success']
+                              for result in data['results']],
+                             [True, True, False, False, False])
+            self.assertEqual(data['results'][2]['error'], 'not found')
+            self.assertEqual(data['results'][4]['error'], 'duplicate id')
+
+            # check the rows, the quiz pool and the search index are gone
+            with self.app.app_context():
+                self.assertEqual(Question.query.filter(
+                    Question.id.in_(ids)).count(), 1)
+            self.assertNotIn(ids[0], pool)
+            res = self.client().post('/questions',
+                                     json={'searchTerm': 'zeppeliny'})
+            data = json.loads(res.data)
+            self.assertEqual([item['id'] for item in data['questions']],
+                             [ids[2]])
+        finally:
+            self.client().post('/questions/delete', json={'ids': ids})
+
+    def test_batch_update_questions(self):
+        ids = self.insert_questions(2)
+        etag = self.client().get('/categories/4/questions').headers['ETag']
+        try:
+            res = self.client().post('/questions/update', json={
+                'ids': ids, 'set': {'category': 4, 'difficulty': 5}})
+            data = json.loads(res.data)
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(data['updated'], 2)
+            with self.app.app_context():
+                self.assertEqual({(question.category, question.difficulty)
+                                  for question in Question.query.filter(
+                                      Question.id.in_(ids))}, {(4, 5)})
+                self.assertIn(ids[0], question_pool.ids(4))
+                self.assertNotIn(ids[0], question_pool.ids(3))
+            res = self.client().get('/categories/4/questions',
+                                    headers={'If-None-Match': etag})
+            self.assertEqual(res.status_code, 200)
+
+            res = self.client().post('/questions/update', json={'patches': [
+                {'id': ids[0], 'question': 'Batch zeppelinz?'},
+                {'id': ids[1], 'category': 999999}]})
+            data = json.loads(res.data)
+            self.assertEqual(data['updated'], 1)
+            self.assertEqual(data['results'][1]['error'],
+                             'unknown category 999999')
+            res = self.client().post('/questions',
+                                     json={'searchTerm': 'zeppelinz'})
+            self.assertEqual(json.loads(res.data)['questions'][0]['id'],
+                             ids[0])
+        finally:
+            self.client().post('/questions/delete', json={'ids': ids})
+
+    def test_400_and_422_batch_writes(self):
+        res = self.client().post('/questions/delete', json={'ids': []})
+        self.assertEqual(res.status_code, 400)
+
+        res = self.client().post('/questions/update',
+                                 json={'patches': [{'id': 999999,
+                                                    'difficulty': 2}]})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['results'][0]['error'], 'not found')
+
     def test_400_inserting_missing_question_parts(self):
         count_before = len(Question.query.all())
         res = self.client().post('/questions', json={})
@@ -182,6 +850,168 @@ class TriviaTestCase(unittest.TestCase):
         self.assertTrue(data['total_questions'])
         self.assertTrue(data['current_category'])
 
+    def test_search_question_index_is_kept_up_to_date(self):
+        search_index.invalidate()
+        self.client().post('/questions', json={'searchTerm': "title"})
+
+        # insert a question after the index was built and search for it
+        question = Question(question="Which zeppelinx flew first?",
+                            answer="LZ 1", category="4", difficulty=2)
+        question.insert()
+        question_id = question.id
+        res = self.client().post('/questions',
+                                 json={'searchTerm': "zeppelin"})
+        data = json.loads(res.data.decode('utf-8'))
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([item['id'] for item in data['questions']],
+                         [question_id])
+
+        # check the deleted question is removed from the index
+        question.delete()
+        res = self.client().post('/questions',
+                                 json={'searchTerm': "zeppelin"})
+        self.assertEqual(res.status_code, 404)
+
+    def test_search_index_rebuilds_after_other_writes(self):
+        with self.app.app_context():
+            search_index.invalidate()
+            search_index.ranked(['petra'])
+
+            # writes of this process keep the index at the current version
+            question = Question(question="Which zeppelinx flew first?",
+                                answer="LZ 1", category=4, difficulty=2)
+            question.insert()
+            self.assertEqual(search_index.version,
+                             read_versions(['questions'])['questions'][0])
+            question.delete()
+
+            # a question written by another process, without ORM events
+            table = Question.__table__
+            with db.engine.begin() as connection:
+                question_id = connection.execute(table.insert().values(
+                    question='Where is Petra?', answer='Jordan', category=4,
+                    difficulty=2)).inserted_primary_key[0]
+                bump_versions(connection, ['questions', 'category:4'])
+            try:
+                check_interval = search_index.check_interval
+                search_index.check_interval = 0
+                try:
+                    self.assertIn(question_id, search_index.ranked(['petra']))
+                finally:
+                    search_index.check_interval = check_interval
+            finally:
+                with db.engine.begin() as connection:
+                    connection.execute(table.delete().where(
+                        table.c.id == question_id))
+                    bump_versions(connection, ['questions', 'category:4'])
+
+    def test_search_index_keeps_writes_made_during_a_rebuild(self):
+        written = []
+
+        # a write of another thread lands while the rows are loaded
+        def write(connection, cursor, statement, *args):
+            if 'questions.question' in statement and len(written) == 0:
+                written.append(True)
+                search_index.add(999999, 'Which zeppelinx flew first?')
+
+        with self.app.app_context():
+            event.listen(db.engine, 'after_cursor_execute', write)
+            try:
+                search_index.build()
+            finally:
+                event.remove(db.engine, 'after_cursor_execute', write)
+            try:
+                self.assertEqual(written, [True])
+                self.assertEqual(search_index.ranked(['zeppelinx']),
+                                 [999999])
+            finally:
+                search_index.remove(999999)
+
+    def wait_for_search_index(self):
+        warmer = search_index.warm(self.app)
+        if warmer is not None:
+            warmer.join()
+
+    def test_suggestions_complete_the_last_word(self):
+        question = Question(question="Which zeppelinx flew first?",
+                            answer="LZ 1", category=4, difficulty=2)
+        question.insert()
+        self.wait_for_search_index()
+        try:
+            res = self.client().get('/questions/suggestions?q=which+zep')
+            data = json.loads(res.data.decode('utf-8'))
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(data['suggestions'],
+                             [{'text': 'which zeppelinx', 'questions': 1}])
+        finally:
+            question.delete()
+
+        # check deleted questions are not suggested, nor short prefixes
+        res = self.client().get('/questions/suggestions?q=zep')
+        self.assertEqual(json.loads(res.data)['suggestions'], [])
+        res = self.client().get('/questions/suggestions?q=t')
+        self.assertEqual(json.loads(res.data)['suggestions'], [])
+        res = self.client().get('/questions/suggestions?q=ti&limit=0')
+        self.assertEqual(res.status_code, 400)
+
+    def test_suggestions_wait_for_no_index_build(self):
+        question = Question(question="Which zeppelinx flew first?",
+                            answer="LZ 1", category=4, difficulty=2)
+        question.insert()
+        try:
+            # check a request only starts the build and suggests nothing
+            search_index.invalidate()
+            loads = []
+
+            def load(connection, cursor, statement, *args):
+                if 'questions.question' in statement:
+                    loads.append(threading.current_thread().name)
+            with self.app.app_context():
+                event.listen(db.engine, 'after_cursor_execute', load)
+                try:
+                    res = self.client().get(
+                        '/questions/suggestions?q=which+zep')
+                    self.assertEqual(res.get_json()['suggestions'], [])
+                    self.wait_for_search_index()
+                finally:
+                    event.remove(db.engine, 'after_cursor_execute', load)
+            self.assertEqual(loads, ['search-index'])
+
+            res = self.client().get('/questions/suggestions?q=which+zep')
+            self.assertEqual(res.get_json()['suggestions'],
+                             [{'text': 'which zeppelinx', 'questions': 1}])
+        finally:
+            question.delete()
+
+    def test_search_question_ranked_and_paginated(self):
+        res = self.client().post('/questions', json={'searchTerm': "the",
+                                                     'page': 1})
+        data = json.loads(res.data.decode('utf-8'))
+        self.assertEqual(res.status_code, 200)
+
+        # check the page size and that total counts every match
+        self.assertLessEqual(len(data['questions']), 10)
+        self.assertGreaterEqual(data['total_questions'],
+                                len(data['questions']))
+
+    def test_search_question_substring_mode(self):
+
+        # "ere" is only found inside words, so only substring mode matches
+        res = self.client().post('/questions', json={'searchTerm': "ere",
+                                                     'mode': "substring"})
+        data = json.loads(res.data.decode('utf-8'))
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data['questions'])
+        res = self.client().post('/questions', json={'searchTerm': "ere"})
+        self.assertEqual(res.status_code, 404)
+
+    def test_400_search_unknown_mode(self):
+        res = self.client().post('/questions', json={'searchTerm': "title",
+                                                     'mode': "fuzzy"})
+        data = json.loads(res.data.decode('utf-8'))
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+
     def test_404_search_wrong_question(self):
 
         # create search_term to be used as json
@@ -222,6 +1052,56 @@ class TriviaTestCase(unittest.TestCase):
         # check that current_category equal to category id
         self.assertEqual(data['current_category'], category_id)
 
+    def test_question_rows_format_like_questions(self):
+        with self.app.app_context():
+            questions = Question.query.order_by(Question.id).all()
+            rows = Question.rows().order_by(Question.id).all()
+            self.assertEqual(json.dumps([Question.format_row(row)
+                                         for row in rows]),
+                             json.dumps([question.format()
+                                         for question in questions]))
+
+    def test_stream_questions_by_category(self):
+        res = self.client().get('/categories/1/questions')
+        data = json.loads(res.data.decode('utf-8'))
+
+        # check the streamed JSON has the same content
+        res = self.client().get('/categories/1/questions?stream=json')
+        streamed = json.loads(res.data.decode('utf-8'))
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(streamed['success'], True)
+        self.assertEqual(streamed['current_category'], 1)
+        self.assertEqual(streamed['total_questions'],
+                         data['total_questions'])
+        self.assertEqual(sorted(streamed['questions'],
+                                key=lambda item: item['id']),
+                         sorted(data['questions'],
+                                key=lambda item: item['id']))
+
+    def test_stream_questions_by_category_as_ndjson(self):
+        res = self.client().get('/categories/1/questions?stream=ndjson')
+        lines = [json.loads(line) for line in
+                 res.data.decode('utf-8').splitlines()]
+        self.assertEqual(res.status_code, 200)
+
+        # check the envelope line then one line per question
+        self.assertEqual(lines[0]['current_category'], 1)
+        self.assertEqual(len(lines) - 1, lines[0]['total_questions'])
+
+    def test_stream_search_question(self):
+        res = self.client().post('/questions?stream=json',
+                                 json={'searchTerm': "title"})
+        data = json.loads(res.data.decode('utf-8'))
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(len(data['questions']), data['total_questions'])
+        self.assertEqual(data['current_category'],
+                         [item['category'] for item in data['questions']])
+
+    def test_400_stream_unknown_format(self):
+        res = self.client().get('/categories/1/questions?stream=xml')
+        self.assertEqual(res.status_code, 400)
+
     def test_404_requesting_questions_of_wrong_category(self):
 
         # assume category_id = 0(value not found in db) to e used in testing
@@ -245,6 +1125,794 @@ class TriviaTestCase(unittest.TestCase):
         # check questions and total_questions return data
         self.assertTrue(data['question'])
 
+    def test_get_questions_to_play_skips_previous_questions(self):
+
+        # exclude every science question but one
+        ids = [question.id for question in
+               Question.query.filter(Question.category == '1').all()]
+        my_json = {'previous_questions': ids[1:],
+                   "quiz_category": {'type': 'Science', 'id': 1}}
+        res = self.client().post('/quizzes', json=my_json)
+        data = json.loads(res.data.decode('utf-8'))
+        self.assertEqual(res.status_code, 200)
+
+        # check the only unseen question is the one returned
+        self.assertEqual(data['question']['id'], ids[0])
+
+    def test_get_questions_to_play_exhausted_pool(self):
+
+        # exclude every question of all categories
+        ids = [question.id for question in Question.query.all()]
+        my_json = {'previous_questions': ids,
+                   "quiz_category": {'type': 'click', 'id': 0}}
+        res = self.client().post('/quizzes', json=my_json)
+        data = json.loads(res.data.decode('utf-8'))
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+
+        # check no question is returned when all were played
+        self.assertEqual(data['question'], None)
+
+    def test_question_pools_follow_writes(self):
+        with self.app.app_context():
+            pool = question_pool.ids(3)
+            everything = question_pool.ids(0)
+        self.assertEqual(pool.itemsize, 4)
+        self.assertEqual(list(pool), sorted(pool))
+
+        # check writes of this process update the cached arrays in place
+        question = Question(question="Where is Petra?", answer="Jordan",
+                            category=3, difficulty=2)
+        question.insert()
+        question_id = question.id
+        try:
+            self.assertIs(question_pool.cached(3), pool)
+            self.assertIn(question_id, pool)
+            self.assertIn(question_id, everything)
+        finally:
+            question.delete()
+        self.assertIs(question_pool.cached(3), pool)
+        self.assertNotIn(question_id, pool)
+        self.assertNotIn(question_id, everything)
+
+    def test_question_pools_reload_after_other_writes(self):
+        with self.app.app_context():
+            pool = question_pool.ids(4)
+
+            # a question written by another process, without ORM events
+            table = Question.__table__
+            with db.engine.begin() as connection:
+                question_id = connection.execute(table.insert().values(
+                    question='Where is Petra?', answer='Jordan', category=4,
+                    difficulty=2)).inserted_primary_key[0]
+                bump_versions(connection, ['questions', 'category:4'])
+            try:
+                check_interval = question_pool.check_interval
+                question_pool.check_interval = 0
+                try:
+                    self.assertIn(question_id, question_pool.ids(4))
+                finally:
+                    question_pool.check_interval = check_interval
+                self.assertNotIn(question_id, pool)
+            finally:
+                with db.engine.begin() as connection:
+                    connection.execute(table.delete().where(
+                        table.c.id == question_id))
+                    bump_versions(connection, ['questions', 'category:4'])
+
+    def test_play_quiz_session(self):
+
+        # create a session for science questions
+        res = self.client().post('/quizzes/sessions', json={
+            "quiz_category": {'type': 'Science', 'id': 1}})
+        data = json.loads(res.data.decode('utf-8'))
+        self.assertEqual(res.status_code, 200)
+        session_id = data['session_id']
+        total = data['total_questions']
+        self.assertEqual(total, Question.query.
+                         filter(Question.category == '1').count())
+
+        # check every turn returns a new question until the deck is empty
+        seen = set()
+        for _ in range(total):
+            res = self.client().post('/quizzes/sessions/{}/next'.
+                                     format(session_id))
+            data = json.loads(res.data.decode('utf-8'))
+            self.assertNotIn(data['question']['id'], seen)
+            seen.add(data['question']['id'])
+        res = self.client().post('/quizzes/sessions/{}/next'.
+                                 format(session_id))
+        data = json.loads(res.data.decode('utf-8'))
+        self.assertEqual(data['question'], None)
+
+        # check ending the session removes it
+        res = self.client().delete('/quizzes/sessions/{}'.format(session_id))
+        self.assertEqual(res.status_code, 200)
+        res = self.client().post('/quizzes/sessions/{}/next'.
+                                 format(session_id))
+        self.assertEqual(res.status_code, 404)
+
+    def test_quiz_session_store_evicts_least_recently_used(self):
+        store = MemorySessionStore(max_sessions=2)
+        sessions = [QuizSession(1, []) for _ in range(3)]
+        store.add(sessions[0])
+        store.add(sessions[1])
+
+        # touch the first session so the second one is evicted
+        store.get(sessions[0].id)
+        store.add(sessions[2])
+        self.assertEqual(len(store), 2)
+        self.assertIsNone(store.get(sessions[1].id))
+        self.assertIs(store.get(sessions[0].id), sessions[0])
+
+    def test_quiz_sessions_in_a_serializing_store(self):
+
+        # like a Redis or database store, it keeps copies of the sessions
+        class PickleSessionStore:
+            def __init__(self):
+                self.sessions = {}
+
+            def get(self, session_id):
+                data = self.sessions.get(session_id)
+                return pickle.loads(data) if data is not None else None
+
+            def add(self, session):
+                self.sessions[session.id] = pickle.dumps(session)
+
+            save = add
+
+            def remove(self, session_id):
+                return self.sessions.pop(session_id, None) is not None
+
+        client = self.create_test_app(
+            {'QUIZ_SESSION_STORE': PickleSessionStore()}).test_client
+        res = client().post('/quizzes/sessions',
+                            json={'quiz_category': {'id': 1}})
+        data = json.loads(res.data.decode('utf-8'))
+        session_id = data['session_id']
+
+        # check every turn plays another question of the deck
+        seen = set()
+        for played in range(1, data['total_questions'] + 1):
+            res = client().post('/quizzes/sessions/{}/next'.
+                                format(session_id))
+            data = json.loads(res.data.decode('utf-8'))
+            self.assertEqual(data['played'], played)
+            self.assertNotIn(data['question']['id'], seen)
+            seen.add(data['question']['id'])
+
+    @unittest.skipIf(asyncpg is None, 'the ASGI mode needs asyncpg')
+    def test_asgi_app_serves_the_same_json(self):
+        # without the response cache, so the native routes render
+        asgi_app = create_asgi_app(
+            wsgi_app=self.create_test_app({'RESPONSE_CACHE': None}))
+        with self.app.app_context():
+            played = Question.query.filter(Question.category == 1).\
+                order_by(Question.id).first().id
+            db.session.add(QuestionStats(played, 4, 3))
+            db.session.commit()
+        try:
+            for path, query in [('/categories', b''),
+                                ('/questions', b'page=2'),
+                                ('/questions', b'after=5&limit=3'),
+                                ('/categories/1/questions', b''),
+                                ('/categories/12345/questions', b''),
+                                ('/questions', b'page=1&stats=true'),
+                                ('/questions', b'after=5&limit=3&stats=1'),
+                                ('/categories/1/questions', b'stats=true')]:
+                res = self.client().get(path + '?' + query.decode())
+
+                # check status and bytes match the Flask views
+                status, body = asgi_request(asgi_app, 'GET', path, query)
+                self.assertEqual(status, res.status_code)
+                self.assertEqual(json.loads(body.decode('utf-8')),
+                                 json.loads(res.data.decode('utf-8')))
+        finally:
+            with self.app.app_context():
+                QuestionStats.query.filter(
+                    QuestionStats.question_id == played).delete()
+                db.session.commit()
+
+    @unittest.skipIf(asyncpg is None, 'the ASGI mode needs asyncpg')
+    def test_asgi_app_sends_the_same_cache_headers(self):
+        asgi_app = create_asgi_app(
+            wsgi_app=self.create_test_app({'RESPONSE_CACHE': None}))
+        for path, query in [('/categories', b''), ('/questions', b'page=1'),
+                            ('/categories/1/questions', b'')]:
+            res = self.client().get(path + '?' + query.decode(),
+                                    headers={'Accept-Encoding': 'gzip'})
+
+            # check the ETag, compression and Vary match the Flask views
+            status, headers, body = asgi_response(
+                asgi_app, 'GET', path, query,
+                headers=[('Accept-Encoding', 'gzip')])
+            self.assertEqual(status, 200)
+            for name in ('ETag', 'Last-Modified', 'Cache-Control', 'Vary',
+                         'Content-Encoding'):
+                self.assertEqual(headers.get(name.lower()),
+                                 res.headers.get(name))
+            expected = res.data
+            if 'content-encoding' in headers:
+                body, expected = gzip.decompress(body), \
+                    gzip.decompress(expected)
+            self.assertEqual(json.loads(body.decode('utf-8')),
+                             json.loads(expected.decode('utf-8')))
+
+            # check a matching If-None-Match is answered with 304
+            status, _, body = asgi_response(
+                asgi_app, 'GET', path, query, headers=[
+                    ('Accept-Encoding', 'gzip'),
+                    ('If-None-Match', res.headers['ETag'])])
+            self.assertEqual(status, 304)
+            self.assertEqual(body, b'')
+
+    @unittest.skipIf(asyncpg is None, 'the ASGI mode needs asyncpg')
+    def test_asgi_app_shares_the_response_cache(self):
+        asgi_app = create_asgi_app(wsgi_app=self.app)
+        response_cache = self.app.extensions['response_cache']
+        self.client().get('/categories/2/questions')
+        hits = response_cache.hits
+
+        # check the native route is served what the Flask view rendered
+        status, body = asgi_request(asgi_app, 'GET',
+                                    '/categories/2/questions')
+        self.assertEqual(status, 200)
+        self.assertEqual(response_cache.hits, hits + 1)
+
+    @unittest.skipIf(asyncpg is None, 'the ASGI mode needs asyncpg')
+    def test_asgi_app_times_native_routes(self):
+        app = self.create_test_app({'METRICS': True, 'RESPONSE_CACHE': None})
+        asgi_app = create_asgi_app(wsgi_app=app)
+        passed = []
+        call_wsgi = asgi_app.call_wsgi
+        asgi_app.call_wsgi = lambda scope, *args: \
+            passed.append(scope['path']) or call_wsgi(scope, *args)
+
+        # check the native route sends its timings and records them
+        status, headers, _ = asgi_response(asgi_app, 'GET',
+                                           '/categories/1/questions')
+        self.assertEqual(status, 200)
+        self.assertRegex(headers['server-timing'],
+                         r'^db;desc="2 SQL statements";dur=')
+        status, _, body = asgi_response(asgi_app, 'GET', '/metrics')
+        self.assertEqual(passed, ['/metrics'])
+        self.assertIn('trivia_request_db_queries_count{route='
+                      '"/categories/<int:category_id>/questions",'
+                      'method="GET",status="200"} 1', body.decode('utf-8'))
+
+    @unittest.skipIf(asyncpg is None, 'the ASGI mode needs asyncpg')
+    def test_asgi_app_reads_from_replicas(self):
+        # the test database again under another name, and one that is down
+        live = self.database_path.replace('localhost', '127.0.0.1')
+        dead = self.database_path.replace('localhost:5432', '127.0.0.1:1')
+        app = self.create_test_app({'RESPONSE_CACHE': None,
+                                    'DATABASE_REPLICA_URLS': [dead, live]})
+        asgi_app = create_asgi_app(wsgi_app=app)
+        replicas = app.extensions['replicas']
+        connected = []
+        connect = asgi_app.connect
+        asgi_app.connect = lambda replica=None: \
+            connected.append(replica) or connect(replica)
+
+        # check a client that wrote recently reads from the primary
+        status, _, _ = asgi_response(
+            asgi_app, 'GET', '/categories',
+            headers=[('Cookie', '{}={}'.format(READ_PRIMARY_COOKIE,
+                                               time.time() + 60))])
+        self.assertEqual(status, 200)
+        self.assertEqual(connected, [None])
+
+        # check the replica that is down is skipped and taken out
+        del connected[:]
+        for _ in range(2):
+            status, _, _ = asgi_response(asgi_app, 'POST', '/quizzes',
+                                         body=json.dumps({
+                                             'previous_questions': [],
+                                             'quiz_category': {'id': 1}
+                                         }).encode())
+            self.assertEqual(status, 200)
+        self.assertEqual(connected, replicas.engines + [replicas.engines[1]])
+        self.assertEqual([replica['healthy'] for replica in
+                          replicas.stats()], [False, True])
+
+    @unittest.skipIf(asyncpg is None, 'the ASGI mode needs asyncpg')
+    def test_asgi_app_logs_native_errors(self):
+        app = self.create_test_app({'RESPONSE_CACHE': None})
+        asgi_app = create_asgi_app(wsgi_app=app)
+
+        async def broken():
+            raise RuntimeError('broken')
+        asgi_app.all_categories = broken
+
+        with self.assertLogs(app.logger, 'ERROR') as logs:
+            status, _, body = asgi_response(asgi_app, 'GET', '/categories')
+        self.assertEqual(status, 500)
+        self.assertEqual(json.loads(body)['message'],
+                         'Internal Server Error!')
+        self.assertIn('Exception on /categories [GET]', logs.output[0])
+        self.assertIn('RuntimeError: broken', logs.output[0])
+
+    @unittest.skipIf(asyncpg is None, 'the ASGI mode needs asyncpg')
+    def test_asgi_app_applies_admission_control(self):
+        app = self.create_test_app({
+            'ADMISSION_LIMITS': 'get_random_quiz_question=1',
+            'ADMISSION_QUEUE_SIZE': 0})
+        asgi_app = create_asgi_app(wsgi_app=app)
+        limit = app.extensions['admission'].limits['get_random_quiz_question']
+        body = json.dumps({'previous_questions': [],
+                           'quiz_category': {'id': 0}}).encode()
+
+        # check a quiz turn over the limit is shed like in the Flask app
+        self.assertTrue(limit.acquire())
+        try:
+            status, headers, _ = asgi_response(asgi_app, 'POST', '/quizzes',
+                                               body=body)
+        finally:
+            limit.release()
+        self.assertEqual(status, 503)
+        self.assertEqual(headers['retry-after'], '1')
+
+        status, _, _ = asgi_response(asgi_app, 'POST', '/quizzes', body=body)
+        self.assertEqual(status, 200)
+        self.assertEqual(limit.stats()['active'], 0)
+        self.assertEqual(limit.stats()['admitted'], 2)
+
+    @unittest.skipIf(asyncpg is None, 'the ASGI mode needs asyncpg')
+    def test_asgi_app_applies_the_rate_limit(self):
+        app = self.create_test_app({'RATE_LIMIT': 0.5, 'RATE_LIMIT_BURST': 1})
+        asgi_app = create_asgi_app(wsgi_app=app)
+        status, _, _ = asgi_response(asgi_app, 'GET', '/categories')
+        self.assertEqual(status, 200)
+        status, headers, _ = asgi_response(asgi_app, 'GET', '/categories')
+        self.assertEqual(status, 429)
+        self.assertEqual(headers['retry-after'], '2')
+
+    @unittest.skipIf(asyncpg is None, 'the ASGI mode needs asyncpg')
+    def test_asgi_app_quiz_and_passed_through_routes(self):
+        asgi_app = create_asgi_app(wsgi_app=self.app)
+        my_json = {'previous_questions': [],
+                   "quiz_category": {'type': 'Science', 'id': '1'}}
+        status, body = asgi_request(asgi_app, 'POST', '/quizzes',
+                                    body=json.dumps(my_json).encode())
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(body.decode('utf-8'))['question']
+                         ['category'], 1)
+
+        # check search is served by the Flask app through the bridge
+        status, body = asgi_request(asgi_app, 'POST', '/questions',
+                                    body=b'{"searchTerm": "title"}')
+        self.assertEqual(status, 200)
+        self.assertTrue(json.loads(body.decode('utf-8'))['questions'])
+
+        status, body = asgi_request(asgi_app, 'POST', '/quizzes',
+                                    body=b'{"quiz_category": ""}')
+        self.assertEqual(status, 400)
+
+    def stream_forever(self, closed):
+        def chunks():
+            try:
+                while True:
+                    yield b'x' * 1024
+            finally:
+                closed.set()
+        self.app.add_url_rule('/forever', 'forever',
+                              lambda: Response(chunks()))
+
+    def test_asgi_bridge_stops_when_the_client_goes(self):
+        closed = threading.Event()
+        self.stream_forever(closed)
+        asgi_app = create_asgi_app(wsgi_app=self.app)
+        messages = []
+        received = []
+
+        async def receive():
+            if len(received) == 0:
+                received.append(True)
+                return {'type': 'http.request', 'body': b''}
+            while len(messages) < 3:
+                await asyncio.sleep(0.01)
+            return {'type': 'http.disconnect'}
+
+        async def send(message):
+            messages.append(message)
+
+        scope = {'type': 'http', 'method': 'GET', 'path': '/forever',
+                 'query_string': b'', 'headers': []}
+        asyncio.run(asyncio.wait_for(asgi_app(scope, receive, send), 5))
+
+        # check the response iterable is closed and nothing more is sent
+        self.assertTrue(closed.wait(5))
+        self.assertTrue(messages[-1]['more_body'])
+
+    def test_asgi_bridge_drops_a_client_that_stopped_reading(self):
+        closed = threading.Event()
+        self.stream_forever(closed)
+        self.app.config['ASGI_SEND_TIMEOUT'] = 0.1
+        asgi_app = create_asgi_app(wsgi_app=self.app)
+        messages = []
+        received = []
+
+        async def receive():
+            if len(received) == 0:
+                received.append(True)
+                return {'type': 'http.request', 'body': b''}
+            await asyncio.Event().wait()
+
+        async def send(message):
+            messages.append(message)
+            if message['type'] == 'http.response.body':
+                await asyncio.sleep(0.5)
+
+        scope = {'type': 'http', 'method': 'GET', 'path': '/forever',
+                 'query_string': b'', 'headers': []}
+        asyncio.run(asyncio.wait_for(asgi_app(scope, receive, send), 5))
+        self.assertTrue(closed.wait(5))
+        self.assertEqual(len(messages), 2)
+
+    def test_benchmark_regressions_against_baseline(self):
+        baseline = {'search': {'p50_ms': 10.0, 'p90_ms': 20.0, 'queries': 2}}
+        results = {'search': {'p50_ms': 12.0, 'p90_ms': 20.2, 'queries': 2}}
+        self.assertEqual(regressions(results, baseline, 0.25), [])
+
+        results['search'].update({'p50_ms': 13.0, 'queries': 3})
+        messages = regressions(results, baseline, 0.25)
+        self.assertEqual(len(messages), 2)
+        self.assertTrue(messages[0].startswith('search: p50_ms'))
+        self.assertEqual(messages[1], 'search: queries 3 > 2')
+
+    def test_reads_go_to_replica_and_writes_to_primary(self):
+        directory = tempfile.mkdtemp()
+        primary, replica = ['sqlite:///' + os.path.join(directory, name)
+                            for name in ('primary.db', 'replica.db')]
+        for url, name in [(primary, 'Primary'), (replica, 'Replica')]:
+            engine = create_engine(url)
+            db.Model.metadata.create_all(engine)
+            engine.execute(Category.__table__.insert().values(type=name))
+        app = create_app({'RESPONSE_CACHE': None,
+                          'DATABASE_REPLICA_URLS': replica})
+        setup_db(app, primary)
+        category_cache.invalidate()
+        try:
+            client = app.test_client()
+            data = json.loads(client.get('/categories').data)
+            self.assertEqual(data['categories'], {'1': 'Replica'})
+
+            # check the write went to the primary and the writer reads it
+            res = client.post('/questions', json={
+                'question': 'Where?', 'answer': 'Here', 'category': 1,
+                'difficulty': 1})
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(client.get('/questions?page=1').status_code,
+                             200)
+            res = app.test_client().get('/questions?page=1')
+            self.assertEqual(res.status_code, 404)
+        finally:
+            category_cache.invalidate()
+            search_index.invalidate()
+            question_pool.invalidate()
+
+    def test_replica_set_skips_failed_replicas(self):
+        directory = tempfile.mkdtemp()
+        dead = create_engine('sqlite:///' + os.path.join(directory, 'no',
+                                                         'replica.db'))
+        replicas = ReplicaSet([dead], retry_interval=60)
+        self.assertIs(replicas.engine(), dead)
+
+        # check a failed connection takes the replica out, until a probe
+        with self.assertRaises(Exception):
+            dead.connect()
+        self.assertIsNone(replicas.engine())
+        self.assertEqual(replicas.stats()[0]['healthy'], False)
+        os.mkdir(os.path.join(directory, 'no'))
+        replicas.retry_interval = 0
+        replicas.mark_down(dead)
+        self.assertIs(replicas.engine(), dead)
+        self.assertEqual(replicas.stats()[0]['healthy'], True)
+
+    def test_quiz_answers_are_written_behind(self):
+        app = self.create_test_app({'ANSWER_FLUSH_INTERVAL': 60})
+        recorder = app.extensions['answers']
+        question = Question(question="Where is Petra?", answer="Jordan",
+                            category=3, difficulty=2)
+        question.insert()
+        question_id = question.id
+        try:
+            client = app.test_client()
+            res = client.post('/quizzes/answers', json={'answers': [
+                {'question_id': question_id, 'correct': True},
+                {'question_id': question_id, 'correct': False}]})
+            self.assertEqual(res.status_code, 202)
+            self.assertEqual(json.loads(res.data)['recorded'], 2)
+            client.post('/quizzes/answers', json={'question_id': question_id,
+                                                  'correct': True})
+
+            # check the answers are written on flush, summed per question
+            self.assertEqual(recorder.stats()['written'], 0)
+            self.assertEqual(recorder.flush(), 3)
+            path = '/questions?after={}&limit=1'.format(question_id - 1)
+            data = json.loads(client.get(path + '&stats=true').data)
+            self.assertEqual(data['questions'][0]['stats'], {
+                'plays': 3, 'correct': 2, 'correct_rate': 0.667})
+            data = json.loads(client.get(path).data)
+            self.assertNotIn('stats', data['questions'][0])
+
+            # check the next flush adds to the counts and the cached page
+            client.post('/quizzes/answers', json={'question_id': question_id,
+                                                  'correct': True})
+            recorder.flush()
+            data = json.loads(client.get(path + '&stats=true').data)
+            self.assertEqual(data['questions'][0]['stats']['plays'], 4)
+        finally:
+            question.delete()
+        with app.app_context():
+            self.assertIsNone(QuestionStats.query.get(question_id))
+
+    def test_quiz_answers_back_pressure(self):
+        directory = tempfile.mkdtemp()
+        url = 'sqlite:///' + os.path.join(directory, 'answers.db')
+        engine = create_engine(url)
+        db.Model.metadata.create_all(engine)
+        engine.execute(Question.__table__.insert().values(
+            question='Where?', answer='Here', difficulty=1))
+        app = create_app({'RESPONSE_CACHE': None, 'ANSWER_QUEUE_SIZE': 2,
+                          'ANSWER_FLUSH_INTERVAL': 60,
+                          'ANSWER_QUEUE_TIMEOUT': 0})
+        setup_db(app, url)
+        recorder = app.extensions['answers']
+        client = app.test_client()
+        try:
+            # the worker can't drain the queue while a flush is running
+            with recorder._flush_lock:
+                res = client.post('/quizzes/answers', json={'answers': [
+                    {'question_id': 1, 'correct': True},
+                    {'question_id': 999, 'correct': True},
+                    {'question_id': 1, 'correct': False}]})
+                data = json.loads(res.data)
+                self.assertEqual(res.status_code, 202)
+                self.assertEqual((data['recorded'], data['dropped']), (2, 1))
+                res = client.post('/quizzes/answers', json={
+                    'question_id': 1, 'correct': True})
+                self.assertEqual(res.status_code, 503)
+                self.assertEqual(json.loads(res.data)['error'], 503)
+
+            # check answers to unknown questions are dropped when written
+            recorder.flush()
+            self.assertEqual(recorder.stats()['written'], 1)
+            self.assertEqual(recorder.stats()['dropped'], 2)
+            recorder.record(1, True)
+            recorder.flush()
+            self.assertEqual(engine.execute(
+                QuestionStats.__table__.select()).fetchall(), [(1, 2, 2)])
+        finally:
+            recorder.close()
+            search_index.invalidate()
+            question_pool.invalidate()
+
+    def test_admission_sheds_load_with_503(self):
+        app = self.create_test_app({
+            'ADMISSION_LIMITS': {'search_question': 1},
+            'ADMISSION_QUEUE_SIZE': 0, 'RESPONSE_CACHE': None})
+        limit = app.extensions['admission'].limits['search_question']
+        client = app.test_client()
+        search = {'searchTerm': 'title'}
+
+        # check a search over the limit fails fast, other routes still run
+        self.assertTrue(limit.acquire())
+        try:
+            res = client.post('/questions', json=search)
+            self.assertEqual(res.status_code, 503)
+            self.assertEqual(res.headers['Retry-After'], '1')
+            self.assertEqual(json.loads(res.data)['error'], 503)
+            self.assertEqual(client.get('/questions?page=1').status_code,
+                             200)
+        finally:
+            limit.release()
+        self.assertEqual(client.post('/questions', json=search).status_code,
+                         200)
+
+        stats = json.loads(client.get('/stats/admission').data)
+        self.assertEqual(stats['admission']['endpoints']['search_question']
+                         ['rejected'], 1)
+        self.assertEqual(stats['admission']['endpoints']['search_question']
+                         ['active'], 0)
+
+    def test_admission_queue_waits_for_a_turn(self):
+        limit = ConcurrencyLimit('search_question', 1, queue_size=1,
+                                 timeout=5)
+        self.assertTrue(limit.acquire())
+        results = []
+        waiter = threading.Thread(target=lambda: results.append(
+            limit.acquire()))
+        waiter.start()
+        while limit.waiting == 0:
+            time.sleep(0.001)
+
+        # check the queue is bounded, and a released turn goes to the waiter
+        self.assertFalse(limit.acquire())
+        limit.release()
+        waiter.join()
+        self.assertEqual(results, [True])
+        limit.timeout = 0.01
+        self.assertFalse(limit.acquire())
+        self.assertEqual((limit.admitted, limit.queued, limit.rejected,
+                          limit.timed_out), (2, 2, 1, 1))
+
+    def test_429_rate_limit_per_client(self):
+        client = self.create_test_app({'RATE_LIMIT': 1,
+                                       'RATE_LIMIT_BURST': 2}).test_client()
+        self.assertEqual(client.get('/categories').status_code, 200)
+        self.assertEqual(client.get('/categories').status_code, 200)
+        res = client.get('/categories')
+        self.assertEqual(res.status_code, 429)
+        self.assertEqual(res.headers['Retry-After'], '1')
+        self.assertEqual(json.loads(res.data)['error'], 429)
+
+        # check other clients have their own bucket
+        res = client.get('/categories',
+                         environ_base={'REMOTE_ADDR': '10.0.0.2'})
+        self.assertEqual(res.status_code, 200)
+
+    def test_changes_since_version(self):
+        client = self.create_test_app({'RESPONSE_CACHE': None}).test_client
+        start = json.loads(client().get('/changes').data)['version']
+        kept = Question(question="Where is Petra?", answer="Syria",
+                        category=3, difficulty=2)
+        kept.insert()
+        kept_id = kept.id
+        gone = Question(question="Where is Uluru?", answer="Australia",
+                        category=3, difficulty=2)
+        gone.insert()
+        gone_id = gone.id
+        middle = json.loads(client().get('/changes').data)['version']
+
+        # the request ended the session of the objects, load them again
+        with self.app.app_context():
+            kept = Question.query.get(kept_id)
+            kept.answer = "Jordan"
+            kept.update()
+            Question.query.get(gone_id).delete()
+        category = Category(type="Music")
+        category.insert()
+        category_id = category.id
+        try:
+            # check rows written since a version come in their final state
+            data = json.loads(client().get(
+                '/changes?since={}'.format(start)).data)
+            self.assertEqual(data['questions']['inserted'], [{
+                'id': kept_id, 'question': "Where is Petra?",
+                'answer': "Jordan", 'category': 3, 'difficulty': 2}])
+            self.assertEqual(data['questions']['updated'], [])
+            self.assertEqual(data['questions']['deleted'], [])
+            self.assertEqual(data['categories']['inserted'],
+                             {str(category_id): "Music"})
+            self.assertFalse(data['more'])
+            data = json.loads(client().get(
+                '/changes?since={}'.format(middle)).data)
+            self.assertEqual([question['id'] for question
+                              in data['questions']['updated']], [kept_id])
+            self.assertEqual(data['questions']['deleted'], [gone_id])
+
+            # check pages end at a version clients ask from next
+            data = json.loads(client().get(
+                '/changes?since={}&limit=1'.format(start)).data)
+            self.assertTrue(data['more'])
+            self.assertEqual(data['version'], start + 1)
+        finally:
+            client().post('/questions/delete', json={'ids': [kept_id]})
+            category.delete()
+        data = json.loads(client().get(
+            '/changes?since={}'.format(middle)).data)
+        self.assertEqual(data['questions']['deleted'], [kept_id, gone_id])
+        self.assertEqual(data['categories']['inserted'], {})
+        latest = json.loads(client().get('/changes').data)['version']
+        self.assertEqual(data['version'], latest)
+
+    def test_changes_of_a_deleted_category(self):
+        client = self.create_test_app({'RESPONSE_CACHE': None}).test_client
+        category = Category(type="Music")
+        category.insert()
+        category_id = category.id
+        question = Question(question="Who wrote Bolero?", answer="Ravel",
+                            category=category_id, difficulty=2)
+        question.insert()
+        question_id = question.id
+        start = json.loads(client().get('/changes').data)['version']
+        with self.app.app_context():
+            Category.query.get(category_id).delete()
+        try:
+            # check the questions the foreign key moved out are logged too
+            data = json.loads(client().get(
+                '/changes?since={}'.format(start)).data)
+            self.assertEqual(data['categories']['deleted'], [category_id])
+            self.assertEqual([(changed['id'], changed['category'])
+                              for changed in data['questions']['updated']],
+                             [(question_id, None)])
+        finally:
+            client().post('/questions/delete', json={'ids': [question_id]})
+
+    def test_410_changes_after_prune(self):
+        client = self.client
+        for answer in ("Jordan", "Petra"):
+            question = Question(question="Where is Petra?", answer=answer,
+                                category=3, difficulty=2)
+            question.insert()
+            client().post('/questions/delete', json={'ids': [question.id]})
+        latest = json.loads(client().get('/changes').data)['version']
+        since = '/changes?since={}'.format(latest - 2)
+        self.assertEqual(client().get(since).status_code, 200)
+
+        # check pages cached before the prune are not served after it
+        with self.app.app_context():
+            self.assertGreater(prune_changes(days=-1), 0)
+        self.assertEqual(client().get(since).status_code, 410)
+
+    def test_version_counters_are_seeded(self):
+        table = ContentVersion.__table__
+        names = ['changes', 'question_stats']
+        with self.app.app_context():
+            before = read_versions(names)
+            with db.engine.begin() as connection:
+                connection.execute(table.delete().where(
+                    table.c.name.in_(names)))
+            try:
+                # check create_tables() seeds the counters it didn't create
+                create_tables(self.app)
+                rows = db.session.execute(table.select().where(
+                    table.c.name.in_(names))).fetchall()
+                self.assertEqual({(row.name, row.version) for row in rows},
+                                 {('changes', 0), ('question_stats', 0)})
+                db.session.commit()
+
+                # check a write seeds the counter that orders the log
+                with db.engine.begin() as connection:
+                    connection.execute(table.delete().where(
+                        table.c.name == 'changes'))
+                category = Category(type="Music")
+                category.insert()
+                category.delete()
+                version = db.session.query(ContentVersion.version).filter(
+                    ContentVersion.name == 'changes').scalar()
+                self.assertEqual(version, 2)
+            finally:
+                # later than any cached version, so no ETag is reused
+                with db.engine.begin() as connection:
+                    for name in names:
+                        connection.execute(table.update().where(
+                            table.c.name == name).values(
+                            version=before[name][0] + 10))
+
+    def test_400_and_410_changes(self):
+        latest = json.loads(self.client().get('/changes').data)['version']
+        res = self.client().get('/changes?since={}'.format(latest + 1000))
+        self.assertEqual(res.status_code, 410)
+        self.assertEqual(json.loads(res.data)['error'], 410)
+        self.assertEqual(self.client().get('/changes?since=-1').status_code,
+                         400)
+        self.assertEqual(self.client().get(
+            '/changes?since=0&limit=0').status_code, 400)
+
+    def test_quiz_answers_share_one_wait(self):
+        app = self.create_test_app({'ANSWER_QUEUE_SIZE': 1,
+                                    'ANSWER_FLUSH_INTERVAL': 60,
+                                    'ANSWER_QUEUE_TIMEOUT': 0.2})
+        recorder = app.extensions['answers']
+        started = time.monotonic()
+        with recorder._flush_lock:
+            recorded = recorder.record_all([(1, True)] * 100)
+
+        # check a full queue sheds the rest of a request after one wait
+        self.assertLess(time.monotonic() - started, 1)
+        self.assertEqual(recorded, 1)
+        self.assertEqual(recorder.stats()['dropped'], 99)
+        recorder.close()
+
+    def test_400_quiz_answers(self):
+        for body in [None, {'question_id': 1}, {'answers': []},
+                     {'question_id': '1', 'correct': True},
+                     {'question_id': 1, 'correct': 'yes'}]:
+            res = self.client().post('/quizzes/answers', json=body)
+            self.assertEqual(res.status_code, 400)
+
     def test_400_get_questions_to_play_missing_json(self):
 
         # create my_json with missing 'quiz_category' item